@@ -0,0 +1,896 @@
+"""
+Benchmarks for the qmupload transfer engine.
+
+Each benchmark sends data to a receiver on the loopback interface.  The
+receiver runs in a separate process, so the CPU time reported is only the time
+used by the sending side.
+
+usage: python qmbench.py [-r repeat] benchmark [arguments]
+
+Benchmarks:
+    sendfile file_path
+        Compare the chunked send loop with the zero-copy send path.
+
+    stripe file_path [latency_ms] [max_stripes]
+        Upload to a local QManager stand-in server with emulated link latency,
+        using 1, 2, 4 ... max_stripes parallel connections.  The stand-in
+        listens on port 8080, so that port must be free.
+
+    compress file_path [max_workers] [block_size]
+        Compress with 1, 2, 4 ... max_workers threads (default: one per CPU)
+        and report uncompressed MB/s and compression ratio.  Then compress
+        through an empty cache of compressed files, and again from the
+        cache.
+
+    chunks file_path [latency_ms] [sock_buf]
+        Upload to a local QManager stand-in server with chunk sizes from
+        16 KiB to 4 MiB, and report the MB/s of the data transfer alone.  Use
+        latency_ms to emulate a high-latency link.
+
+    ratelimit file_path [rate_mbps]
+        Send to a local receiver with a per-transfer limit, with the global
+        limit, with two transfers sharing the global limit, and with the limit
+        halved halfway through, and report achieved throughput against the
+        cap.  Fails if throughput is over the cap, or under 80% of it.  The
+        default rate is 100 Mbit/s.
+
+    hash file_path [buffer_size]
+        Report GB/s of each hash algorithm in HASH_ALGORITHMS that is
+        available, hashing the file in memory directly and through a
+        HashWorker, and check that the HashWorker digest and the digest of an
+        upload to a local QManager stand-in server match hashlib's.
+
+    digests file_path
+        Hash a copy of file_path through an empty DigestCache and again from
+        the cache, and report the time of each.  Then check that the cached
+        digest is not used once the copy's mtime or size changes or it is
+        replaced by another file, and that the least recently used entries
+        are evicted.
+
+    codec file_path [bandwidths_mbps]
+        Upload to a local QManager stand-in server with codec 'auto', rate
+        limited to emulate each comma-separated link bandwidth (default
+        10,100,1000), streamed and through a temporary file.  Report the
+        codec chosen, and the predicted and actual ratio and upload time.
+
+    sparse [size_gb] [data_mb]
+        Create a sparse image of size_gb GB (default 10) holding data_mb MB
+        (default 256) of data in 64 extents, then gzip-compress it and send it
+        to a local receiver, reading holes from disk and skipping them with
+        SEEK_DATA/SEEK_HOLE.  Report MB/s, bytes read by read() calls, and
+        check that both give the same compressed data and digest.
+
+    delta file_path [change_pct] [latency_ms]
+        Upload file_path to a local QManager stand-in server, then upload a
+        copy with change_pct percent (default 2) of it rewritten in 4 KiB
+        pieces and a few bytes inserted, in full and as a delta against the
+        first upload.  Report the time of each and the bytes sent.
+
+    download file_path [latency_ms] [max_stripes]
+        Upload file_path to a local QManager stand-in server, then download
+        it with emulated link latency (default 20 ms) over 1, 2, 4 ...
+        max_stripes (default 8) connections, and check the downloaded file.
+
+    cache file_path [latency_ms]
+        Upload file_path to a local QManager stand-in server, then download
+        it repeatedly with emulated link latency (default 20 ms) through an
+        empty download cache, and report the time of the first download, of
+        the repeats placed from the cache, and the cache counters.  Files
+        are only cached where the file system supports reflinks.
+
+    sparsedl [size_gb] [data_mb] [stripes]
+        Download a sparse image of size_gb GB (default 10) holding data_mb MB
+        (default 256) of data from a local QManager stand-in server, over
+        stripes connections (default 1), writing every block and leaving holes
+        for blocks of zeros.  Report MB/s, bytes written by write() calls and
+        disk space used, and check the downloaded file.
+
+    verify file_path [corrupt_chunks] [latency_ms]
+        Upload to a local QManager stand-in server without and with chunk
+        verification, then with corrupt_chunks (default 3) chunks of each
+        verified upload corrupted in flight by the stand-in.  Check that the
+        stored file is right and that only the corrupted chunks were sent
+        again, and report the time and the bytes resent.
+
+    tee file_path [fast_ms] [slow_ms]
+        Upload file_path gzip-compressed to two local QManager stand-in
+        servers, on 127.0.0.1 with emulated link latency fast_ms (default 0)
+        and on 127.0.0.2 with slow_ms (default 20), one server after the
+        other and then to both at once, reading and compressing the file
+        once.  Report the total time and when each server finished, and
+        check that both servers stored the same file.
+
+"""
+from __future__ import with_statement
+
+__author__ = 'Andrew Gillis'
+
+import sys
+import os
+import socket
+import time
+import shutil
+import tempfile
+import threading
+import random
+import hashlib
+import xmlrpclib
+import multiprocessing
+
+import qmupload
+import qmstandin
+
+
+def _sink(listen_sock):
+    # Accept connections and discard everything received on them.
+    buff = bytearray(1 << 20)
+    while True:
+        conn, _ = listen_sock.accept()
+        while conn.recv_into(buff):
+            pass
+        conn.close()
+
+
+def start_sink():
+    """Start a discarding receiver process.  Return (process, port)."""
+    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_sock.bind(('127.0.0.1', 0))
+    listen_sock.listen(5)
+    port = listen_sock.getsockname()[1]
+    proc = multiprocessing.Process(target=_sink, args=(listen_sock,))
+    proc.daemon = True
+    proc.start()
+    listen_sock.close()
+    return proc, port
+
+
+def measure(func, *args, **kwargs):
+    """Call func and return (result, wall_seconds, cpu_seconds)."""
+    t0 = os.times()
+    w0 = time.time()
+    result = func(*args, **kwargs)
+    wall = time.time() - w0
+    t1 = os.times()
+    cpu = (t1[0] - t0[0]) + (t1[1] - t0[1])
+    return result, wall, cpu
+
+
+def report(label, nbytes, wall, cpu, extra=''):
+    mbps = nbytes / wall / (1 << 20) if wall else 0.0
+    print '%-14s %10.1f MB/s %8.2f cpu-s %8.2f wall-s %s'\
+          % (label, mbps, cpu, wall, extra)
+
+
+def bench_sendfile(repeat, file_path):
+    """Compare the chunked send loop with the zero-copy send path."""
+    size = os.path.getsize(file_path)
+    proc, port = start_sink()
+    try:
+        print 'file %s: %d bytes, sendfile() %savailable'\
+              % (file_path, size, '' if qmupload._sendfile else 'not ')
+        for label, zero_copy in (('chunked loop', False),
+                                 ('zero-copy', True)):
+            for _ in range(repeat):
+                (status, results), wall, cpu = measure(
+                    qmupload._send_file, file_path, '127.0.0.1', port,
+                    zero_copy=zero_copy)
+                if not status:
+                    raise RuntimeError(results)
+                report(label, size, wall, cpu)
+    finally:
+        proc.terminate()
+
+
+def start_standin(latency=0.0, window=65536, corrupt=0, host='127.0.0.1'):
+    """Start a stand-in QManager server process on port 8080 of host.
+
+    Return:
+    (process, storage_root)
+
+    """
+    root = tempfile.mkdtemp(prefix='qmstandin-')
+    proc = multiprocessing.Process(target=qmstandin.serve,
+                                   args=(root, 8080, host, latency,
+                                         window, corrupt))
+    proc.daemon = True
+    proc.start()
+    qms = xmlrpclib.ServerProxy('http://%s:8080' % (host,))
+    for _ in range(50):
+        try:
+            qms.get_server_time()
+            break
+        except socket.error:
+            time.sleep(0.1)
+    return proc, root
+
+
+def bench_stripe(repeat, file_path, latency_ms=20, max_stripes=8):
+    """Upload with 1, 2, 4 ... max_stripes connections over a slow link."""
+    size = os.path.getsize(file_path)
+    proc, root = start_standin(float(latency_ms) / 1000.0)
+    try:
+        print 'file %s: %d bytes, emulated latency %s ms'\
+              % (file_path, size, latency_ms)
+        stripes = 1
+        while stripes <= int(max_stripes):
+            for _ in range(repeat):
+                _, wall, cpu = measure(
+                    qmupload.send_file_to_qmanager, 'bench', file_path,
+                    False, '127.0.0.1', stripes=stripes, dedupe=False)
+                report('%d stripe(s)' % (stripes,), size, wall, cpu)
+            stripes *= 2
+    finally:
+        proc.terminate()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_compress(repeat, file_path, max_workers=None, block_size=None):
+    """Compress with 1, 2, 4 ... max_workers threads."""
+    size = os.path.getsize(file_path)
+    max_workers = int(max_workers or qmupload.COMPRESS_WORKERS)
+    block_size = int(block_size or qmupload.GZIP_BLOCK_SIZE)
+    print 'file %s: %d bytes, block size %d' % (file_path, size, block_size)
+    workers = 1
+    while True:
+        for _ in range(repeat):
+            dst_path, wall, cpu = measure(qmupload.compress, file_path,
+                                          workers, block_size,
+                                          use_cache=False)
+            ratio = float(size) / os.path.getsize(dst_path)
+            os.unlink(dst_path)
+            report('%d worker(s)' % (workers,), size, wall, cpu,
+                   'ratio %.2f' % (ratio,))
+        if workers >= max_workers:
+            break
+        workers = min(workers * 2, max_workers)
+
+    # Compress again through an empty cache of compressed files.
+    tmp_dir = tempfile.mkdtemp(prefix='qmbench-')
+    cache_dir = qmupload.COMPRESS_CACHE_DIR
+    qmupload.COMPRESS_CACHE_DIR = tmp_dir
+    del qmupload._compress_cache[:]
+    try:
+        for i in range(repeat + 1):
+            dst_path, wall, cpu = measure(qmupload.compress, file_path,
+                                          workers, block_size,
+                                          use_cache=True)
+            os.unlink(dst_path)
+            report('not cached' if not i else 'cached', size, wall, cpu)
+    finally:
+        qmupload.COMPRESS_CACHE_DIR = cache_dir
+        del qmupload._compress_cache[:]
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def bench_chunks(repeat, file_path, latency_ms=0, sock_buf=None):
+    """Upload with each chunk size and report data transfer MB/s."""
+    size = os.path.getsize(file_path)
+    sock_buf = int(sock_buf) if sock_buf else None
+    proc, root = start_standin(float(latency_ms) / 1000.0)
+    qms = xmlrpclib.ServerProxy('http://127.0.0.1:8080')
+    try:
+        print 'file %s: %d bytes, emulated latency %s ms, socket buffer %s'\
+              % (file_path, size, latency_ms, sock_buf or 'default')
+        for chunk_size in (16383, 65536, 262144, 1048576, 4194304):
+            for _ in range(repeat):
+                fetch_id, port = qms.upload('bench', 'chunks.img', str(size))
+                (status, results), wall, cpu = measure(
+                    qmupload._send_file, file_path, '127.0.0.1', port,
+                    chunk_size=chunk_size, sock_buf=sock_buf)
+                if not status:
+                    raise RuntimeError(results)
+                while not qms.get_transfer_results(fetch_id,
+                                                   results['hash']):
+                    time.sleep(0.1)
+                report('%d' % (chunk_size,), size, wall, cpu)
+    finally:
+        proc.terminate()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def _send_limited(file_path, port, rate_limit=None):
+    status, results = qmupload._send_file(
+        file_path, '127.0.0.1', port, chunk_size=65536,
+        limiters=qmupload._rate_limiters(rate_limit))
+    if not status:
+        raise RuntimeError(results)
+    return results['size']
+
+
+def bench_ratelimit(repeat, file_path, rate_mbps=100):
+    """Check that achieved throughput stays at the rate limit."""
+    size = os.path.getsize(file_path)
+    rate = float(rate_mbps) * 1000000 / 8
+    proc, port = start_sink()
+
+    def check(label, nbytes, wall, cap, tolerance=0.05, floor=0.8):
+        achieved = nbytes / wall
+        report(label, nbytes, wall, 0.0, '%+.1f%% of cap %.1f MB/s' % (
+            (achieved / cap - 1) * 100, cap / (1 << 20)))
+        # A limiter that was idle can let one burst through at full speed.
+        allowed = cap * (1 + tolerance) + \
+                  cap * qmupload.RATE_LIMIT_BURST / wall
+        if achieved > allowed:
+            raise RuntimeError('%s: %.1f MB/s is over the cap of %.1f MB/s'
+                               % (label, achieved / (1 << 20),
+                                  cap / (1 << 20)))
+        # A limiter that stalls or throttles too hard is also wrong.
+        if achieved < cap * floor:
+            raise RuntimeError('%s: %.1f MB/s is under %d%% of the cap of '
+                               '%.1f MB/s' % (label, achieved / (1 << 20),
+                                              floor * 100, cap / (1 << 20)))
+
+    try:
+        print 'file %s: %d bytes, limit %s Mbit/s' % (file_path, size,
+                                                     rate_mbps)
+        for _ in range(repeat):
+            # Per-transfer limit.
+            _, wall, _ = measure(_send_limited, file_path, port, rate)
+            check('per-transfer', size, wall, rate)
+
+            # Global limit, alone and shared by two concurrent transfers.
+            qmupload.global_rate_limiter.set_rate(rate)
+            try:
+                _, wall, _ = measure(_send_limited, file_path, port)
+                check('global', size, wall, rate)
+                threads = [threading.Thread(target=_send_limited,
+                                            args=(file_path, port))
+                           for _i in range(2)]
+                w0 = time.time()
+                for th in threads:
+                    th.start()
+                for th in threads:
+                    th.join()
+                check('global x2', 2 * size, time.time() - w0, rate)
+            finally:
+                qmupload.global_rate_limiter.set_rate(None)
+
+            # Halve the limit when half the data should have been sent.
+            limiter = qmupload.RateLimiter(rate)
+            timer = threading.Timer(size / rate / 2, limiter.set_rate,
+                                    (rate / 2,))
+            timer.start()
+            _, wall, _ = measure(_send_limited, file_path, port, limiter)
+            timer.join()
+            check('changed', size, wall, size / (size / rate * 1.5))
+    finally:
+        proc.terminate()
+
+
+def bench_hash(repeat, file_path, buffer_size=1048576):
+    """Report hash GB/s per algorithm and check HashWorker digests."""
+    buffer_size = int(buffer_size)
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    size = len(data)
+    view = memoryview(data)
+    print 'file %s: %d bytes, buffer size %d' % (file_path, size,
+                                                 buffer_size)
+
+    def hash_direct(algorithm):
+        h = qmupload.new_hash(algorithm)
+        for pos in xrange(0, size, buffer_size):
+            h.update(view[pos:pos + buffer_size])
+        return h.hexdigest()
+
+    def hash_worker(algorithm):
+        worker = qmupload.HashWorker(qmupload.new_hash(algorithm),
+                                     buffer_size)
+        for pos in xrange(0, size, buffer_size):
+            buf = worker.buffer()
+            n = len(view[pos:pos + buffer_size])
+            buf[:n] = view[pos:pos + n]
+            worker.update(buf, n)
+        return worker.hexdigest()
+
+    for algorithm in qmupload.HASH_ALGORITHMS:
+        try:
+            expected = qmupload.new_hash(algorithm)
+        except ValueError:
+            print '%-14s not available' % (algorithm,)
+            continue
+        expected.update(data)
+        expected = expected.hexdigest()
+        for label, func in (('direct', hash_direct),
+                            ('worker', hash_worker)):
+            for _ in range(repeat):
+                digest, wall, cpu = measure(func, algorithm)
+                if digest != expected:
+                    raise RuntimeError('%s %s digest mismatch' %
+                                       (algorithm, label))
+                gbps = size / wall / (1 << 30) if wall else 0.0
+                print '%-14s %10.2f GB/s %8.2f cpu-s %8.2f wall-s'\
+                      % ('%s %s' % (algorithm, label), gbps, cpu, wall)
+
+    # Digest sent with an upload must be the same as hashing the file.
+    proc, root = start_standin()
+    try:
+        capabilities = qmupload._server_capabilities(
+            xmlrpclib.ServerProxy('http://127.0.0.1:8080'))
+        for algorithm in qmupload.HASH_ALGORITHMS:
+            if (algorithm != 'sha1' and
+                'hash:' + algorithm not in capabilities):
+                continue
+            m = qmupload.TransferMetrics()
+            qmupload.send_file_to_qmanager(
+                'bench', file_path, False, '127.0.0.1', dedupe=False,
+                digest_cache=False, metrics=m, hash_algorithm=algorithm)
+            print 'upload with %s verified by server in %.2f s'\
+                  % (algorithm, m.record['elapsed'])
+    finally:
+        proc.terminate()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_digests(repeat, file_path):
+    """Time DigestCache hits and misses, and check when entries are used."""
+    tmp_dir = tempfile.mkdtemp(prefix='qmbench-')
+    # Digests of files modified in the last two seconds are not stored, so
+    # give the files an mtime in the past.
+    past = time.time() - 60
+
+    def make_file(path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.utime(path, (past, past))
+
+    def expect(label, found, wanted):
+        if found != wanted:
+            raise RuntimeError('%s: cached digest %r, expected %r' %
+                               (label, found, wanted))
+
+    try:
+        path = os.path.join(tmp_dir, 'copy')
+        shutil.copyfile(file_path, path)
+        os.utime(path, (past, past))
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            expected = qmupload._file_digest(f, size)
+        print 'file %s: %d bytes' % (file_path, size)
+        for _ in range(repeat):
+            cache = qmupload.DigestCache(os.path.join(tmp_dir, 'digests.db'))
+            for label in ('not cached', 'cached'):
+                digest, wall, cpu = measure(cache.digest, path)
+                expect(label, digest, expected)
+                report(label, size, wall, cpu)
+            os.unlink(os.path.join(tmp_dir, 'digests.db'))
+
+        cache = qmupload.DigestCache(os.path.join(tmp_dir, 'digests.db'))
+        cache.digest(path)
+        expect('hit', cache.lookup(path), expected)
+        os.utime(path, (past + 1, past + 1))
+        expect('mtime changed', cache.lookup(path), None)
+
+        cache.digest(path)
+        with open(path, 'ab') as f:
+            f.write('x')
+        os.utime(path, (past + 1, past + 1))
+        expect('size changed', cache.lookup(path), None)
+
+        # Same content, size and mtime, but a new inode.
+        cache.digest(path)
+        new_path = os.path.join(tmp_dir, 'replacement')
+        shutil.copyfile(path, new_path)
+        os.utime(new_path, (past + 1, past + 1))
+        os.rename(new_path, path)
+        expect('replaced', cache.lookup(path), None)
+
+        cache = qmupload.DigestCache(os.path.join(tmp_dir, 'small.db'), 2)
+        paths = []
+        for i in range(3):
+            paths.append(os.path.join(tmp_dir, 'small%d' % (i,)))
+            make_file(paths[-1], str(i))
+            cache.digest(paths[-1])
+        expect('evicted', cache.lookup(paths[0]), None)
+        for p in paths[1:]:
+            with open(p, 'rb') as f:
+                expect('kept', cache.lookup(p), qmupload._file_digest(f, 1))
+        print 'digest cache checks passed: hit, mtime changed, size '\
+              'changed, replaced, evicted'
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def bench_codec(repeat, file_path, bandwidths_mbps='10,100,1000'):
+    """Compare predicted and actual upload times of automatic codecs."""
+    size = os.path.getsize(file_path)
+    print 'file %s: %d bytes' % (file_path, size)
+    proc, root = start_standin()
+    try:
+        for mbps in bandwidths_mbps.split(','):
+            mbps = float(mbps)
+            # Two stripes make the upload compress to a file first.
+            for mode, stripes in (('stream', 1), ('file', 2)):
+                for _ in range(repeat):
+                    m = qmupload.TransferMetrics()
+                    qmupload.send_file_to_qmanager(
+                        'bench', file_path, False, '127.0.0.1',
+                        stripes=stripes, stream_compress=True,
+                        digest_cache=False, dedupe=False, metrics=m,
+                        rate_limit=mbps * 1000000 / 8, codec='auto',
+                        bandwidth=mbps, compress_cache=False)
+                    decision = m.record['codec']
+                    if decision is None:
+                        print '%s is already compressed' % (file_path,)
+                        return
+                    pred = decision['predicted']
+                    act = decision['actual']
+                    print '%6g Mbit/s %-6s %4s %d  ratio %.3f/%.3f  '\
+                          'time %7.2f/%7.2f s' % (
+                              mbps, mode, decision['codec'],
+                              decision['level'], pred['ratio'], act['ratio'],
+                              pred['total_time'], act['total_time'])
+    finally:
+        proc.terminate()
+        shutil.rmtree(root, ignore_errors=True)
+    print '(predicted/actual)'
+
+
+def _io_chars(field='rchar'):
+    # Bytes this process has read with read() calls (rchar), or written with
+    # write() calls (wchar), or None if unknown.
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def _make_sparse_image(path, size, data_size, extents=64):
+    """Write data_size bytes of data in extents spread through a hole."""
+    text = ('qmupload sparse image benchmark ' * 4096)
+    extent_size = data_size // extents
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        for i in range(extents):
+            f.seek(i * (size // extents))
+            half = extent_size // 2
+            f.write(os.urandom(half))
+            f.write((text * (half // len(text) + 1))[:extent_size - half])
+
+
+def bench_sparse(repeat, size_gb=10, data_mb=256):
+    """Compress and send a sparse image, with and without skipping holes."""
+    size = int(float(size_gb) * (1 << 30))
+    tmp_dir = tempfile.mkdtemp(prefix='qmbench-')
+    path = os.path.join(tmp_dir, 'sparse.img')
+    _make_sparse_image(path, size, int(float(data_mb) * (1 << 20)))
+    proc, port = start_sink()
+    sparse_reads = qmupload.SPARSE_READS
+    print 'file %s: %d bytes, %d bytes allocated on disk'\
+          % (path, size, os.stat(path).st_blocks * 512)
+
+    def compress():
+        dst_path = qmupload.compress(path, qmupload.COMPRESS_WORKERS,
+                                     use_cache=False)
+        h = hashlib.sha1()
+        with open(dst_path, 'rb') as f:
+            for data in iter(lambda: f.read(1 << 20), ''):
+                h.update(data)
+        os.unlink(dst_path)
+        return h.hexdigest()
+
+    def send():
+        status, results = qmupload._send_file(path, '127.0.0.1', port,
+                                              chunk_size=1 << 20)
+        if not status:
+            raise RuntimeError(results)
+        return results['hash']
+
+    try:
+        for op, func in (('compress', compress), ('send', send)):
+            outputs = set()
+            for label, sparse in (('read holes', False),
+                                  ('skip holes', True)):
+                qmupload.SPARSE_READS = sparse
+                for _ in range(repeat):
+                    rchar = _io_chars()
+                    output, wall, cpu = measure(func)
+                    extra = ''
+                    if rchar is not None:
+                        extra = '%d MB read' % (
+                            (_io_chars() - rchar) >> 20,)
+                    report('%s %s' % (op, label), size, wall, cpu, extra)
+                    outputs.add(output)
+            if len(outputs) != 1:
+                raise RuntimeError('%s output differs when skipping holes'
+                                   % (op,))
+            print '%s output identical: %s' % (op, outputs.pop())
+    finally:
+        qmupload.SPARSE_READS = sparse_reads
+        proc.terminate()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def bench_delta(repeat, file_path, change_pct=2, latency_ms=0):
+    """Compare a full upload with a delta upload of a changed copy."""
+    size = os.path.getsize(file_path)
+    tmp_dir = tempfile.mkdtemp(prefix='qmbench-')
+    new_path = os.path.join(tmp_dir, 'changed.img')
+    shutil.copyfile(file_path, new_path)
+    with open(new_path, 'r+b') as f:
+        for _ in range(int(size * float(change_pct) / 100) // 4096):
+            f.seek(random.randrange(size - 4096))
+            f.write(os.urandom(4096))
+        # Shift the rest of the file by inserting bytes near the start.
+        f.seek(size // 10)
+        rest = f.read()
+        f.seek(size // 10)
+        f.write(os.urandom(123) + rest)
+    new_size = os.path.getsize(new_path)
+
+    base_name = os.path.basename(file_path)
+    proc, root = start_standin(float(latency_ms) / 1000.0)
+    try:
+        qmupload.send_file_to_qmanager('bench', file_path, False,
+                                       '127.0.0.1', dedupe=False)
+        print 'file %s: %d bytes, changed copy %d bytes'\
+              % (file_path, size, new_size)
+        for label, delta_base in (('full', None), ('delta', base_name)):
+            for _ in range(repeat):
+                m = qmupload.TransferMetrics()
+                _, wall, cpu = measure(
+                    qmupload.send_file_to_qmanager, 'bench', new_path,
+                    False, '127.0.0.1', dedupe=False, digest_cache=False,
+                    metrics=m, delta_base=delta_base)
+                sent = m.record['bytes_out']
+                report(label, new_size, wall, cpu,
+                       '%d bytes sent, %.1f%% saved' %
+                       (sent, 100.0 * (new_size - sent) / new_size))
+    finally:
+        proc.terminate()
+        shutil.rmtree(root, ignore_errors=True)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def bench_download(repeat, file_path, latency_ms=20, max_stripes=8):
+    """Download with 1, 2, 4 ... max_stripes connections over a slow link."""
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        expected = qmupload._file_digest(f, size)
+    tmp_dir = tempfile.mkdtemp(prefix='qmbench-')
+    dst_path = os.path.join(tmp_dir, os.path.basename(file_path))
+    proc, root = start_standin(float(latency_ms) / 1000.0)
+    try:
+        qmupload.send_file_to_qmanager('bench', file_path, False,
+                                       '127.0.0.1', dedupe=False)
+        print 'file %s: %d bytes, emulated latency %s ms, pwrite() %s'\
+              'available' % (file_path, size, latency_ms,
+                             '' if qmupload._pwrite else 'not ')
+        stripes = 1
+        while stripes <= int(max_stripes):
+            for _ in range(repeat):
+                _, wall, cpu = measure(
+                    qmupload.recv_file_from_qmanager, 'bench', dst_path,
+                    False, '127.0.0.1', stripes=stripes,
+                    hash_algorithm='sha1', download_cache=False)
+                with open(dst_path, 'rb') as f:
+                    if qmupload._file_digest(f, size) != expected:
+                        raise RuntimeError('downloaded file differs')
+                os.unlink(dst_path)
+                report('%d stripe(s)' % (stripes,), size, wall, cpu)
+            stripes *= 2
+    finally:
+        proc.terminate()
+        shutil.rmtree(root, ignore_errors=True)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def bench_cache(repeat, file_path, latency_ms=20):
+    """Download the same file repeatedly through the download cache."""
+    size = os.path.getsize(file_path)
+    tmp_dir = tempfile.mkdtemp(prefix='qmbench-')
+    dst_path = os.path.join(tmp_dir, os.path.basename(file_path))
+    cache_dir = qmupload.DOWNLOAD_CACHE_DIR
+    qmupload.DOWNLOAD_CACHE_DIR = os.path.join(tmp_dir, 'cache')
+    del qmupload._download_cache[:]
+    proc, root = start_standin(float(latency_ms) / 1000.0)
+    try:
+        qmupload.send_file_to_qmanager('bench', file_path, False,
+                                       '127.0.0.1', dedupe=False)
+        print 'file %s: %d bytes, emulated latency %s ms'\
+              % (file_path, size, latency_ms)
+        for i in range(repeat + 1):
+            hits = qmupload.download_cache_stats['hits']
+            _, wall, cpu = measure(
+                qmupload.recv_file_from_qmanager, 'bench', dst_path, False,
+                '127.0.0.1')
+            if qmupload.download_cache_stats['hits'] > hits:
+                label = 'cached'
+            else:
+                label = 'downloaded'
+            report(label, size, wall, cpu)
+        if not qmupload.download_cache_stats['hits']:
+            print 'nothing cached: no reflinks in %s' % (tmp_dir,)
+        print 'cache counters:', qmupload.download_cache_stats
+    finally:
+        proc.terminate()
+        shutil.rmtree(root, ignore_errors=True)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        qmupload.DOWNLOAD_CACHE_DIR = cache_dir
+        del qmupload._download_cache[:]
+
+
+def bench_sparsedl(repeat, size_gb=10, data_mb=256, stripes=1):
+    """Download a sparse image, writing zeros and leaving holes."""
+    size = int(float(size_gb) * (1 << 30))
+    tmp_dir = tempfile.mkdtemp(prefix='qmbench-')
+    dst_path = os.path.join(tmp_dir, 'sparse.img')
+    proc, root = start_standin()
+    try:
+        path = os.path.join(root, 'users', 'bench', 'sparse.img')
+        os.makedirs(os.path.dirname(path))
+        _make_sparse_image(path, size, int(float(data_mb) * (1 << 20)))
+        with open(path, 'rb') as f:
+            expected = qmupload._file_digest(f, size)
+        print 'file %s: %d bytes, %d bytes allocated on disk'\
+              % (path, size, os.stat(path).st_blocks * 512)
+        for label, sparse in (('write zeros', False), ('leave holes', True)):
+            for _ in range(repeat):
+                wchar = _io_chars('wchar')
+                _, wall, cpu = measure(
+                    qmupload.recv_file_from_qmanager, 'bench', dst_path,
+                    False, '127.0.0.1', stripes=int(stripes),
+                    hash_algorithm='sha1', sparse=sparse,
+                    download_cache=False)
+                extra = '%d MB on disk' % (
+                    os.stat(dst_path).st_blocks * 512 >> 20,)
+                if wchar is not None:
+                    extra = '%d MB written, %s' % (
+                        (_io_chars('wchar') - wchar) >> 20, extra)
+                with open(dst_path, 'rb') as f:
+                    if (os.path.getsize(dst_path) != size or
+                        qmupload._file_digest(f, size) != expected):
+                        raise RuntimeError('downloaded file differs')
+                os.unlink(dst_path)
+                report(label, size, wall, cpu, extra)
+    finally:
+        proc.terminate()
+        shutil.rmtree(root, ignore_errors=True)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def bench_verify(repeat, file_path, corrupt_chunks=3, latency_ms=0):
+    """Upload with chunks corrupted in flight, and check the repair."""
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        expected = qmupload._file_digest(f, size)
+    chunk_size = qmupload.VERIFY_CHUNK_SIZE
+    chunks = -(-size // chunk_size)
+    corrupt_chunks = min(int(corrupt_chunks), chunks)
+    print 'file %s: %d bytes, %d chunks of %d bytes'\
+          % (file_path, size, chunks, chunk_size)
+    for label, corrupt, verify in (('not verified', 0, False),
+                                   ('verified', 0, True),
+                                   ('%d corrupted' % (corrupt_chunks,),
+                                    corrupt_chunks, True)):
+        proc, root = start_standin(float(latency_ms) / 1000.0,
+                                   corrupt=corrupt)
+        try:
+            for _ in range(repeat):
+                m = qmupload.TransferMetrics()
+                _, wall, cpu = measure(
+                    qmupload.send_file_to_qmanager, 'bench', file_path,
+                    False, '127.0.0.1', dedupe=False, digest_cache=False,
+                    metrics=m, verify_chunks=verify)
+                stored = os.path.join(root, 'users', 'bench',
+                                      os.path.basename(file_path))
+                with open(stored, 'rb') as f:
+                    if qmupload._file_digest(f, size) != expected:
+                        raise RuntimeError('stored file differs')
+                os.unlink(stored)
+                resent = m.record['resent']
+                # Each corrupted chunk is a full chunk, except maybe the last.
+                if resent > corrupt * chunk_size or (
+                        corrupt and resent <= (corrupt - 1) * chunk_size):
+                    raise RuntimeError('%d bytes resent for %d corrupted '
+                                       'chunks' % (resent, corrupt))
+                report(label, size, wall, cpu, '%d bytes resent' % (resent,))
+        finally:
+            proc.terminate()
+            proc.join()
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def bench_tee(repeat, file_path, fast_ms=0, slow_ms=20):
+    """Upload to a fast and a slow server in turn, and to both at once."""
+    size = os.path.getsize(file_path)
+    hosts = ('127.0.0.1', '127.0.0.2')
+    standins = [start_standin(float(fast_ms) / 1000.0),
+                start_standin(float(slow_ms) / 1000.0, host=hosts[1])]
+    file_name = os.path.basename(file_path) + '.gz'
+    options = dict(stream_compress=True, dedupe=False, digest_cache=False,
+                   compress_cache=False)
+
+    def one_at_a_time():
+        for host in hosts:
+            m = qmupload.TransferMetrics(records.append)
+            qmupload.send_file_to_qmanager('bench', file_path, False, host,
+                                           metrics=m, verify_chunks=False,
+                                           **options)
+
+    def at_once():
+        results = qmupload.send_file_to_qmanagers(
+            'bench', file_path, False, hosts,
+            metrics_callback=records.append, **options)
+        for host in hosts:
+            if results[host]:
+                raise RuntimeError('%s: %s' % (host, results[host]))
+
+    try:
+        print 'file %s: %d bytes, emulated latency %s ms to %s and %s ms '\
+              'to %s' % (file_path, size, fast_ms, hosts[0], slow_ms,
+                         hosts[1])
+        for label, upload in (('one at a time', one_at_a_time),
+                              ('at once', at_once)):
+            for _ in range(repeat):
+                records = []
+                start = time.time()
+                _, wall, cpu = measure(upload)
+                finished = dict(
+                    (r['server'],
+                     r['start_time'] + r['elapsed'] - start)
+                    for r in records)
+                digests = []
+                for _, root in standins:
+                    stored = os.path.join(root, 'users', 'bench', file_name)
+                    with open(stored, 'rb') as f:
+                        digests.append(qmupload._file_digest(
+                            f, os.path.getsize(stored)))
+                    os.unlink(stored)
+                if digests[0] != digests[1]:
+                    raise RuntimeError('servers stored different files')
+                report(label, size, wall, cpu, ' '.join(
+                    '%s done %.2fs' % (host, finished[host])
+                    for host in hosts))
+    finally:
+        for proc, root in standins:
+            proc.terminate()
+            proc.join()
+            shutil.rmtree(root, ignore_errors=True)
+
+
+BENCHMARKS = {
+    'sendfile': bench_sendfile,
+    'stripe': bench_stripe,
+    'compress': bench_compress,
+    'chunks': bench_chunks,
+    'ratelimit': bench_ratelimit,
+    'hash': bench_hash,
+    'digests': bench_digests,
+    'codec': bench_codec,
+    'sparse': bench_sparse,
+    'delta': bench_delta,
+    'download': bench_download,
+    'cache': bench_cache,
+    'sparsedl': bench_sparsedl,
+    'verify': bench_verify,
+    'tee': bench_tee,
+}
+
+
+if __name__ == '__main__':
+    argv = list(sys.argv)
+    prg = argv.pop(0)
+    usage_msg = 'usage: python %s [-r repeat] benchmark [arguments]' % (prg,)
+
+    repeat = 3
+    while argv and argv[0].startswith('-'):
+        arg = argv.pop(0)
+        if arg == '-r' and argv:
+            repeat = int(argv.pop(0))
+        else:
+            print usage_msg
+            print __doc__
+            sys.exit(0)
+
+    if not argv or argv[0] not in BENCHMARKS:
+        print usage_msg
+        print 'benchmarks:', ', '.join(sorted(BENCHMARKS))
+        sys.exit(1)
+
+    name = argv.pop(0)
+    BENCHMARKS[name](repeat, *argv)
@@ -0,0 +1,783 @@
+"""
+QManager stand-in server for testing qmupload transfers locally.
+
+This implements the part of the QManager XML-RPC interface that qmupload uses
+(upload, download, transfer results, file listing), plus the optional transfer
+features that qmupload can use when the server advertises them in the
+'capabilities' list returned by get_server_info().  Hash algorithms other than
+SHA-1 that this Python supports are advertised as 'hash:<name>', and are used
+for a transfer when named as the last argument of upload(), upload_stream(),
+upload_striped(), upload_delta(), upload_verified(), download(),
+download_striped() or file_info().  Files are kept in a local storage
+directory:
+
+    <root>/users/<user_name>/<file_name>
+    <root>/shared/<file_name>
+
+A high-latency link can be emulated on the data connections.  Each data
+connection moves at most one window of data per round trip, which is how a
+single TCP stream behaves on a long fat network.
+
+For testing verified uploads, a number of chunks of each upload_verified()
+transfer can be corrupted in flight: one byte of each is changed as it is
+received, before it is written and hashed.  Chunks sent again by
+repair_upload() are not corrupted.
+
+usage: python qmstandin.py [options] storage_root
+
+Options
+    -p port     : XML-RPC port to listen on (default 8080)
+    -l ms       : emulated round-trip latency of data connections
+    -w bytes    : emulated window size per round trip (default 65536)
+    -c count    : corrupt count chunks of each verified upload
+
+"""
+from __future__ import with_statement
+
+__author__ = 'Andrew Gillis'
+
+import sys
+import os
+import socket
+import random
+import threading
+import time
+import uuid
+import shutil
+import struct
+import SocketServer
+import xmlrpclib
+from SimpleXMLRPCServer import SimpleXMLRPCServer
+
+from qmupload import (new_hash, block_signature, ChunkTree, HASH_ALGORITHMS,
+                      DELTA_COPY, DELTA_LITERAL)
+
+SERVER_VERSION = '1.0.4'
+CHUNK_SIZE = 65536
+ACCEPT_TIMEOUT = 60
+
+CAPABILITIES = ['striped_upload', 'resume', 'stream_upload', 'find_file',
+                'delta_upload', 'striped_download', 'chunk_verify',
+                'file_info']
+
+
+def _hash_capabilities():
+    caps = []
+    for algorithm in HASH_ALGORITHMS:
+        if algorithm == 'sha1':
+            continue
+        try:
+            new_hash(algorithm)
+        except ValueError:
+            continue
+        caps.append('hash:' + algorithm)
+    return caps
+
+CAPABILITIES.extend(_hash_capabilities())
+
+
+class _Link(object):
+
+    """Pace a data connection as if it had the given latency and window."""
+
+    def __init__(self, latency=0.0, window=65536):
+        self._latency = latency
+        self._window = window
+        self._count = 0
+
+    def pace(self, nbytes):
+        if not self._latency:
+            return
+        self._count += nbytes
+        while self._count >= self._window:
+            self._count -= self._window
+            time.sleep(self._latency)
+
+
+class _Transfer(object):
+
+    """State of one upload or download."""
+
+    def __init__(self, path, size=None, algorithm='sha1'):
+        self.path = path
+        self.size = size
+        self.algorithm = algorithm
+        self.dst_path = None
+        self.resumable = False
+        self.done = threading.Event()
+        self.error = None
+        self.recv_size = None
+        self.hash = None
+        self.tree = None
+        self.stale = set()
+
+
+def _file_hash(path, algorithm='sha1'):
+    h = new_hash(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+class ThreadedXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class StandInServer(object):
+
+    """XML-RPC methods of the stand-in QManager server."""
+
+    def __init__(self, root, host='127.0.0.1', latency=0.0, window=65536,
+                 corrupt=0):
+        self._root = os.path.abspath(root)
+        self._host = host
+        self._latency = latency
+        self._window = window
+        self._corrupt = corrupt
+        self._transfers = {}
+        self._hashes = {}
+        self._lock = threading.Lock()
+        self._incoming = os.path.join(self._root, '.incoming')
+        for d in (self._incoming, os.path.join(self._root, 'users'),
+                  os.path.join(self._root, 'shared')):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+    #
+    # Helpers
+    #
+
+    def _storage_path(self, user_name, file_name):
+        if file_name.startswith('shared/'):
+            return os.path.join(self._root, 'shared',
+                                os.path.basename(file_name))
+        return os.path.join(self._root, 'users', user_name,
+                            os.path.basename(file_name))
+
+    def _new_transfer(self, path, size=None, algorithm='sha1'):
+        if 'hash:' + algorithm not in CAPABILITIES and algorithm != 'sha1':
+            raise Exception('unsupported hash algorithm: ' + algorithm)
+        fetch_id = uuid.uuid4().hex
+        xfer = _Transfer(path, size, algorithm)
+        with self._lock:
+            self._transfers[fetch_id] = xfer
+        return fetch_id, xfer
+
+    def _listen(self):
+        lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        lsock.bind((self._host, 0))
+        lsock.listen(1)
+        lsock.settimeout(ACCEPT_TIMEOUT)
+        return lsock, lsock.getsockname()[1]
+
+    def _serve_once(self, lsock, handler, *args):
+        """Accept one data connection and run handler on it in a thread."""
+        def run():
+            try:
+                conn, _ = lsock.accept()
+            except socket.timeout:
+                return
+            finally:
+                lsock.close()
+            try:
+                handler(conn, *args)
+            finally:
+                conn.close()
+        th = threading.Thread(target=run)
+        th.daemon = True
+        th.start()
+
+    def _recv_range(self, conn, path, offset, length=None, tree=None,
+                    corrupt=()):
+        """Receive data into path at offset.  Return bytes received.
+
+        The data is also given to tree, if not None.  The bytes at the file
+        offsets in corrupt are changed as they are received.
+
+        """
+        link = _Link(self._latency, self._window)
+        buff = bytearray(CHUNK_SIZE)
+        view = memoryview(buff)
+        total = 0
+        with open(path, 'r+b') as f:
+            f.seek(offset)
+            while length is None or total < length:
+                want = CHUNK_SIZE
+                if length is not None:
+                    want = min(want, length - total)
+                n = conn.recv_into(view[:want])
+                if not n:
+                    break
+                start = offset + total
+                for pos in corrupt:
+                    if start <= pos < start + n:
+                        buff[pos - start] ^= 0xff
+                f.write(view[:n])
+                if tree is not None:
+                    tree.update(view[:n])
+                total += n
+                link.pace(n)
+        return total
+
+    def _recv_delta(self, conn, base_path, path, block_size):
+        """Rebuild a file from a base file and delta instructions."""
+        link = _Link(self._latency, self._window)
+        stream = conn.makefile('rb')
+        with open(base_path, 'rb') as base, open(path, 'wb') as f:
+            while True:
+                op = stream.read(1)
+                if not op:
+                    break
+                if op == DELTA_COPY:
+                    index, count = struct.unpack('>LL', stream.read(8))
+                    base.seek(index * block_size)
+                    for _ in xrange(count):
+                        data = base.read(block_size)
+                        if len(data) != block_size:
+                            raise Exception('copy past end of base file')
+                        f.write(data)
+                    link.pace(9)
+                elif op == DELTA_LITERAL:
+                    length, = struct.unpack('>L', stream.read(4))
+                    data = stream.read(length)
+                    if len(data) != length:
+                        raise Exception('delta ended in literal data')
+                    f.write(data)
+                    link.pace(5 + length)
+                else:
+                    raise Exception('bad delta instruction: %r' % (op,))
+
+    def _finish_upload(self, xfer, error=None):
+        xfer.error = error
+        if not error:
+            xfer.recv_size = os.path.getsize(xfer.path)
+            xfer.hash = _file_hash(xfer.path, xfer.algorithm)
+        xfer.done.set()
+
+    def _take_transfer(self, fetch_id):
+        with self._lock:
+            xfer = self._transfers.get(fetch_id)
+            if xfer is None or not xfer.done.is_set():
+                return xfer
+            del self._transfers[fetch_id]
+        return xfer
+
+    #
+    # XML-RPC interface
+    #
+
+    def get_server_time(self):
+        return time.time()
+
+    def get_server_info(self):
+        return {'server_version': SERVER_VERSION,
+                'capabilities': CAPABILITIES}
+
+    def list_files(self, user_name):
+        files = []
+        user_dir = os.path.join(self._root, 'users', user_name)
+        if user_name and os.path.isdir(user_dir):
+            files.extend(sorted(os.listdir(user_dir)))
+        shared_dir = os.path.join(self._root, 'shared')
+        files.extend('shared/' + n for n in sorted(os.listdir(shared_dir)))
+        return files
+
+    def copy_file(self, user_name, file_name):
+        """Copy a file between the shared and private storage areas."""
+        src = self._storage_path(user_name, file_name)
+        if not os.path.isfile(src):
+            raise Exception('file not found: ' + file_name)
+        if file_name.startswith('shared/'):
+            dst_name = os.path.basename(file_name)
+        else:
+            dst_name = 'shared/' + file_name
+        dst = self._storage_path(user_name, dst_name)
+        dst_dir = os.path.dirname(dst)
+        if not os.path.isdir(dst_dir):
+            os.makedirs(dst_dir)
+        shutil.copyfile(src, dst)
+        return dst_name
+
+    def rename_file(self, user_name, src_name, dst_name):
+        src = self._storage_path(user_name, src_name)
+        if not os.path.isfile(src):
+            raise Exception('file not found: ' + src_name)
+        os.rename(src, self._storage_path(user_name, dst_name))
+        return dst_name
+
+    def delete_file(self, user_name, file_name):
+        path = self._storage_path(user_name, file_name)
+        if not os.path.isfile(path):
+            return False
+        os.unlink(path)
+        return True
+
+    def file_info(self, user_name, file_name, hash_algorithm='sha1'):
+        """Return {'file_size': size, 'hash': hex digest} of a stored file,
+        or False if there is no such file.
+
+        Digests are kept until the file changes, so that asking again is
+        cheap.
+
+        """
+        path = self._storage_path(user_name, file_name)
+        if not os.path.isfile(path):
+            return False
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime, hash_algorithm)
+        digest = self._hashes.get(key)
+        if digest is None:
+            digest = _file_hash(path, hash_algorithm)
+            self._hashes[key] = digest
+        return {'file_size': str(st.st_size), 'hash': digest}
+
+    def find_file(self, user_name, file_hash, file_size):
+        """Return names of the user's and shared files with given content."""
+        found = []
+        for name in self.list_files(user_name):
+            path = self._storage_path(user_name, name)
+            if (os.path.getsize(path) == long(file_size) and
+                _file_hash(path) == file_hash):
+                found.append(name)
+        return found
+
+    def upload(self, user_name, file_name, file_size, hash_algorithm='sha1'):
+        tmp_path = os.path.join(self._incoming, uuid.uuid4().hex)
+        open(tmp_path, 'wb').close()
+        fetch_id, xfer = self._new_transfer(tmp_path, long(file_size),
+                                            hash_algorithm)
+        xfer.dst_path = self._storage_path(user_name, file_name)
+
+        def handler(conn):
+            try:
+                self._recv_range(conn, tmp_path, 0)
+            except Exception as e:
+                self._finish_upload(xfer, str(e))
+            else:
+                self._finish_upload(xfer)
+
+        lsock, port = self._listen()
+        self._serve_once(lsock, handler)
+        return fetch_id, port
+
+    def upload_verified(self, user_name, file_name, file_size, chunk_size,
+                        hash_algorithm='sha1'):
+        """Prepare to receive a file that is verified chunk by chunk.
+
+        A ChunkTree of the data is built as it is received, for the client
+        to compare with upload_tree(), and chunks received wrong are sent
+        again through repair_upload().
+
+        """
+        file_size, chunk_size = long(file_size), int(chunk_size)
+        tmp_path = os.path.join(self._incoming, uuid.uuid4().hex)
+        open(tmp_path, 'wb').close()
+        fetch_id, xfer = self._new_transfer(tmp_path, file_size,
+                                            hash_algorithm)
+        xfer.dst_path = self._storage_path(user_name, file_name)
+        xfer.tree = ChunkTree(chunk_size, hash_algorithm)
+
+        chunks = -(-file_size // chunk_size)
+        corrupt = []
+        for index in random.sample(xrange(chunks), min(self._corrupt, chunks)):
+            length = min(chunk_size, file_size - index * chunk_size)
+            corrupt.append(index * chunk_size + random.randrange(length))
+
+        def handler(conn):
+            try:
+                self._recv_range(conn, tmp_path, 0, tree=xfer.tree,
+                                 corrupt=corrupt)
+            except Exception as e:
+                self._finish_upload(xfer, str(e))
+            else:
+                self._finish_upload(xfer)
+            finally:
+                xfer.tree.close()
+
+        lsock, port = self._listen()
+        self._serve_once(lsock, handler)
+        return fetch_id, port
+
+    def upload_tree(self, fetch_id, level, indices):
+        """Return the hex digests of nodes of a verified upload's ChunkTree.
+
+        A node whose data has not all been received yet is returned as '',
+        and one past the end of the data received as 'missing'.
+
+        """
+        with self._lock:
+            xfer = self._transfers.get(fetch_id)
+        if xfer is None or xfer.tree is None:
+            raise Exception('unknown transfer: %s' % (fetch_id,))
+        level = int(level)
+        nodes = []
+        stale = list(xfer.stale)
+        for index in indices:
+            first, end = index << level, (index + 1) << level
+            if any(first <= i < end for i in stale):
+                nodes.append('')
+                continue
+            digest = xfer.tree.node(level, index)
+            if digest is None:
+                digest = 'missing' if xfer.tree.closed else ''
+            nodes.append(digest)
+        return nodes
+
+    def repair_upload(self, fetch_id, chunks):
+        """Prepare to receive chunks of a verified upload again.
+
+        The data connection carries the chunks in the order given.  The
+        upload is confirmed by get_transfer_results() once they have been
+        received.
+
+        """
+        with self._lock:
+            xfer = self._transfers.get(fetch_id)
+        if xfer is None or xfer.tree is None:
+            raise Exception('unknown transfer: %s' % (fetch_id,))
+        xfer.done.wait(ACCEPT_TIMEOUT)
+        xfer.done.clear()
+        chunk_size = xfer.tree.chunk_size
+        xfer.stale.update(chunks)
+
+        def handler(conn):
+            error = None
+            try:
+                for index in chunks:
+                    tree = ChunkTree(chunk_size, xfer.algorithm)
+                    length = min(chunk_size, xfer.size - index * chunk_size)
+                    self._recv_range(conn, xfer.path, index * chunk_size,
+                                     length, tree)
+                    tree.close()
+                    leaves = xfer.tree.leaves
+                    while len(leaves) <= index:
+                        leaves.append('')
+                    leaves[index] = tree.leaves[0]
+                    xfer.stale.discard(index)
+            except Exception as e:
+                error = str(e)
+            xfer.stale.clear()
+            self._finish_upload(xfer, error)
+
+        lsock, port = self._listen()
+        self._serve_once(lsock, handler)
+        return port
+
+    def upload_stream(self, user_name, file_name, hash_algorithm='sha1'):
+        """Prepare to receive a file whose size is not known in advance.
+
+        The size is given to get_transfer_results() when the upload is done.
+
+        """
+        return self.upload(user_name, file_name, '-1', hash_algorithm)
+
+    def delta_signature(self, user_name, base_name, block_size):
+        """Return the block_signature() of a stored file."""
+        path = self._storage_path(user_name, base_name)
+        if not os.path.isfile(path):
+            raise Exception('file not found: ' + base_name)
+        return xmlrpclib.Binary(block_signature(path, int(block_size)))
+
+    def upload_delta(self, user_name, file_name, base_name, block_size,
+                     hash_algorithm='sha1'):
+        """Prepare to receive a file as differences from a stored file.
+
+        The data connection carries copy and literal instructions, from which
+        the file is rebuilt.  The size is given to get_transfer_results().
+
+        """
+        base_path = self._storage_path(user_name, base_name)
+        if not os.path.isfile(base_path):
+            raise Exception('file not found: ' + base_name)
+        tmp_path = os.path.join(self._incoming, uuid.uuid4().hex)
+        fetch_id, xfer = self._new_transfer(tmp_path, -1, hash_algorithm)
+        xfer.dst_path = self._storage_path(user_name, file_name)
+
+        def handler(conn):
+            try:
+                self._recv_delta(conn, base_path, tmp_path, int(block_size))
+            except Exception as e:
+                self._finish_upload(xfer, str(e))
+            else:
+                self._finish_upload(xfer)
+
+        lsock, port = self._listen()
+        self._serve_once(lsock, handler)
+        return fetch_id, port
+
+    def upload_resumable(self, user_name, file_name, file_size):
+        """Prepare to receive a file that can be resumed if interrupted.
+
+        If the data connection closes before the whole file is received, the
+        partial file is kept until resume_upload() is called.
+
+        """
+        tmp_path = os.path.join(self._incoming, uuid.uuid4().hex)
+        open(tmp_path, 'wb').close()
+        fetch_id, xfer = self._new_transfer(tmp_path, long(file_size))
+        xfer.dst_path = self._storage_path(user_name, file_name)
+        xfer.resumable = True
+        return fetch_id, self._listen_resumable(xfer, 0)
+
+    def resume_upload(self, fetch_id):
+        """Continue an interrupted resumable upload.
+
+        Return:
+        [port, offset] where offset is the number of bytes already received,
+        or False if there is no such partial upload.
+
+        """
+        with self._lock:
+            xfer = self._transfers.get(fetch_id)
+        if xfer is None or xfer.done.is_set() or not xfer.resumable:
+            return False
+        offset = os.path.getsize(xfer.path)
+        return [self._listen_resumable(xfer, offset), str(offset)]
+
+    def _listen_resumable(self, xfer, offset):
+        def handler(conn):
+            try:
+                self._recv_range(conn, xfer.path, offset)
+            except Exception:
+                pass
+            if os.path.getsize(xfer.path) >= xfer.size:
+                self._finish_upload(xfer)
+
+        lsock, port = self._listen()
+        self._serve_once(lsock, handler)
+        return port
+
+    def upload_striped(self, user_name, file_name, file_size, stripes,
+                       hash_algorithm='sha1'):
+        """Prepare to receive a file as several byte ranges at once.
+
+        Return:
+        (fetch_id, [[port, offset, length], ...])
+
+        """
+        file_size = long(file_size)
+        stripes = max(1, min(int(stripes), 64))
+        tmp_path = os.path.join(self._incoming, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            f.truncate(file_size)
+        fetch_id, xfer = self._new_transfer(tmp_path, file_size,
+                                            hash_algorithm)
+        xfer.dst_path = self._storage_path(user_name, file_name)
+
+        stripe_size = -(-file_size // stripes)
+        ranges = []
+        offset = 0
+        while offset < file_size:
+            length = min(stripe_size, file_size - offset)
+            ranges.append((offset, length))
+            offset += length
+
+        pending = [len(ranges)]
+        errors = []
+        pending_lock = threading.Lock()
+
+        def handler(conn, offset, length):
+            try:
+                got = self._recv_range(conn, tmp_path, offset, length)
+                if got != length:
+                    errors.append('stripe at %d: received %d of %d bytes'
+                                  % (offset, got, length))
+            except Exception as e:
+                errors.append(str(e))
+            with pending_lock:
+                pending[0] -= 1
+                last = not pending[0]
+            if last:
+                self._finish_upload(xfer, '; '.join(errors) or None)
+
+        stripe_info = []
+        for offset, length in ranges:
+            lsock, port = self._listen()
+            self._serve_once(lsock, handler, offset, length)
+            stripe_info.append([port, str(offset), str(length)])
+        return fetch_id, stripe_info
+
+    def get_transfer_results(self, fetch_id, file_hash, file_size=None):
+        xfer = self._take_transfer(fetch_id)
+        if xfer is None:
+            return [False, 'unknown transfer: %s' % (fetch_id,)]
+        if not xfer.done.is_set():
+            return False
+        if xfer.size < 0 and file_size is not None:
+            xfer.size = long(file_size)
+        if xfer.error:
+            status, msg = False, xfer.error
+        elif xfer.recv_size != xfer.size:
+            status, msg = False, ('size mismatch: expected %d, received %d'
+                                  % (xfer.size, xfer.recv_size))
+        elif xfer.hash != file_hash:
+            status, msg = False, 'hash mismatch'
+        else:
+            dst_dir = os.path.dirname(xfer.dst_path)
+            if not os.path.isdir(dst_dir):
+                os.makedirs(dst_dir)
+            os.rename(xfer.path, xfer.dst_path)
+            return [True, 'received ' + os.path.basename(xfer.dst_path)]
+        os.unlink(xfer.path)
+        return [status, msg]
+
+    def download(self, user_name, file_name, offset='0',
+                 hash_algorithm='sha1'):
+        """Prepare to send a file, starting at offset if resuming."""
+        offset = long(offset)
+        path = self._storage_path(user_name, file_name)
+        if not os.path.isfile(path):
+            return False
+        size = os.path.getsize(path)
+        fetch_id, xfer = self._new_transfer(path, size, hash_algorithm)
+
+        def handler(conn):
+            link = _Link(self._latency, self._window)
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    while True:
+                        data = f.read(CHUNK_SIZE)
+                        if not data:
+                            break
+                        conn.sendall(data)
+                        link.pace(len(data))
+                # End the data before hashing, which takes a while for a
+                # large file.
+                conn.close()
+                xfer.hash = _file_hash(path, xfer.algorithm)
+            except Exception as e:
+                xfer.error = str(e)
+            xfer.done.set()
+
+        lsock, port = self._listen()
+        self._serve_once(lsock, handler)
+        return {'fetch_id': fetch_id, 'server_port': port,
+                'file_size': str(size)}
+
+    def download_striped(self, user_name, file_name, stripes,
+                         hash_algorithm='sha1'):
+        """Prepare to send a file as several byte ranges at once.
+
+        Return:
+        {'fetch_id': id, 'file_size': size,
+         'stripes': [[port, offset, length], ...]}
+
+        """
+        path = self._storage_path(user_name, file_name)
+        if not os.path.isfile(path):
+            return False
+        size = os.path.getsize(path)
+        stripes = max(1, min(int(stripes), 64))
+        fetch_id, xfer = self._new_transfer(path, size, hash_algorithm)
+
+        stripe_size = -(-size // stripes)
+        ranges = []
+        offset = 0
+        while offset < size:
+            length = min(stripe_size, size - offset)
+            ranges.append((offset, length))
+            offset += length
+
+        pending = [len(ranges)]
+        errors = []
+        pending_lock = threading.Lock()
+
+        def handler(conn, offset, length):
+            link = _Link(self._latency, self._window)
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    left = length
+                    while left:
+                        data = f.read(min(CHUNK_SIZE, left))
+                        if not data:
+                            break
+                        conn.sendall(data)
+                        link.pace(len(data))
+                        left -= len(data)
+            except Exception as e:
+                errors.append(str(e))
+            conn.close()
+            with pending_lock:
+                pending[0] -= 1
+                last = not pending[0]
+            if last:
+                xfer.error = '; '.join(errors) or None
+                if not xfer.error:
+                    xfer.hash = _file_hash(path, xfer.algorithm)
+                xfer.done.set()
+
+        if not ranges:
+            xfer.hash = _file_hash(path, xfer.algorithm)
+            xfer.done.set()
+        stripe_info = []
+        for offset, length in ranges:
+            lsock, port = self._listen()
+            self._serve_once(lsock, handler, offset, length)
+            stripe_info.append([port, str(offset), str(length)])
+        return {'fetch_id': fetch_id, 'file_size': str(size),
+                'stripes': stripe_info}
+
+    def transfer_results(self, fetch_id, file_hash, file_size):
+        xfer = self._take_transfer(fetch_id)
+        if xfer is None:
+            return [False, 'unknown transfer: %s' % (fetch_id,)]
+        if not xfer.done.is_set():
+            return False
+        if xfer.error:
+            return [False, xfer.error]
+        if long(file_size) != xfer.size:
+            return [False, 'size mismatch']
+        if file_hash != xfer.hash:
+            return [False, 'hash mismatch']
+        return [True, 'sent ' + os.path.basename(xfer.path)]
+
+
+def serve(root, port=8080, host='127.0.0.1', latency=0.0, window=65536,
+          corrupt=0):
+    """Run the stand-in server until interrupted."""
+    server = ThreadedXMLRPCServer((host, port), logRequests=False,
+                                  allow_none=False)
+    server.register_instance(StandInServer(root, host, latency, window,
+                                           corrupt))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    argv = list(sys.argv)
+    prg = argv.pop(0)
+    usage_msg = 'usage: python %s [options] storage_root' % (prg,)
+
+    port = 8080
+    latency = 0.0
+    window = 65536
+    corrupt = 0
+    while argv and argv[0].startswith('-'):
+        arg = argv.pop(0)
+        if arg == '-p' and argv:
+            port = int(argv.pop(0))
+        elif arg == '-l' and argv:
+            latency = float(argv.pop(0)) / 1000.0
+        elif arg == '-w' and argv:
+            window = int(argv.pop(0))
+        elif arg == '-c' and argv:
+            corrupt = int(argv.pop(0))
+        else:
+            print __doc__
+            sys.exit(0)
+
+    if not argv:
+        print usage_msg
+        sys.exit(1)
+
+    print 'QManager stand-in serving %s on port %d' % (argv[0], port)
+    try:
+        serve(argv[0], port, latency=latency, window=window,
+              corrupt=corrupt)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,342 @@
+"""
+Keep a local directory and a user's QManager storage area in step.
+
+The files in the local directory are compared with the files on the server,
+and only the files that are new or have changed are transferred, several at
+a time.  As with qmupload, only .img, .qcow2 and .iso files, optionally
+compressed, are synced, and other files in the directory are left alone.
+Uploads go through send_file_to_qmanager() and downloads through
+recv_file_from_qmanager(), so they are deduplicated, cached and verified the
+same way.  Files are transferred as they are, without compressing them.
+
+What each file looked like when it was last synced is kept in a SyncManifest
+under SYNC_DIR.  Once a directory has been synced, syncing it again costs one
+list_files() call and a stat() of each local file, and nothing is read or
+hashed unless it changed.
+
+usage: python qmsync.py [options] user_name local_dir [qmanager_server]
+
+Options
+    -d          : download - make local_dir match the server (default is
+                  to upload, making the server match local_dir)
+    -s          : use shared storage area
+    -p pattern  : only sync file names matching the glob pattern
+    -j workers  : number of transfers to run at once (default 4)
+    -r          : remove files that are not on the other side
+    -n          : show what would be done, without doing it
+    -q          : be quiet - do not print output
+
+"""
+from __future__ import with_statement
+
+__author__ = 'Andrew Gillis'
+
+import sys
+import os
+import stat
+import json
+import hashlib
+import fnmatch
+import xmlrpclib
+from multiprocessing.pool import ThreadPool
+
+import qmupload
+from qmupload import (send_file_to_qmanager, recv_file_from_qmanager,
+                      DEFAULT_QM_SERVER, SHARED_PREFIX)
+
+SYNC_DIR = os.path.join(qmupload.STATE_DIR, 'sync')
+SYNC_WORKERS = 4
+
+
+class SyncManifest(object):
+
+    """
+    What the files of a synced directory looked like when last synced.
+
+    There is one manifest for each pair of local directory and server storage
+    area.  An entry maps a file name to the device, inode, size and mtime of
+    the local file once it matched the file on the server.  A local file whose
+    entry still matches has not changed since, and a file on the server that
+    has an entry is taken to be unchanged, as for the UploadManifest.
+
+    """
+
+    def __init__(self, path, entries):
+        self._path = path
+        self.entries = entries
+
+    @classmethod
+    def load(cls, qmserver, user_name, shared, local_dir):
+        key = hashlib.sha1('%s\0%s\0%s\0%s' % (
+            qmserver, user_name, 'shared' if shared else 'private',
+            os.path.abspath(local_dir))).hexdigest()
+        path = os.path.join(SYNC_DIR, key + '.json')
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            entries = {}
+        return cls(path, entries)
+
+    def save(self):
+        if not os.path.isdir(SYNC_DIR):
+            os.makedirs(SYNC_DIR)
+        tmp_path = '%s.%d.tmp' % (self._path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.rename(tmp_path, self._path)
+
+    def record(self, name, identity):
+        self.entries[name] = identity
+
+    def remove(self, name):
+        self.entries.pop(name, None)
+
+    def unchanged(self, name, identity):
+        """Return True if the file has not changed since it was synced."""
+        return self.entries.get(name) == identity
+
+
+def _identity(st):
+    # The parts of a stat result that change when a file is replaced or
+    # written, as a list so that it compares equal after a JSON round trip.
+    return list(qmupload._stat_key(st))
+
+
+def local_files(local_dir, pattern='*'):
+    """Return a dict of the name to the identity of each file to sync.
+
+    Only regular files directly in local_dir are synced, and only those with
+    an extension that qmupload would upload, as checked by _check_file().
+    Hidden files, such as the temporary files of transfers, are left out.
+
+    """
+    files = {}
+    for name in os.listdir(local_dir):
+        if name.startswith('.') or not fnmatch.fnmatch(name, pattern):
+            continue
+        path = os.path.join(local_dir, name)
+        st = os.stat(path)
+        if stat.S_ISREG(st.st_mode) and not qmupload._check_file(path):
+            files[name] = _identity(st)
+    return files
+
+
+def remote_files(qms, user_name, shared, pattern='*'):
+    """Return the set of names of the files in one storage area."""
+    files = set()
+    for name in qms.list_files(user_name):
+        if name.startswith(SHARED_PREFIX) != bool(shared):
+            continue
+        name = name[len(SHARED_PREFIX):] if shared else name
+        if fnmatch.fnmatch(name, pattern):
+            files.add(name)
+    return files
+
+
+def _adopt(qms, capabilities, user_name, shared, local_dir, names, manifest):
+    # Record files that are the same on both sides, though not synced before.
+    if 'file_info' not in capabilities:
+        return
+    prefix = SHARED_PREFIX if shared else ''
+    for name in names:
+        path = os.path.join(local_dir, name)
+        info = qms.file_info(user_name, prefix + name)
+        if not info or long(info['file_size']) != os.path.getsize(path):
+            continue
+        st = os.stat(path)
+        if qmupload._local_digest(path) == info['hash']:
+            manifest.record(name, _identity(st))
+
+
+def sync(user_name, local_dir, shared=False, qmserver=DEFAULT_QM_SERVER,
+         download=False, pattern='*', workers=SYNC_WORKERS, remove=False,
+         dry_run=False, quiet=True):
+    """Sync a local directory with a user's storage area on a QManager server.
+
+    Uploading makes the storage area match the local directory: files that
+    are not on the server, or have changed locally since they were last
+    synced, are uploaded.  Downloading makes the local directory match the
+    storage area: files that are not in the directory, or have changed
+    locally since they were last synced, are downloaded.  A file that is on
+    both sides but was not synced before is transferred, unless the server
+    reports the same size and SHA-1 for it with file_info().
+
+    Arguments:
+    user_name -- User whose storage area to sync with.
+    local_dir -- Local directory to sync.
+    shared    -- Optional.  True to sync with the shared storage area.
+    qmserver  -- Optional.  QManager server DNS name or IP address.
+    download  -- Optional.  True to download, False to upload.
+    pattern   -- Optional.  Only sync file names that match this glob
+                 pattern.
+    workers   -- Optional.  Number of transfers to run at once.  Each one
+                 starts as soon as the previous one on its worker has sent
+                 its data, while the server is still checking it.
+    remove    -- Optional.  Remove files on the destination side that are
+                 not on the source side.
+    dry_run   -- Optional.  Work out what to transfer and remove, but do not
+                 do it.
+    quiet     -- Optional.  Do not print output if True.
+
+    Return:
+    Dict with lists of file names 'transferred', 'removed' and 'unchanged',
+    and 'failed', a dict of file name to error message.  Raises RuntimeError
+    if the server cannot be contacted.
+
+    """
+    qms_url = 'http://%s:8080' % (qmserver,)
+    qms = xmlrpclib.ServerProxy(qms_url)
+    manifest = SyncManifest.load(qmserver, user_name, shared, local_dir)
+    local = local_files(local_dir, pattern)
+    try:
+        remote = remote_files(qms, user_name, shared, pattern)
+        unknown = [name for name in set(local) & remote
+                   if name not in manifest.entries]
+        if unknown:
+            _adopt(qms, qmupload._server_capabilities(qms), user_name,
+                   shared, local_dir, unknown, manifest)
+    except Exception as e:
+        raise RuntimeError('unable to contact QManager (%s): %s' %
+                           (qms_url, e))
+
+    # Forget files that are on neither side.
+    for name in list(manifest.entries):
+        if name not in local and name not in remote and \
+           fnmatch.fnmatch(name, pattern):
+            manifest.remove(name)
+
+    if download:
+        source, dest = remote, local
+    else:
+        source, dest = local, remote
+    transfer = sorted(name for name in source
+                      if name not in dest or name not in local or
+                      not manifest.unchanged(name, local[name]))
+    removes = sorted(set(dest) - set(source)) if remove else []
+    summary = {'transferred': [], 'removed': [], 'failed': {},
+               'unchanged': sorted(set(source) - set(transfer))}
+    if dry_run:
+        summary['transferred'] = transfer
+        summary['removed'] = removes
+        return summary
+
+    def run(name):
+        # Start one transfer.  Return (name, confirmation, identity, error).
+        path = os.path.join(local_dir, name)
+        try:
+            if download:
+                confirmation = recv_file_from_qmanager(
+                    user_name, path, shared, qmserver, wait=False)
+                return name, confirmation, None, None
+            identity = _identity(os.stat(path))
+            confirmation = send_file_to_qmanager(
+                user_name, path, shared, qmserver, wait=False)
+            return name, confirmation, identity, None
+        except Exception as e:
+            return name, None, None, str(e)
+
+    pool = ThreadPool(max(1, min(workers, len(transfer))))
+    try:
+        pending = []
+        for name, confirmation, identity, error in pool.imap_unordered(
+                run, transfer):
+            if error:
+                summary['failed'][name] = error
+            else:
+                pending.append((name, confirmation, identity))
+        for name, confirmation, identity in pending:
+            try:
+                # None if nothing had to be sent.
+                if confirmation is not None:
+                    confirmation.wait()
+            except RuntimeError as e:
+                summary['failed'][name] = str(e)
+                continue
+            if identity is None:
+                identity = _identity(os.stat(os.path.join(local_dir, name)))
+            manifest.record(name, identity)
+            summary['transferred'].append(name)
+            if not quiet:
+                print '%s %s' % ('received' if download else 'sent', name)
+    finally:
+        pool.terminate()
+        manifest.save()
+
+    prefix = SHARED_PREFIX if shared else ''
+    for name in removes:
+        try:
+            if download:
+                os.unlink(os.path.join(local_dir, name))
+            else:
+                qms.delete_file(user_name, prefix + name)
+        except Exception as e:
+            summary['failed'][name] = 'unable to remove: %s' % (e,)
+            continue
+        manifest.remove(name)
+        summary['removed'].append(name)
+        if not quiet:
+            print 'removed', name
+    manifest.save()
+
+    for name, error in sorted(summary['failed'].iteritems()):
+        if not quiet:
+            print >>sys.stderr, 'failed %s: %s' % (name, error)
+    return summary
+
+
+if __name__ == '__main__':
+    argv = list(sys.argv)
+    prg = argv.pop(0)
+    usage_msg = 'usage: python %s [options] user_name local_dir '\
+                '[qmanager_server]' % (prg,)
+
+    download = shared = remove = dry_run = quiet = False
+    pattern = '*'
+    workers = SYNC_WORKERS
+    while argv and argv[0].startswith('-'):
+        arg = argv.pop(0)
+        if arg == '-d':
+            download = True
+        elif arg == '-s':
+            shared = True
+        elif arg == '-p' and argv:
+            pattern = argv.pop(0)
+        elif arg == '-j' and argv:
+            workers = int(argv.pop(0))
+        elif arg == '-r':
+            remove = True
+        elif arg == '-n':
+            dry_run = True
+        elif arg == '-q':
+            quiet = True
+        else:
+            print __doc__
+            sys.exit(0)
+
+    if len(argv) < 2:
+        print usage_msg
+        print "Try 'python", prg, "--help' for more options"
+        sys.exit(1)
+    if not os.path.isdir(argv[1]):
+        print 'directory', argv[1], 'does not exist'
+        sys.exit(1)
+    qmserver = argv[2] if len(argv) >= 3 else DEFAULT_QM_SERVER
+
+    try:
+        summary = sync(argv[0], argv[1], shared, qmserver, download, pattern,
+                       workers, remove, dry_run, quiet)
+    except Exception as ex:
+        print 'ERROR:', ex
+        sys.exit(1)
+    if dry_run:
+        for name in summary['transferred']:
+            print 'would %s %s' % ('receive' if download else 'send', name)
+        for name in summary['removed']:
+            print 'would remove', name
+    if not quiet:
+        print '%d transferred, %d removed, %d unchanged, %d failed' % (
+            len(summary['transferred']), len(summary['removed']),
+            len(summary['unchanged']), len(summary['failed']))
+    if summary['failed']:
+        sys.exit(1)
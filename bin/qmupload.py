@@ -30,6 +30,10 @@ Note: For both the command line script and the function call, the QManager
 server address can be optionally specified.  By default, the Calabasas QManager
 server is used.
 
+To upload a file to several QManager servers at once, reading and compressing
+it only once, call send_file_to_qmanagers, or give the servers separated by
+commas on the command line.
+
 Download:
 
 The upload functionality works using the same parameters as download.  The
@@ -48,13 +52,124 @@ __author__ = "Andrew Gillis"
 
 import socket
 import os
+import stat
+import errno
 import hashlib
+import mmap
+import select
+import threading
 import time
 import sys
 import xmlrpclib
 import glob
-import warnings
+import tempfile
+import shutil
 import gzip
+import json
+import sqlite3
+import struct
+import zlib
+import Queue
+import bz2
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# Preallocation of download files.  Python 3 has os.posix_fallocate(); on
+# Python 2 call it from the C library if it is there.
+try:
+    _fallocate = os.posix_fallocate
+except AttributeError:
+    _fallocate = None
+    try:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.posix_fallocate.argtypes = [ctypes.c_int, ctypes.c_longlong,
+                                          ctypes.c_longlong]
+
+        def _fallocate(fd, offset, length):
+            err = _libc.posix_fallocate(fd, offset, length)
+            if err:
+                raise OSError(err, os.strerror(err))
+    except (ImportError, OSError, TypeError, AttributeError):
+        pass
+
+# Positional writes of download ranges.  _pwrite(fd, buf, length, offset,
+# start=0) writes length bytes of bytearray buf, from index start, at offset,
+# and returns the number of bytes written.  Python 3 has os.pwrite(); on
+# Python 2 call it from the C library if it is there.
+if hasattr(os, 'pwrite'):
+    def _pwrite(fd, buf, length, offset, start=0):
+        return os.pwrite(fd, memoryview(buf)[start:start + length], offset)
+else:
+    _pwrite = None
+    try:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.pwrite.argtypes = [ctypes.c_int, ctypes.c_void_p,
+                                 ctypes.c_size_t, ctypes.c_longlong]
+        _libc.pwrite.restype = ctypes.c_ssize_t
+
+        def _pwrite(fd, buf, length, offset, start=0):
+            data = (ctypes.c_char * length).from_buffer(buf, start)
+            n = _libc.pwrite(fd, data, length, offset)
+            if n < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            return n
+    except (ImportError, OSError, TypeError, AttributeError):
+        pass
+
+# Copy-on-write clones of files, on file systems that support them (btrfs,
+# XFS and others).  Linux only.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+_FICLONE = 0x40049409
+
+# Per-thread CPU time for transfer metrics.  RUSAGE_THREAD is Linux-only, and
+# the resource module is not available on Windows.
+try:
+    import resource
+except ImportError:
+    resource = None
+_RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD',
+                         1 if sys.platform.startswith('linux') else None)
+
+# xz compression.  Python 3 has lzma; on Python 2 use backports.lzma if it is
+# installed.
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Kernel zero-copy file send.  Python 3 has os.sendfile(); on Python 2 use the
+# pysendfile module if it is installed.
+try:
+    _sendfile = os.sendfile
+except AttributeError:
+    try:
+        from sendfile import sendfile as _sendfile
+    except ImportError:
+        _sendfile = None
+
+# Data and holes of sparse files.  Python 2 does not define SEEK_DATA and
+# SEEK_HOLE, so use the Linux values there.
+SEEK_DATA = getattr(os, 'SEEK_DATA',
+                    3 if sys.platform.startswith('linux') else None)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE',
+                    4 if sys.platform.startswith('linux') else None)
+
+# The umask can only be read by setting it, which is not safe once other
+# threads may be creating files, so read it once at import.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
 
 #DEFAULT_QM_SERVER = 'qmanager.cal.ci.spirentcom.com'
 DEFAULT_QM_SERVER = 'qmanager.rtp.ci.spirentcom.com'
@@ -62,6 +177,139 @@ DEFAULT_QM_SERVER = 'qmanager.rtp.ci.spirentcom.com'
 CHUNK_SIZE = 16383
 SHARED_PREFIX = 'shared/'
 
+# Read the holes of sparse files as zeros from memory instead of from disk.
+SPARSE_READS = True
+
+# Leave holes in downloaded files for blocks of SPARSE_BLOCK_SIZE zero bytes,
+# aligned on the file offset, instead of writing them.  Off by default, so that
+# an uncompressed download has its full size preallocated instead: the disk
+# space is reserved before anything is received, so the download cannot run
+# out of space part way through, and the file is laid out in few extents.
+# Sparse writes save the writes and space of the zeros of a mostly empty
+# image, but the space is only taken when the image is written to later, and
+# may not be there then.
+SPARSE_WRITES = False
+SPARSE_BLOCK_SIZE = 4096
+_ZERO_BLOCK = '\0' * SPARSE_BLOCK_SIZE
+
+# Transfer tuning.  Unless given as arguments or in the environment variables
+# QMUPLOAD_CHUNK_SIZE, QMUPLOAD_SOCKET_BUFFER and QMUPLOAD_BANDWIDTH (Mbit/s),
+# the read/recv chunk size and socket buffer sizes are chosen from the measured
+# round-trip time to the server and the throughput of the last transfer to it.
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+MIN_SOCKET_BUFFER = 64 * 1024
+MAX_SOCKET_BUFFER = 16 * 1024 * 1024
+DEFAULT_BANDWIDTH = 1000
+
+# Bandwidth limits.  The burst allowance defaults to this many seconds of data
+# at the limited rate, and a throttled transfer checks the limit again at
+# least this often, so that a changed limit takes effect quickly.
+RATE_LIMIT_BURST = 0.25
+RATE_LIMIT_RECHECK = 0.1
+
+# Hash algorithms for verifying transfers, in order of preference.  SHA-1 is
+# used unless the server advertises others as 'hash:<name>' capabilities.
+HASH_ALGORITHMS = ('blake2b', 'sha256', 'sha1')
+
+# Buffers in flight between a transfer and its HashWorker.
+HASH_BUFFERS = 4
+
+# Number of chunks buffered between stages of a streaming upload.
+PIPELINE_DEPTH = 64
+
+# Parallel gzip compression.
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+try:
+    COMPRESS_WORKERS = multiprocessing.cpu_count()
+except NotImplementedError:
+    COMPRESS_WORKERS = 1
+
+# Compression codecs, their file extensions and default levels.
+CODEC_EXTENSIONS = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz'}
+CODEC_LEVELS = {'gzip': 9, 'bz2': 9, 'xz': 6}
+
+# Codec and level candidates for automatic selection, and the samples of the
+# file used to estimate how well and how fast each one compresses.  Only gzip
+# is compressed on several threads.
+AUTO_CODECS = (('none', 0), ('gzip', 1), ('gzip', 6), ('gzip', 9),
+               ('bz2', 9), ('xz', 6))
+AUTO_SAMPLE_BLOCKS = 8
+AUTO_SAMPLE_SIZE = 256 * 1024
+
+# Local state kept between runs.
+STATE_DIR = os.path.join(os.path.expanduser('~'), '.qmupload')
+
+# Checkpoint journals for resumable transfers.
+JOURNAL_DIR = os.path.join(STATE_DIR, 'journal')
+JOURNAL_BLOCK_SIZE = 64 * 1024 * 1024
+
+# Cache of SHA-1 digests of local files.
+DIGEST_CACHE_PATH = os.path.join(STATE_DIR, 'digests.db')
+DIGEST_CACHE_ENTRIES = 10000
+
+# Cache of downloaded files, keyed on the server, file name, and the hash and
+# size the server reports, limited to DOWNLOAD_CACHE_SIZE bytes.  Files are
+# only added as reflinks, so that the cache does not make a second copy of
+# each download on file systems without them.
+DOWNLOAD_CACHE_DIR = os.path.join(STATE_DIR, 'downloads')
+DOWNLOAD_CACHE_SIZE = 20 * 1024 * 1024 * 1024
+
+# Cache of files made by compress(), keyed on the identity of the source file
+# and the codec and level, limited to COMPRESS_CACHE_SIZE bytes.
+COMPRESS_CACHE_DIR = os.path.join(STATE_DIR, 'compressed')
+COMPRESS_CACHE_SIZE = 20 * 1024 * 1024 * 1024
+
+# Delta upload against a file already on the server.  The new file is matched
+# against whole blocks of the base file by a rolling Adler-32 checksum and a
+# SHA-1 digest, and sent as instructions to copy runs of base blocks and to
+# insert literal data.  Each instruction is one byte, DELTA_COPY followed by
+# the first block index and the block count, or DELTA_LITERAL followed by the
+# length and the data, with the numbers as 32-bit big-endian integers.  The
+# block size is the smallest power of two, from DELTA_MIN_BLOCK_SIZE to
+# DELTA_MAX_BLOCK_SIZE, that splits the file into at most DELTA_MAX_BLOCKS,
+# so that the signature stays small for large files.
+DELTA_MIN_BLOCK_SIZE = 8 * 1024
+DELTA_MAX_BLOCK_SIZE = 1024 * 1024
+DELTA_MAX_BLOCKS = 256 * 1024
+DELTA_MAX_LITERAL = 1024 * 1024
+DELTA_COPY = 'C'
+DELTA_LITERAL = 'L'
+_SIGNATURE = struct.Struct('>I20s')
+
+# Uploads verified chunk by chunk are hashed as a ChunkTree of
+# VERIFY_CHUNK_SIZE chunks on both sides.  While the file is sent, each
+# subtree of VERIFY_BATCH chunks (a power of two) is compared with the
+# server's about every VERIFY_INTERVAL seconds.  Chunks the server received
+# wrong are sent again, up to VERIFY_RETRIES times.
+VERIFY_CHUNK_SIZE = 4 * 1024 * 1024
+VERIFY_BATCH = 16
+VERIFY_INTERVAL = 1.0
+VERIFY_RETRIES = 3
+
+# Log of automatic codec choices, with predicted and actual outcomes.
+CODEC_LOG_PATH = os.path.join(STATE_DIR, 'codec.jsonl')
+
+# Manifests of files known to be on each server, for each user.
+MANIFEST_DIR = os.path.join(STATE_DIR, 'manifests')
+
+# Polling for the server to confirm a finished transfer.  The interval starts
+# short and doubles up to the maximum, until the timeout.
+CONFIRM_FIRST_INTERVAL = 0.05
+CONFIRM_MAX_INTERVAL = 3.0
+CONFIRM_TIMEOUT = 3600
+
+# Seconds between samples of instantaneous throughput in TransferMetrics.
+THROUGHPUT_INTERVAL = 1.0
+
+# Totals for uploads that were done with a server-side copy instead of sending
+# the file, since this module was loaded.
+dedupe_stats = {'files': 0, 'bytes_saved': 0}
+
+# Totals for downloads looked up in the download cache since this module was
+# loaded.
+download_cache_stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0}
+
 class ProgressBar(object):
 
     """
@@ -190,14 +438,1046 @@ class ProgressBar(object):
         return self._total_size / self._total_blocks
 
 
+def _cpu_time():
+    """Return CPU seconds used by the calling thread, or by the whole process
+    where per-thread times are not available."""
+    if _RUSAGE_THREAD is not None:
+        try:
+            ru = resource.getrusage(_RUSAGE_THREAD)
+            return ru.ru_utime + ru.ru_stime
+        except (ValueError, resource.error):
+            pass
+    t = os.times()
+    return t[0] + t[1]
+
+
+class _Phase(object):
+    # Context manager that adds its elapsed wall and CPU time to a phase.
+
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._wall = time.time()
+        self._cpu = _cpu_time()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._metrics.add(self._name, time.time() - self._wall,
+                          _cpu_time() - self._cpu)
+
+
+class TransferMetrics(object):
+
+    """
+    Wall and CPU time of each phase of a transfer, byte counts and throughput.
+
+    The phases are compress or delta, hash, dedupe, connect, send or recv,
+    decompress, verify, and confirm.
+    The time of a phase adds up each time it is entered, and phases may
+    overlap: hashing done while sending is also part of the send time, and a
+    streamed compression runs while the data is sent.  CPU time is that of the
+    thread doing the work where the OS reports per-thread times (Linux), and
+    of the whole process otherwise.
+
+    When the transfer has finished, or failed, the record is complete and is
+    passed to callback(record).  The record is a dict that to_json() writes
+    as one line of JSON:
+
+    direction    -- 'upload' or 'download'.
+    file         -- Name of file on server.
+    path         -- Local path of file.
+    server, user -- QManager server and user name.
+    status       -- 'ok' or 'error'.  If 'error', error is the message.
+    start_time   -- Unix time the transfer started.
+    elapsed      -- Seconds from start to finish.
+    phases       -- Dict of phase name to {'wall': seconds, 'cpu': seconds}.
+    bytes_in     -- Bytes read: the local file for an upload, or the network
+                    for a download.
+    bytes_out    -- Bytes written: the network for an upload, or the local
+                    file for a download.
+    compression_ratio -- Size of file before / after compression, when the
+                    file was compressed to upload it or decompressed as it
+                    was downloaded.  Otherwise None.
+    throughput   -- Network bytes per second: 'average' over the send or recv
+                    phase, 'peak' of the samples, and 'samples' as a list of
+                    [seconds since start, bytes/s] taken about every
+                    THROUGHPUT_INTERVAL seconds.
+    deduplicated -- Bytes not sent because the server already had the data.
+    hash_algorithm -- Algorithm the transfer was verified with.
+    codec        -- For an upload with codec 'auto', the choose_codec()
+                    decision with the 'actual' outcome.  Otherwise None.
+    delta        -- For a delta upload, the 'base' file name and the 'size',
+                    'copied' and 'literal' bytes of the file.  Otherwise None.
+    resent       -- Bytes sent again because the server received their chunks
+                    wrong.
+    cached       -- For a download, bytes not received because the file was
+                    in the download cache.
+
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.record = {
+            'direction': None, 'file': None, 'path': None, 'server': None,
+            'user': None, 'status': None, 'start_time': time.time(),
+            'elapsed': None, 'phases': {}, 'bytes_in': 0, 'bytes_out': 0,
+            'compression_ratio': None, 'throughput': None,
+            'deduplicated': 0, 'hash_algorithm': None, 'codec': None,
+            'delta': None, 'resent': 0, 'cached': 0}
+        self._lock = threading.Lock()
+        self._finished = False
+        self._net_bytes = 0
+        self._samples = []
+        self._sample_time = None
+        self._sample_bytes = 0
+
+    def phase(self, name):
+        """Return a context manager that times the named phase."""
+        return _Phase(self, name)
+
+    def add(self, name, wall, cpu=0.0):
+        """Add wall and CPU seconds to the named phase."""
+        with self._lock:
+            times = self.record['phases'].setdefault(name,
+                                                     {'wall': 0.0, 'cpu': 0.0})
+            times['wall'] += wall
+            times['cpu'] += cpu
+
+    def network(self, nbytes):
+        """Count bytes sent or received on the network."""
+        now = time.time()
+        with self._lock:
+            self._net_bytes += nbytes
+            if self._sample_time is None:
+                self._sample_time = now
+                self._sample_bytes = self._net_bytes - nbytes
+            elif now - self._sample_time >= THROUGHPUT_INTERVAL:
+                rate = (self._net_bytes - self._sample_bytes) / \
+                       (now - self._sample_time)
+                self._samples.append(
+                    [round(now - self.record['start_time'], 3), rate])
+                self._sample_time = now
+                self._sample_bytes = self._net_bytes
+
+    def finish(self, error=None):
+        """Complete the record and pass it to the callback.
+
+        Only the first call has any effect.
+
+        """
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+            record = self.record
+            record['status'] = 'error' if error else 'ok'
+            if error:
+                record['error'] = str(error)
+            record['elapsed'] = time.time() - record['start_time']
+            if record['direction'] == 'download':
+                record['bytes_in'] = self._net_bytes
+            else:
+                record['bytes_out'] = self._net_bytes
+            xfer = record['phases'].get('send') or \
+                   record['phases'].get('recv')
+            average = None
+            if xfer and xfer['wall']:
+                average = self._net_bytes / xfer['wall']
+            record['throughput'] = {
+                'average': average,
+                'peak': max([r for _, r in self._samples] or [average]),
+                'samples': self._samples}
+        if self.callback is not None:
+            self.callback(record)
+
+    def to_json(self):
+        return json.dumps(self.record, sort_keys=True)
+
+
+class TransferJournal(object):
+
+    """
+    On-disk checkpoint of a resumable upload or download.
+
+    The journal records the identity of the file being transferred, the
+    server's fetch_id for the transfer, the number of bytes confirmed, and the
+    SHA-1 of every complete block of JOURNAL_BLOCK_SIZE bytes.  A hash object's
+    state cannot be saved, so when a transfer is resumed the data already
+    transferred is hashed again locally.  The block hashes are compared as
+    this is done, to find the last offset at which the data is still good.
+
+    """
+
+    def __init__(self, path, record):
+        self._path = path
+        self.record = record
+        self._block_hash = hashlib.sha1()
+        self._block_fill = 0
+        self._block_index = 0
+        self.mismatch = None
+
+    @staticmethod
+    def _journal_path(direction, qmserver, user_name, file_name, local_path):
+        key = '\0'.join((direction, qmserver, user_name, file_name,
+                         os.path.abspath(local_path)))
+        return os.path.join(JOURNAL_DIR, hashlib.sha1(key).hexdigest())
+
+    @classmethod
+    def load(cls, direction, qmserver, user_name, file_name, local_path):
+        """Return the journal for a transfer, or None if there is none."""
+        path = cls._journal_path(direction, qmserver, user_name, file_name,
+                                 local_path)
+        try:
+            with open(path) as f:
+                record = json.load(f)
+        except (IOError, ValueError):
+            return None
+        return cls(path, record)
+
+    @classmethod
+    def create(cls, direction, qmserver, user_name, file_name, local_path,
+               fetch_id, identity):
+        """Create and save a new journal, replacing any existing one."""
+        path = cls._journal_path(direction, qmserver, user_name, file_name,
+                                 local_path)
+        record = {'direction': direction,
+                  'server': qmserver,
+                  'user_name': user_name,
+                  'file_name': file_name,
+                  'local_path': os.path.abspath(local_path),
+                  'identity': identity,
+                  'fetch_id': fetch_id,
+                  'offset': 0,
+                  'block_size': JOURNAL_BLOCK_SIZE,
+                  'block_hashes': []}
+        journal = cls(path, record)
+        journal.save()
+        return journal
+
+    @property
+    def offset(self):
+        """Number of bytes confirmed, always on a block boundary."""
+        return self.record['offset']
+
+    def save(self):
+        if not os.path.isdir(JOURNAL_DIR):
+            os.makedirs(JOURNAL_DIR)
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.record, f)
+        os.rename(tmp_path, self._path)
+
+    def remove(self):
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
+
+    def truncate(self, offset):
+        """Forget everything after the block containing offset."""
+        block_size = self.record['block_size']
+        nblocks = offset // block_size
+        del self.record['block_hashes'][nblocks:]
+        self.record['offset'] = nblocks * block_size
+        self.save()
+
+    def update(self, data):
+        """Account for data transferred after what has already been seen.
+
+        Each time a block is completed, its hash is compared with the hash
+        recorded for that block, or recorded if there is none.  The journal
+        is saved after each new block.  If a block does not match, the offset
+        of that block is stored in the mismatch attribute.
+
+        """
+        block_size = self.record['block_size']
+        hashes = self.record['block_hashes']
+        view = memoryview(data)
+        pos = 0
+        while pos < len(view):
+            take = min(len(view) - pos, block_size - self._block_fill)
+            self._block_hash.update(view[pos:pos + take])
+            self._block_fill += take
+            pos += take
+            if self._block_fill < block_size:
+                break
+            digest = self._block_hash.hexdigest()
+            if self._block_index < len(hashes):
+                if hashes[self._block_index] != digest:
+                    if self.mismatch is None:
+                        self.mismatch = self._block_index * block_size
+            else:
+                hashes.append(digest)
+                self.record['offset'] = len(hashes) * block_size
+                self.save()
+            self._block_index += 1
+            self._block_hash = hashlib.sha1()
+            self._block_fill = 0
+
+    def resume(self, f, end):
+        """Hash the first end bytes of file f to find where to resume.
+
+        The data is checked against the journal's block hashes.  If a block
+        does not match, the journal is truncated to that block and the data
+        before it is hashed again.
+
+        Return:
+        (offset, hash) where offset is how much of the file is good, and hash
+        is a SHA-1 object that has been updated with the data up to offset.
+        The file is left positioned at offset.
+
+        """
+        buff = bytearray(CHUNK_SIZE)
+        view = memoryview(buff)
+        while True:
+            self._block_hash = hashlib.sha1()
+            self._block_fill = self._block_index = 0
+            self.mismatch = None
+            h = hashlib.sha1()
+            f.seek(0)
+            pos = 0
+            while pos < end and self.mismatch is None:
+                n = f.readinto(view[:min(CHUNK_SIZE, end - pos)])
+                if not n:
+                    break
+                h.update(view[:n])
+                self.update(view[:n])
+                pos += n
+            if self.mismatch is None:
+                return pos, h
+            end = self.mismatch
+            self.truncate(end)
+
+
+def _stat_key(st):
+    """Return (dev, ino, size, mtime_ns) of an os.stat() result."""
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(st.st_mtime * 1e9))
+    return st.st_dev, st.st_ino, st.st_size, mtime_ns
+
+
+class DigestCache(object):
+
+    """
+    Persistent cache of the SHA-1 digests of local files.
+
+    Entries are keyed on the device, inode, size and modification time (in
+    nanoseconds) of a file, and stored in a small SQLite database.  If any of
+    these change, the cached digest is not used.  There is one entry per
+    device and inode, and when there are more than max_entries, the least
+    recently used entries are removed.
+
+    A file modified again within the same mtime tick would keep the same key,
+    so the digest of a file modified within the last two seconds is not
+    stored.
+
+    """
+
+    def __init__(self, path=DIGEST_CACHE_PATH,
+                 max_entries=DIGEST_CACHE_ENTRIES):
+        self._max_entries = max_entries
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._db = sqlite3.connect(path, timeout=10,
+                                   check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS digests ('
+                'dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, '
+                'digest TEXT, last_used REAL, PRIMARY KEY (dev, ino))')
+            self._db.execute('CREATE INDEX IF NOT EXISTS digests_last_used '
+                             'ON digests (last_used)')
+
+    @staticmethod
+    def _key(st):
+        return _stat_key(st)
+
+    def lookup(self, path, st=None):
+        """Return the cached digest of a file, or None if not cached."""
+        if st is None:
+            st = os.stat(path)
+        key = self._key(st)
+        with self._lock:
+            with self._db:
+                row = self._db.execute(
+                    'SELECT digest FROM digests WHERE dev=? AND ino=? AND '
+                    'size=? AND mtime_ns=?', key).fetchone()
+                if row is None:
+                    return None
+                self._db.execute(
+                    'UPDATE digests SET last_used=? WHERE dev=? AND ino=?',
+                    (time.time(), key[0], key[1]))
+        return str(row[0])
+
+    def store(self, path, digest, st=None):
+        """Store the digest of a file.
 
-def _make_connection(host, port, timeout):
+        Arguments:
+        path   -- Path of file.
+        digest -- Hex digest of file.
+        st     -- Optional.  Result of os.stat() taken before the file was
+                  hashed.  If the file has changed since then, the digest is
+                  not stored.
+
+        """
+        current = os.stat(path)
+        if st is None:
+            st = current
+        key = self._key(st)
+        if key != self._key(current) or time.time() - st.st_mtime < 2:
+            return
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?)',
+                    key + (digest, time.time()))
+                count = self._db.execute(
+                    'SELECT COUNT(*) FROM digests').fetchone()[0]
+                if count > self._max_entries:
+                    self._db.execute(
+                        'DELETE FROM digests WHERE rowid IN (SELECT rowid '
+                        'FROM digests ORDER BY last_used LIMIT ?)',
+                        (count - self._max_entries,))
+
+    def digest(self, path):
+        """Return the digest of a file, hashing it only if not cached."""
+        st = os.stat(path)
+        digest = self.lookup(path, st)
+        if digest is None:
+            with open(path, 'rb') as f:
+                digest = _file_digest(f, st.st_size)
+            self.store(path, digest, st)
+        return digest
+
+
+_digest_cache = []
+
+def _get_digest_cache():
+    """Return the shared DigestCache, or None if it cannot be opened."""
+    if not _digest_cache:
+        try:
+            _digest_cache.append(DigestCache())
+        except (OSError, sqlite3.Error):
+            _digest_cache.append(None)
+    return _digest_cache[0]
+
+
+def _local_digest(path):
+    """Return the SHA-1 hex digest of a file, using the DigestCache."""
+    cache = _get_digest_cache()
+    if cache is not None:
+        return cache.digest(path)
+    with open(path, 'rb') as f:
+        return _file_digest(f, os.fstat(f.fileno()).st_size)
+
+
+def _reflink(src_path, dst_path):
+    """Make dst_path a copy-on-write clone of src_path.  Return True if
+    done, or False if the file system does not support it."""
+    if fcntl is None:
+        return False
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        except (IOError, OSError):
+            return False
+    return True
+
+
+def _copy_file(src_path, dst_path):
+    """Copy the data of src_path to dst_path, keeping the holes of a sparse
+    file as holes instead of writing them out as zeros."""
+    with open(src_path, 'rb') as f_in, open(dst_path, 'wb') as f_out:
+        fd = f_in.fileno()
+        if not _is_sparse(fd):
+            shutil.copyfileobj(f_in, f_out, MAX_CHUNK_SIZE)
+            return
+        size = os.fstat(fd).st_size
+        pos = 0
+        while pos < size:
+            end, hole = _extent_at(fd, pos, size)
+            if not hole:
+                f_in.seek(pos)
+                f_out.seek(pos)
+                while pos < end:
+                    data = f_in.read(min(end - pos, MAX_CHUNK_SIZE))
+                    if not data:
+                        break
+                    f_out.write(data)
+                    pos += len(data)
+            pos = end
+        f_out.truncate(size)
+
+
+def _place_file(src_path, dst_path, mode=None, copy=True):
+    """Make dst_path a copy of src_path, as cheaply as possible.
+
+    The copy is a reflink if the file system supports it, and otherwise a
+    copy of the data, with the holes of a sparse file left as holes.  Either
+    way it is a file of its own, so that writing to one does not change the
+    other.  dst_path is replaced atomically, except on Windows.
+
+    Arguments:
+    mode -- Optional.  Permissions to give dst_path.  Default is as for
+            _new_file_mode().
+    copy -- Optional.  False to leave dst_path alone if it cannot be made a
+            reflink.
+
+    Return:
+    'reflink' or 'copy', or None if not copied.
+
+    """
+    if mode is None:
+        mode = _new_file_mode(dst_path)
+    fd, tmp_path = tempfile.mkstemp(
+        prefix='.%s.' % (os.path.basename(dst_path),), suffix='.part',
+        dir=os.path.dirname(dst_path) or '.')
+    os.close(fd)
+    try:
+        if _reflink(src_path, tmp_path):
+            method = 'reflink'
+        elif copy:
+            _copy_file(src_path, tmp_path)
+            method = 'copy'
+        else:
+            os.unlink(tmp_path)
+            return None
+        os.chmod(tmp_path, mode)
+        if os.name == 'nt' and os.path.isfile(dst_path):
+            os.unlink(dst_path)
+        os.rename(tmp_path, dst_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return method
+
+
+class FileCache(object):
+
+    """
+    Directory of cached files, limited in total size, with LRU eviction.
+
+    Each file is stored under a key, and a small SQLite database in the
+    directory holds the size, identity (as for DigestCache) and last use of
+    each file.  A file that has changed since it was stored, through a hard
+    link for example, is dropped when it is next looked up.  When the files
+    add up to more than max_size bytes, the least recently used are removed.
+
+    Files are added and given out with _place_file(), so that they share
+    their data with the files they came from and went to where the file
+    system supports reflinks.  The files in the cache are read-only, and the
+    files given out get the usual permissions of a new file.  If copy is
+    False, a file is only added if it can be reflinked, so that the cache
+    uses no disk space of its own until the file it came from is changed.
+
+    """
+
+    def __init__(self, path, max_size, copy=True):
+        self._dir = path
+        self._max_size = max_size
+        self._copy = copy
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._db = sqlite3.connect(os.path.join(path, 'index.db'),
+                                   timeout=10, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'key TEXT PRIMARY KEY, size INTEGER, dev INTEGER, '
+                'ino INTEGER, mtime_ns INTEGER, last_used REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS files_last_used '
+                             'ON files (last_used)')
+
+    def _path(self, key):
+        return os.path.join(self._dir, hashlib.sha1(key).hexdigest())
+
+    def _remove(self, key):
+        # Caller holds the lock.
+        self._db.execute('DELETE FROM files WHERE key=?', (key,))
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+    def lookup(self, key):
+        """Return the path of the cached file, or None if not cached."""
+        path = self._path(key)
+        with self._lock:
+            with self._db:
+                row = self._db.execute(
+                    'SELECT size, dev, ino, mtime_ns FROM files WHERE key=?',
+                    (key,)).fetchone()
+                if row is None:
+                    return None
+                try:
+                    current = _stat_key(os.stat(path))
+                except OSError:
+                    current = None
+                if current != (row[1], row[2], row[0], row[3]):
+                    self._remove(key)
+                    return None
+                self._db.execute('UPDATE files SET last_used=? WHERE key=?',
+                                 (time.time(), key))
+        return path
+
+    def place(self, key, dst_path):
+        """Copy the cached file to dst_path with _place_file().
+
+        Return:
+        'reflink' or 'copy', or None if not cached.
+
+        """
+        path = self.lookup(key)
+        if path is None:
+            return None
+        return _place_file(path, dst_path)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def store(self, key, src_path):
+        """Add a copy of src_path to the cache, and remove the least
+        recently used files if over the size limit.  Return the path of the
+        cached file, or None if the file is larger than the limit, or
+        cannot be reflinked when the cache does not copy."""
+        size = os.path.getsize(src_path)
+        if size > self._max_size:
+            return None
+        path = self._path(key)
+        if not _place_file(src_path, path, 0444, self._copy):
+            return None
+        st = os.stat(path)
+        dev, ino, size, mtime_ns = _stat_key(st)
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, size, dev, ino, mtime_ns, time.time()))
+                total = self._db.execute(
+                    'SELECT SUM(size) FROM files').fetchone()[0]
+                rows = self._db.execute(
+                    'SELECT key, size FROM files WHERE key!=? '
+                    'ORDER BY last_used', (key,)).fetchall()
+                for old_key, old_size in rows:
+                    if total <= self._max_size:
+                        break
+                    self._remove(old_key)
+                    total -= old_size
+        return path
+
+    def remove(self, key):
+        with self._lock:
+            with self._db:
+                self._remove(key)
+
+
+_download_cache = []
+
+def _get_download_cache():
+    """Return the shared download FileCache, or None if it cannot be
+    opened."""
+    if not _download_cache:
+        try:
+            _download_cache.append(FileCache(DOWNLOAD_CACHE_DIR,
+                                             DOWNLOAD_CACHE_SIZE, copy=False))
+        except (OSError, sqlite3.Error):
+            _download_cache.append(None)
+    return _download_cache[0]
+
+
+def _download_cache_key(qmserver, file_name, algorithm, digest, size):
+    # The same file under another name or on another server is cached again,
+    # which costs nothing more since the cache only holds reflinks.
+    return '%s\0%s\0%s:%s:%d' % (qmserver, file_name, algorithm, digest, size)
+
+
+_compress_cache = []
+
+def _get_compress_cache():
+    """Return the shared FileCache of compressed files, or None if it cannot
+    be opened."""
+    if not _compress_cache:
+        try:
+            _compress_cache.append(FileCache(COMPRESS_CACHE_DIR,
+                                             COMPRESS_CACHE_SIZE))
+        except (OSError, sqlite3.Error):
+            _compress_cache.append(None)
+    return _compress_cache[0]
+
+
+class UploadManifest(object):
+
+    """
+    Record of files that a server holds for a user, and their contents.
+
+    Each successful upload or download adds an entry with the file's size and
+    SHA-1.  Uploads that compressed the file while sending also record the
+    size and SHA-1 of the uncompressed source, so that the same source can be
+    recognized without compressing it again.
+
+    The manifest only knows about transfers made from this machine.  It is
+    assumed that a file on the server is not replaced with different content
+    under the same name by someone else.
+
+    """
+
+    def __init__(self, path, entries):
+        self._path = path
+        self.entries = entries
+
+    @classmethod
+    def load(cls, qmserver, user_name):
+        key = hashlib.sha1('%s\0%s' % (qmserver, user_name)).hexdigest()
+        path = os.path.join(MANIFEST_DIR, key + '.json')
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            entries = {}
+        return cls(path, entries)
+
+    def save(self):
+        if not os.path.isdir(MANIFEST_DIR):
+            os.makedirs(MANIFEST_DIR)
+        tmp_path = '%s.%d.tmp' % (self._path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.rename(tmp_path, self._path)
+
+    def record(self, file_name, size, digest, source_size=None,
+               source_hash=None):
+        entry = {'size': long(size), 'hash': digest}
+        if source_hash:
+            entry['source_size'] = long(source_size)
+            entry['source_hash'] = source_hash
+        self.entries[file_name] = entry
+
+    def remove(self, file_name):
+        self.entries.pop(file_name, None)
+
+    def find(self, key, value):
+        """Return names of files whose entry has the given key and value."""
+        return [name for name, entry in self.entries.iteritems()
+                if entry.get(key) == value]
+
+
+_manifest_lock = threading.Lock()
+
+
+def _record_transfer(qmserver, user_name, file_name, size, digest,
+                     source_size=None, source_hash=None):
+    # Add a file to the manifest.  Transfers may be confirmed concurrently.
+    with _manifest_lock:
+        manifest = UploadManifest.load(qmserver, user_name)
+        manifest.record(file_name, size, digest, source_size, source_hash)
+        manifest.save()
+
+
+def _storage_area(file_name):
+    return 'shared' if file_name.startswith(SHARED_PREFIX) else 'private'
+
+
+def _place_duplicate(qms, capabilities, qmserver, user_name, file_path,
+                     file_name, by_source=False, known_digest=None):
+    """Put content already on the server at file_name, without uploading it.
+
+    Files with the same content are found in the UploadManifest, or by asking
+    the server with find_file() if it has that capability.  A match in the
+    other storage area is copied with copy_file(), and renamed with
+    rename_file() if its name is different.  Matches in the same storage area
+    under a different name are not used, since copy_file() only copies
+    between storage areas.
+
+    Arguments:
+    by_source    -- True if file_path is uploaded compressed, and is matched
+                    by the recorded size and hash of the uncompressed source.
+    known_digest -- Optional.  SHA-1 of file_path, if already known.
+
+    Return:
+    (bytes_saved, digest) where bytes_saved is None if the content was not
+    found, and digest is the file's SHA-1 if it had to be computed.
+
+    """
+    with _manifest_lock:
+        manifest = UploadManifest.load(qmserver, user_name)
+    size = os.path.getsize(file_path)
+    size_key, hash_key = ('source_size', 'source_hash') if by_source else \
+                         ('size', 'hash')
+    names = manifest.find(size_key, size)
+    probe = not by_source and 'find_file' in capabilities
+    if not names and not probe:
+        return None, known_digest
+
+    # Only hash the file when something on the server could match it.
+    digest = known_digest or _local_digest(file_path)
+    names = [name for name in names
+             if manifest.entries[name].get(hash_key) == digest]
+
+    # The server is asked without holding the manifest lock, so that a slow
+    # server does not hold up transfers to others.  The changes are made to
+    # the manifest as it is when saved, since transfers may have been
+    # confirmed meanwhile.
+    found = []
+    stale = []
+    saved = entry = None
+    if probe:
+        for name in qms.find_file(user_name, digest, str(size)):
+            if name not in names:
+                names.append(name)
+            if name not in manifest.entries:
+                manifest.record(name, size, digest)
+                found.append(name)
+    if names:
+        server_files = set(qms.list_files(user_name))
+    for src_name in names:
+        if src_name not in server_files:
+            stale.append(src_name)
+            continue
+        if src_name != file_name:
+            if _storage_area(src_name) == _storage_area(file_name):
+                continue
+            copy_name = os.path.basename(src_name)
+            if _storage_area(file_name) == 'shared':
+                copy_name = SHARED_PREFIX + copy_name
+            if copy_name != file_name and copy_name in server_files:
+                # Copy would replace an unrelated file.
+                continue
+            copy_name = qms.copy_file(user_name, src_name)
+            if copy_name != file_name:
+                qms.rename_file(user_name, copy_name, file_name)
+        entry = manifest.entries[src_name]
+        saved = entry['size']
+        break
+
+    if found or stale or saved is not None:
+        with _manifest_lock:
+            manifest = UploadManifest.load(qmserver, user_name)
+            for name in found:
+                if name not in manifest.entries:
+                    manifest.record(name, size, digest)
+            for name in stale:
+                manifest.remove(name)
+            if saved is not None:
+                manifest.entries[file_name] = dict(entry)
+            manifest.save()
+    if saved is not None:
+        dedupe_stats['files'] += 1
+        dedupe_stats['bytes_saved'] += saved
+    return saved, digest
+
+
+def _file_identity(path):
+    """Return a dict identifying the current contents of a local file."""
+    st = os.stat(path)
+    return {'dev': st.st_dev, 'inode': st.st_ino, 'size': st.st_size,
+            'mtime': st.st_mtime}
+
+
+# Throughput in bytes per second of the last transfer to each server.
+_link_throughput = {}
+
+
+def measure_rtt(host, port=8080, samples=3):
+    """Return the round-trip time to a server in seconds.
+
+    This is the shortest time taken to open a TCP connection to the server,
+    which takes one round trip.
+
+    """
+    addr = (socket.gethostbyname(host), int(port))
+    best = None
+    for _ in range(samples):
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.settimeout(5)
+        try:
+            start = time.time()
+            conn.connect(addr)
+            elapsed = time.time() - start
+        except socket.error:
+            continue
+        finally:
+            conn.close()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _power_of_two(n, low, high):
+    # Smallest power of two >= n, limited to [low, high].
+    size = low
+    while size < n and size < high:
+        size *= 2
+    return min(size, high)
+
+
+def _link_bandwidth(host, bandwidth=None):
+    """Return the expected bandwidth, in bytes per second, of the link to host.
+
+    Arguments:
+    host      -- Server to transfer with.
+    bandwidth -- Optional.  Link bandwidth in Mbit/s.  Default is the value
+                 of QMUPLOAD_BANDWIDTH, or the throughput of the last
+                 transfer with host, or DEFAULT_BANDWIDTH.
+
+    """
+    bandwidth = bandwidth or float(os.environ.get('QMUPLOAD_BANDWIDTH', 0))
+    if bandwidth:
+        return bandwidth * 1000000 / 8
+    return _link_throughput.get(host, DEFAULT_BANDWIDTH * 1000000 / 8)
+
+
+def tune_transfer(host, chunk_size=None, sock_buf=None, bandwidth=None):
+    """Choose the chunk size and socket buffer size for transfers with host.
+
+    The socket buffers are sized to twice the bandwidth-delay product of the
+    link, so that a single connection can keep the link full.  The chunk size
+    is about one millisecond of data at the link bandwidth, so that the
+    number of system calls stays small on fast links.
+
+    Arguments:
+    host       -- Server to transfer with.
+    chunk_size -- Optional.  Use this chunk size.  Default is the value of
+                  QMUPLOAD_CHUNK_SIZE, or chosen automatically.
+    sock_buf   -- Optional.  Use this socket buffer size.  Default is the
+                  value of QMUPLOAD_SOCKET_BUFFER, or chosen automatically.
+    bandwidth  -- Optional.  Link bandwidth in Mbit/s.  Default is the value
+                  of QMUPLOAD_BANDWIDTH, or the throughput of the last
+                  transfer with host, or DEFAULT_BANDWIDTH.
+
+    Return:
+    (chunk_size, sock_buf)
+
+    """
+    env = os.environ
+    chunk_size = chunk_size or int(env.get('QMUPLOAD_CHUNK_SIZE', 0))
+    sock_buf = sock_buf or int(env.get('QMUPLOAD_SOCKET_BUFFER', 0))
+    if chunk_size and sock_buf:
+        return chunk_size, sock_buf
+
+    bytes_per_sec = _link_bandwidth(host, bandwidth)
+
+    if not chunk_size:
+        chunk_size = _power_of_two(bytes_per_sec / 1000, MIN_CHUNK_SIZE,
+                                   MAX_CHUNK_SIZE)
+    if not sock_buf:
+        rtt = measure_rtt(host) or 0.001
+        sock_buf = _power_of_two(2 * bytes_per_sec * rtt, MIN_SOCKET_BUFFER,
+                                 MAX_SOCKET_BUFFER)
+    return chunk_size, sock_buf
+
+
+class RateLimiter(object):
+
+    """
+    Token bucket that limits the rate of data transfer.
+
+    The bucket fills at rate bytes per second, up to burst bytes.  Each
+    transfer takes the bytes it moves from the bucket, and when the bucket is
+    empty it waits until the debt is paid back.  The rate can be changed with
+    set_rate() at any time, including by another thread while transfers are
+    running.  A rate of None or 0 means no limit.
+
+    One limiter can be shared by several transfers to limit their total rate.
+    global_rate_limiter applies to every transfer in the process.
+
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._last = time.time()
+        self.rate = None
+        self.burst = None
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate limit.
+
+        Arguments:
+        rate  -- Bytes per second, or None or 0 for no limit.
+        burst -- Optional.  Bytes that can be sent at full speed after the
+                 transfer has been idle.  Default is RATE_LIMIT_BURST seconds
+                 of data at rate, and at least MIN_CHUNK_SIZE.
+
+        """
+        with self._lock:
+            self._refill()
+            self.rate = float(rate) if rate else None
+            if rate and not burst:
+                burst = max(self.rate * RATE_LIMIT_BURST, MIN_CHUNK_SIZE)
+            self.burst = burst
+            if self.rate is None:
+                self._tokens = 0.0
+            elif self._tokens > burst:
+                self._tokens = float(burst)
+
+    def _refill(self):
+        now = time.time()
+        if self.rate is not None:
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._last) * self.rate)
+        self._last = now
+
+    def consume(self, nbytes):
+        """Take nbytes from the bucket.
+
+        Return:
+        Seconds to wait before transferring more data, 0 if no wait.
+
+        """
+        with self._lock:
+            if self.rate is None:
+                return 0
+            self._refill()
+            self._tokens -= nbytes
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+
+# Limit for all transfers in this process.  The initial limit is the value of
+# QMUPLOAD_RATE_LIMIT in Mbit/s, if set.
+global_rate_limiter = RateLimiter(
+    float(os.environ.get('QMUPLOAD_RATE_LIMIT', 0)) * 1000000 / 8)
+
+
+def _rate_limiters(rate_limit):
+    # Return the limiters that apply to a transfer.
+    if rate_limit is None:
+        return [global_rate_limiter]
+    if not isinstance(rate_limit, RateLimiter):
+        rate_limit = RateLimiter(rate_limit)
+    return [rate_limit, global_rate_limiter]
+
+
+def _limit_delay(limiters, nbytes):
+    """Take nbytes from each limiter and return the seconds to wait."""
+    delay = 0
+    for limiter in limiters:
+        delay = max(delay, limiter.consume(nbytes))
+    return delay
+
+
+def _make_connection(host, port, timeout, sock_buf=None):
     host = socket.gethostbyname(host)
     port = int(port)
 
     conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     if timeout:
         conn.settimeout(int(timeout))
+    if sock_buf:
+        # Only ever grow the buffers.  Set before connecting, so that the TCP
+        # window scale is negotiated for the larger receive buffer.
+        for opt in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            if conn.getsockopt(socket.SOL_SOCKET, opt) < sock_buf:
+                conn.setsockopt(socket.SOL_SOCKET, opt, sock_buf)
 
     try:
         conn.connect((host, port))
@@ -208,46 +1488,1124 @@ def _make_connection(host, port, timeout):
     return conn
 
 
-def _send_file(filename, host, port, print_hash=False, timeout=30):
+def new_hash(algorithm='sha1'):
+    """Return a new hash object for the named algorithm.
+
+    On Python 2, blake2b and blake2s come from the pyblake2 module if it is
+    installed.  Raises ValueError if the algorithm is not available.
+
+    """
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        if not algorithm.startswith('blake2'):
+            raise
+    try:
+        import pyblake2
+        return getattr(pyblake2, algorithm)()
+    except (ImportError, AttributeError):
+        raise ValueError('unsupported hash type ' + algorithm)
+
+
+def _hash_available(algorithm):
+    try:
+        new_hash(algorithm)
+    except ValueError:
+        return False
+    return True
+
+
+def _choose_hash(capabilities, algorithm=None):
+    """Choose the hash algorithm to verify a transfer with.
+
+    Arguments:
+    capabilities -- Capabilities of the server.
+    algorithm    -- Optional.  Algorithm asked for by the caller.  Default is
+                    the first in HASH_ALGORITHMS that the server and this
+                    Python both support.
+
+    Return:
+    Name of hash algorithm.  Raises RuntimeError if the algorithm asked for
+    is not supported.
+
+    """
+    if algorithm is not None:
+        if algorithm != 'sha1' and 'hash:' + algorithm not in capabilities:
+            raise RuntimeError('qmanager does not support hash algorithm: '
+                               + algorithm)
+        new_hash(algorithm)
+        return algorithm
+    for algorithm in HASH_ALGORITHMS:
+        if ((algorithm == 'sha1' or 'hash:' + algorithm in capabilities) and
+            _hash_available(algorithm)):
+            return algorithm
+    return 'sha1'
+
+
+class HashWorker(object):
+
+    """
+    Hash data on a separate thread, so that hashing overlaps with socket I/O.
+
+    hashlib releases the GIL while hashing large buffers, so the hashing runs
+    in parallel with sending or receiving.  The data is not copied: a
+    transfer takes a buffer with buffer(), fills it, and passes it to update().
+    The buffer is returned to the pool once it has been hashed, and buffer()
+    waits for one if all are in use.
+
+    """
+
+    def __init__(self, h, buffer_size=CHUNK_SIZE, buffers=HASH_BUFFERS,
+                 metrics=None):
+        self._h = h
+        self._metrics = TransferMetrics() if metrics is None else metrics
+        self._free = Queue.Queue()
+        for _ in xrange(buffers):
+            self._free.put(memoryview(bytearray(buffer_size)))
+        self._work = Queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._work.get()
+            if item is None:
+                break
+            buf, n = item
+            if self._error is None:
+                try:
+                    with self._metrics.phase('hash'):
+                        self._h.update(buf[:n])
+                except Exception as e:
+                    self._error = e
+            self._free.put(buf)
+
+    def buffer(self):
+        """Return a free buffer, a writable memoryview."""
+        return self._free.get()
+
+    def update(self, buf, nbytes):
+        """Hash the first nbytes of buf, which must not be changed until it
+        is returned by buffer() again."""
+        self._work.put((buf, nbytes))
+
+    def close(self):
+        """Stop the worker after hashing all data given to update()."""
+        if self._thread.is_alive():
+            self._work.put(None)
+            self._thread.join()
+
+    def hexdigest(self):
+        self.close()
+        if self._error is not None:
+            raise self._error
+        return self._h.hexdigest()
+
+
+class ChunkTree(object):
+
+    """
+    Hash tree of the chunks of a file, built as the data is hashed.
+
+    Each leaf is the digest of one chunk_size chunk of the data, and each
+    node above is the hash of its two children's digests, or its only child
+    at the end of a level.  Level 0 holds the leaves, and node index of level
+    covers leaves index << level up to (index + 1) << level.
+
+    Data is given to update(), which also passes it to h, the hash of the
+    whole file, so a ChunkTree can be hashed on a HashWorker in place of h.
+    Comparing nodes of the sender's and receiver's trees from the top down
+    narrows a mismatch to the chunks that differ, without comparing every
+    leaf.  Leaves may be replaced when a chunk is received again.
+
+    """
+
+    def __init__(self, chunk_size, algorithm='sha1', h=None):
+        self.chunk_size = chunk_size
+        self.algorithm = algorithm
+        self.leaves = []
+        self.closed = False
+        self._h = h
+        self._leaf = new_hash(algorithm)
+        self._fill = 0
+
+    def update(self, data):
+        if self._h is not None:
+            self._h.update(data)
+        pos, n = 0, len(data)
+        while pos < n:
+            take = min(n - pos, self.chunk_size - self._fill)
+            self._leaf.update(data[pos:pos + take])
+            self._fill += take
+            pos += take
+            if self._fill == self.chunk_size:
+                self.leaves.append(self._leaf.digest())
+                self._leaf = new_hash(self.algorithm)
+                self._fill = 0
+
+    def close(self):
+        """End the data.  A last partial chunk becomes the last leaf."""
+        if not self.closed:
+            if self._fill:
+                self.leaves.append(self._leaf.digest())
+            self.closed = True
+
+    def hexdigest(self):
+        return self._h.hexdigest()
+
+    def count(self, level):
+        """Return the number of nodes of level whose data is all hashed."""
+        if self.closed:
+            return (len(self.leaves) + (1 << level) - 1) >> level
+        return len(self.leaves) >> level
+
+    def node(self, level, index):
+        """Return the hex digest of a node, or None if it is not complete."""
+        if index >= self.count(level):
+            return None
+        return self._node(level, index).encode('hex')
+
+    def _node(self, level, index):
+        if not level:
+            return self.leaves[index]
+        left = self._node(level - 1, 2 * index)
+        if (2 * index + 1) << (level - 1) >= len(self.leaves):
+            return left
+        h = new_hash(self.algorithm)
+        h.update(left + self._node(level - 1, 2 * index + 1))
+        return h.digest()
+
+
+class _ChunkVerifier(object):
+
+    """
+    Compare an upload's ChunkTree with the server's while the file is sent.
+
+    A thread checks each subtree of VERIFY_BATCH chunks as soon as the data
+    of it is hashed, and descends only into the nodes that differ, with one
+    upload_tree() call per level, to find the chunks the server received
+    wrong.  Subtrees the server has not received yet are checked on a later
+    round.  finish() checks the rest once all the data is sent.
+
+    """
+
+    def __init__(self, qms_url, fetch_id, tree, interval=VERIFY_INTERVAL):
+        self.bad = set()
+        self._qms_url = qms_url
+        self._fetch_id = fetch_id
+        self._tree = tree
+        self._level = VERIFY_BATCH.bit_length() - 1
+        self._next = 0
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        qms = xmlrpclib.ServerProxy(self._qms_url)
+        while not self._stop.wait(self._interval):
+            try:
+                self._check(qms)
+            except Exception:
+                # finish() checks whatever was not checked here.
+                return
+
+    def _differ(self, qms, level, indices):
+        """Return (nodes that differ, nodes the server does not have yet)."""
+        remote = qms.upload_tree(self._fetch_id, level, indices)
+        differ, pending = [], []
+        for index, digest in zip(indices, remote):
+            if not digest:
+                pending.append(index)
+            elif digest != self._tree.node(level, index):
+                differ.append(index)
+        return differ, pending
+
+    def _descend(self, qms, level, differ):
+        """Return the chunks under the differing nodes of level that
+        differ."""
+        while level and differ:
+            level -= 1
+            count = self._tree.count(level)
+            children = [c for i in differ for c in (2 * i, 2 * i + 1)
+                        if c < count]
+            differ, pending = self._differ(qms, level, children)
+            differ.extend(pending)
+        return differ
+
+    def _check(self, qms):
+        """Check the subtrees that are complete.  Return True when all of
+        the tree has been checked."""
+        with self._lock:
+            count = self._tree.count(self._level)
+            if self._next < count:
+                indices = range(self._next, count)
+                differ, pending = self._differ(qms, self._level, indices)
+                self.bad.update(self._descend(qms, self._level, differ))
+                self._next = min(pending) if pending else count
+            return self._tree.closed and self._next == count
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def finish(self, timeout=CONFIRM_TIMEOUT):
+        """Check the rest of the closed tree, waiting for the server to
+        receive it.  Return the sorted list of chunks that differ."""
+        self.stop()
+        qms = xmlrpclib.ServerProxy(self._qms_url)
+        deadline = time.time() + timeout
+        interval = CONFIRM_FIRST_INTERVAL
+        while not self._check(qms):
+            if time.time() > deadline:
+                raise RuntimeError('timed out verifying chunks')
+            time.sleep(interval)
+            interval = min(interval * 2, CONFIRM_MAX_INTERVAL)
+        return sorted(self.bad)
+
+    def recheck(self, chunks, timeout=CONFIRM_TIMEOUT):
+        """Check chunks again after they are resent.  Return the sorted list
+        of those that still differ."""
+        qms = xmlrpclib.ServerProxy(self._qms_url)
+        deadline = time.time() + timeout
+        interval = CONFIRM_FIRST_INTERVAL
+        bad = []
+        while chunks:
+            differ, chunks = self._differ(qms, 0, chunks)
+            bad.extend(differ)
+            if chunks:
+                if time.time() > deadline:
+                    raise RuntimeError('timed out verifying chunks')
+                time.sleep(interval)
+                interval = min(interval * 2, CONFIRM_MAX_INTERVAL)
+        self.bad = set(bad)
+        return sorted(bad)
+
+
+def _extent_at(fd, pos, size):
+    """Return (end, is_hole) of the data extent or hole that pos is in.
+
+    This moves the file offset of fd.
+
+    """
+    try:
+        data = os.lseek(fd, pos, SEEK_DATA)
+    except OSError as e:
+        if e.errno != errno.ENXIO:
+            raise
+        # No data after pos, so the rest of the file is a hole.
+        return size, True
+    if data > pos:
+        return min(data, size), True
+    return min(os.lseek(fd, pos, SEEK_HOLE), size), False
+
+
+def _is_sparse(fd):
+    """Return True if the file has holes that can be found with SEEK_HOLE."""
+    if SEEK_HOLE is None:
+        return False
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode) or \
+       getattr(st, 'st_blocks', None) is None or \
+       st.st_blocks * 512 >= st.st_size:
+        return False
+    offset = os.lseek(fd, 0, os.SEEK_CUR)
+    try:
+        _extent_at(fd, 0, st.st_size)
+    except OSError:
+        # Filesystem or OS does not support SEEK_DATA.
+        return False
+    finally:
+        os.lseek(fd, offset, os.SEEK_SET)
+    return True
+
+
+class SparseFile(object):
+
+    """
+    Read-only file that does not read the holes of a sparse file from disk.
+
+    The file is walked with SEEK_DATA and SEEK_HOLE.  Reads from a hole are
+    filled with zeros from memory, and only the data extents are read from
+    disk, so a raw VM image that is mostly holes is read at a fraction of its
+    size.  The data read is the same as from the plain file.  Supports
+    read(), readinto(), seek(), tell(), fileno() and close(), and is a
+    context manager.
+
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._fd = f.fileno()
+        self._size = os.fstat(self._fd).st_size
+        self._pos = f.tell()
+        # Current extent [start, end), and whether f is positioned at pos.
+        self._extent = (0, 0, False)
+        self._synced = True
+        self._zeros = ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def fileno(self):
+        return self._fd
+
+    def close(self):
+        self._f.close()
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._pos = offset
+        self._synced = False
+
+    def _next_extent(self, limit):
+        # Return (length, is_hole) of what can be read next, up to limit.
+        start, end, hole = self._extent
+        if not start <= self._pos < end:
+            end, hole = _extent_at(self._fd, self._pos, self._size)
+            self._extent = (self._pos, end, hole)
+            self._synced = False
+        return min(limit, end - self._pos), hole
+
+    def _read_data(self, n, into=None):
+        if not self._synced:
+            self._f.seek(self._pos)
+            self._synced = True
+        if into is None:
+            data = self._f.read(n)
+            n = len(data)
+        else:
+            n = self._f.readinto(into)
+            data = None
+        if n:
+            self._pos += n
+        else:
+            # File was truncated; stop at its new end.
+            self._size = self._pos
+        return data, n
+
+    def read(self, n=-1):
+        left = self._size - self._pos
+        if n < 0 or n > left:
+            n = max(left, 0)
+        pieces = []
+        while n:
+            length, hole = self._next_extent(n)
+            if hole:
+                if len(self._zeros) != length:
+                    self._zeros = '\0' * length
+                pieces.append(self._zeros)
+                self._pos += length
+                self._synced = False
+            else:
+                data, length = self._read_data(length)
+                if not length:
+                    break
+                pieces.append(data)
+            n -= length
+        if len(pieces) == 1:
+            return pieces[0]
+        return ''.join(pieces)
+
+    def readinto(self, buf):
+        view = memoryview(buf)
+        n = min(len(view), max(self._size - self._pos, 0))
+        done = 0
+        while done < n:
+            length, hole = self._next_extent(n - done)
+            if hole:
+                if len(self._zeros) < length:
+                    self._zeros = '\0' * length
+                view[done:done + length] = self._zeros[:length]
+                self._pos += length
+                self._synced = False
+            else:
+                _, length = self._read_data(length,
+                                            view[done:done + length])
+                if not length:
+                    break
+            done += length
+        return done
+
+
+def _open_sparse(path):
+    """Open a file for reading, as a SparseFile if it has holes."""
+    f = open(path, 'rb')
+    if SPARSE_READS and _is_sparse(f.fileno()):
+        return SparseFile(f)
+    return f
+
+
+def _file_digest(f, size, algorithm='sha1'):
+    """Return the hex digest of the first size bytes of an open file.
+
+    The file is hashed from a read-only mmap, so the data is passed to hashlib
+    straight from the page cache without being copied into Python objects.
+    The holes of a sparse file are hashed as zeros from memory.
+
+    """
+    h = new_hash(algorithm)
+    if not size:
+        return h.hexdigest()
+    fd = f.fileno()
+    m = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+    try:
+        if not (SPARSE_READS and _is_sparse(fd)):
+            h.update(m)
+            return h.hexdigest()
+        offset = os.lseek(fd, 0, os.SEEK_CUR)
+        zeros = ''
+        pos = 0
+        while pos < size:
+            end, hole = _extent_at(fd, pos, size)
+            if not hole:
+                h.update(buffer(m, pos, end - pos))
+                pos = end
+                continue
+            while pos < end:
+                n = min(end - pos, MAX_CHUNK_SIZE)
+                if len(zeros) != n:
+                    zeros = '\0' * n
+                h.update(zeros)
+                pos += n
+        os.lseek(fd, offset, os.SEEK_SET)
+    finally:
+        m.close()
+    return h.hexdigest()
+
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK,
+                getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+
+class _Job(object):
+
+    # Base of transfers run by TransferLoop.  A job that is over its rate
+    # limit sets paused_until, and is not run again until then.
+
+    def __init__(self, conn, timeout, limiters):
+        self.conn = conn
+        self.timeout = timeout
+        self.error = None
+        self.paused_until = None
+        self._limiters = limiters
+
+    def _throttle(self, nbytes):
+        """Count nbytes against the rate limits.  Return True if paused."""
+        if not self._limiters:
+            return False
+        delay = _limit_delay(self._limiters, nbytes)
+        if not delay:
+            self.paused_until = None
+            return False
+        self.paused_until = time.time() + min(delay, RATE_LIMIT_RECHECK)
+        return True
+
+
+class _SendJob(_Job):
+
+    """
+    Send part of a file on a non-blocking socket.
+
+    Data is read into one reused buffer and sent through a memoryview.  With
+    zero_copy, sendfile() is used instead when it is available.  If a
+    HashWorker is given, the data is read into its buffers instead and hashed
+    on its thread while being sent.  The data sent is optionally recorded in a
+    TransferJournal and shown on a ProgressBar, and bytes sent are added to
+    TransferMetrics.
+    The rate is kept within the limits of the given RateLimiter list.
+
+    """
+
+    events = 'w'
+
+    def __init__(self, conn, f, timeout, offset=0, length=None, hasher=None,
+                 progress_bar=None, journal=None, chunk_size=CHUNK_SIZE,
+                 zero_copy=False, metrics=None, limiters=None):
+        _Job.__init__(self, conn, timeout, limiters)
+        self.sent = 0
+        self._f = f
+        self._offset = offset
+        self._length = length
+        self._hasher = hasher
+        self._progress_bar = progress_bar
+        self._journal = journal
+        self._metrics = TransferMetrics() if metrics is None else metrics
+        self._zero_copy = zero_copy and _sendfile is not None and \
+                          hasher is None and journal is None and \
+                          length is not None
+        self._chunk_size = chunk_size
+        if not self._zero_copy:
+            f.seek(offset)
+            if hasher is None:
+                self._view = memoryview(bytearray(chunk_size))
+            self._pos = self._fill = 0
+
+    def _remaining(self):
+        if self._length is None:
+            return len(self._view)
+        return min(len(self._view), self._length - self.sent)
+
+    def on_ready(self):
+        """Send as much as the socket takes.  Return True when done."""
+        if self._throttle(0):
+            return False
+        if self._zero_copy:
+            left = self._length - self.sent
+            if not left:
+                return True
+            if self._limiters:
+                # Keep each send small while rate limited.
+                left = min(left, self._chunk_size)
+            try:
+                sent = _sendfile(self.conn.fileno(), self._f.fileno(),
+                                 self._offset + self.sent, left)
+            except (OSError, IOError) as e:
+                if e.errno in _WOULD_BLOCK:
+                    return False
+                raise
+            if not sent:
+                # File was truncated while sending.
+                return True
+        else:
+            if self._pos == self._fill:
+                if self._hasher is not None:
+                    self._view = self._hasher.buffer()
+                want = self._remaining()
+                n = self._f.readinto(self._view[:want]) if want else 0
+                if not n:
+                    return True
+                if self._hasher is not None:
+                    self._hasher.update(self._view, n)
+                self._pos, self._fill = 0, n
+            try:
+                sent = self.conn.send(self._view[self._pos:self._fill])
+            except socket.error as e:
+                if e.errno in _WOULD_BLOCK:
+                    return False
+                raise
+            self._pos += sent
+            if self._pos == self._fill and self._journal is not None:
+                self._journal.update(self._view[:self._fill])
+        self.sent += sent
+        self._metrics.network(sent)
+        if self._progress_bar is not None:
+            self._progress_bar.update(sent)
+        self._throttle(sent)
+        return False
+
+
+class _RecvJob(_Job):
+
+    """
+    Receive data from a non-blocking socket into a file until end of data.
+
+    The data is received into the buffers of a HashWorker, written through a
+    memoryview, and hashed on the worker's thread.  It is optionally recorded
+    in a TransferJournal and shown on a ProgressBar, and bytes received are
+    added to TransferMetrics.  The rate is kept within the limits of the given
+    RateLimiter list.
+
+    """
+
+    events = 'r'
+
+    def __init__(self, conn, f, timeout, hasher, progress_bar=None,
+                 journal=None, metrics=None, limiters=None):
+        _Job.__init__(self, conn, timeout, limiters)
+        self.received = 0
+        self._f = f
+        self._hasher = hasher
+        self._progress_bar = progress_bar
+        self._journal = journal
+        self._metrics = TransferMetrics() if metrics is None else metrics
+        self._view = None
+
+    def on_ready(self):
+        """Receive what is available.  Return True at end of data."""
+        if self._throttle(0):
+            return False
+        if self._view is None:
+            self._view = self._hasher.buffer()
+        try:
+            n = self.conn.recv_into(self._view)
+        except socket.error as e:
+            if e.errno in _WOULD_BLOCK:
+                return False
+            raise
+        if not n:
+            return True
+        data = self._view[:n]
+        self._f.write(data)
+        if self._journal is not None:
+            self._f.flush()
+            self._journal.update(data)
+        self._hasher.update(self._view, n)
+        self._view = None
+        self.received += n
+        self._metrics.network(n)
+        if self._progress_bar is not None:
+            self._progress_bar.update(n)
+        self._throttle(n)
+        return False
+
+
+class _RangeRecvJob(_Job):
+
+    """
+    Receive one byte range of a file from a non-blocking socket.
+
+    The data is received into a reused buffer and written at its offset in
+    the file with pwrite(), so that several ranges are written to the same
+    file at once without seeking.  Where pwrite() is not available, the range
+    is written through a file object of its own.  With sparse, blocks of
+    zeros are not written, and are left as holes of the new file.  Bytes
+    received are added to TransferMetrics, and the rate is kept within the
+    limits of the given RateLimiter list.
+
+    """
+
+    events = 'r'
+
+    def __init__(self, conn, path, fd, offset, length, timeout,
+                 chunk_size=CHUNK_SIZE, progress_bar=None, metrics=None,
+                 limiters=None, sparse=False):
+        _Job.__init__(self, conn, timeout, limiters)
+        self.offset = offset
+        self.length = length
+        self.received = 0
+        self._fd = fd
+        self._f = None
+        if _pwrite is None:
+            self._f = open(path, 'r+b')
+            self._f.seek(offset)
+        self._buf = bytearray(chunk_size)
+        self._view = memoryview(self._buf)
+        self._sparse = sparse
+        self._progress_bar = progress_bar
+        self._metrics = TransferMetrics() if metrics is None else metrics
+
+    def _write(self, start, end):
+        offset = self.offset + self.received + start
+        if self._f is not None:
+            if self._f.tell() != offset:
+                self._f.seek(offset)
+            self._f.write(self._view[start:end])
+        elif _pwrite(self._fd, self._buf, end - start, offset,
+                     start) != end - start:
+            # Only happens when the disk is full.
+            raise IOError(errno.ENOSPC, 'short write to file')
+
+    def close(self):
+        self.conn.close()
+        if self._f is not None:
+            self._f.close()
+
+    def on_ready(self):
+        """Receive what is available.  Return True when the range is done."""
+        if self._throttle(0):
+            return False
+        want = min(len(self._buf), self.length - self.received)
+        if not want:
+            return True
+        try:
+            n = self.conn.recv_into(self._view[:want])
+        except socket.error as e:
+            if e.errno in _WOULD_BLOCK:
+                return False
+            raise
+        if not n:
+            return True
+        if self._sparse:
+            for start, end in _data_runs(self._view[:n],
+                                         self.offset + self.received):
+                self._write(start, end)
+        else:
+            self._write(0, n)
+        self.received += n
+        self._metrics.network(n)
+        if self._progress_bar is not None:
+            self._progress_bar.update(n)
+        self._throttle(n)
+        return False
+
+
+class TransferLoop(object):
+
+    """
+    Drive several socket transfers from one thread.
+
+    Each transfer's socket is made non-blocking, and select() waits until one
+    of them can make progress, so no CPU is used while waiting for the network.
+    A transfer that makes no progress for its timeout fails with
+    socket.timeout.  A transfer that raises an error is stopped and the error
+    is stored in its error attribute, without affecting the others.  A
+    transfer that is paused by its rate limit is left out of select() until
+    its pause ends, and does not time out while paused.
+
+    select() is used instead of poll() because it is also available on
+    Windows.
+
+    """
+
+    def __init__(self):
+        self._jobs = []
+
+    def add(self, job):
+        job.conn.setblocking(0)
+        job.deadline = time.time() + job.timeout if job.timeout else None
+        self._jobs.append(job)
+
+    def run(self):
+        """Run until all transfers are done or have failed."""
+        jobs = self._jobs
+        while jobs:
+            now = time.time()
+            active = []
+            wakeups = []
+            for job in jobs:
+                if job.paused_until is not None and job.paused_until > now:
+                    wakeups.append(job.paused_until)
+                    if job.timeout:
+                        job.deadline = job.paused_until + job.timeout
+                else:
+                    active.append(job)
+                    if job.deadline is not None:
+                        wakeups.append(job.deadline)
+            wait = None
+            if wakeups:
+                wait = max(0, min(wakeups) - now)
+            readers = [j.conn for j in active if j.events == 'r']
+            writers = [j.conn for j in active if j.events == 'w']
+            if not readers and not writers:
+                # All paused.  select() with no sockets fails on Windows.
+                time.sleep(wait)
+                continue
+            try:
+                readable, writable, _ = select.select(readers, writers, [],
+                                                      wait)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            ready = set(readable) | set(writable)
+            now = time.time()
+            for job in active:
+                if job.conn in ready:
+                    try:
+                        done = job.on_ready()
+                    except Exception as e:
+                        job.error = e
+                        done = True
+                    if job.timeout:
+                        job.deadline = now + job.timeout
+                    if done:
+                        jobs.remove(job)
+                elif job.deadline is not None and now >= job.deadline:
+                    job.error = socket.timeout('timed out')
+                    jobs.remove(job)
+
+
+def _send_zero_copy(conn, f, size, timeout, offset=0, chunk_size=CHUNK_SIZE,
+                    metrics=None, limiters=None):
+    """Send size bytes of open file f over conn without copying to user space.
+
+    Uses sendfile() when available.  Otherwise the file is read into a single
+    reused buffer and sent through a memoryview, so that no per-chunk strings
+    are created and short sends do not copy the unsent remainder.
+
+    Arguments:
+    conn    -- Connected socket to send data on.
+    f       -- File object open for reading.
+    size    -- Number of bytes to send.
+    timeout -- Seconds to wait for the socket to become writable.
+    offset  -- Optional.  File position to start sending from.
+    chunk_size -- Optional.  Size of buffer, when sendfile() is not available.
+    metrics -- Optional.  TransferMetrics to count bytes sent in.
+    limiters -- Optional.  List of RateLimiter to keep within.
+
+    Return:
+    Number of bytes sent.
+
+    """
+    job = _SendJob(conn, f, timeout, offset, size, chunk_size=chunk_size,
+                   zero_copy=True, metrics=metrics, limiters=limiters)
+    loop = TransferLoop()
+    loop.add(job)
+    loop.run()
+    if job.error is not None:
+        raise job.error
+    return job.sent
+
+
+def _send_file(filename, host, port, print_hash=False, timeout=30,
+               zero_copy=False, journal=None, offset=0, known_digest=None,
+               chunk_size=CHUNK_SIZE, sock_buf=None, metrics=None,
+               limiters=None, hash_algorithm='sha1', tree=None):
     if not os.path.isfile(filename):
         raise Exception('%s is not a file', filename)
-
-    conn = _make_connection(host, port, timeout)
+    if metrics is None:
+        metrics = TransferMetrics()
+
+    # When resuming, the data the server already has is hashed again locally,
+    # and checked against the journal, before sending the rest.  Journals
+    # always use SHA-1.
+    h = new_hash(hash_algorithm)
+    if journal is not None:
+        with metrics.phase('hash'):
+            with _open_sparse(filename) as f:
+                good_offset, h = journal.resume(f, offset)
+        if good_offset != offset:
+            return False, 'file changed since the upload was interrupted'
+
+    with metrics.phase('connect'):
+        conn = _make_connection(host, port, timeout, sock_buf)
 
     if print_hash:
         progress_bar = ProgressBar(os.path.getsize(filename))
+        progress_bar.update(offset)
     else:
         progress_bar = None
 
-    filesize = digest = None
+    filesize = digest = hasher = None
     try:
-        with open(filename, "rb") as f:
-            h = hashlib.sha1()
-            while 1:
-                data = f.read(CHUNK_SIZE)
-                # If done reading file
-                if not data:
-                    break
-                h.update(data)
-                while len(data):
+        with _open_sparse(filename) as f:
+            if (zero_copy and progress_bar is None and journal is None and
+                tree is None):
+                size = os.fstat(f.fileno()).st_size
+                with metrics.phase('hash'):
+                    digest = known_digest or _file_digest(f, size,
+                                                          hash_algorithm)
+                with metrics.phase('send'):
+                    filesize = _send_zero_copy(conn, f, size, timeout,
+                                               chunk_size=chunk_size,
+                                               metrics=metrics,
+                                               limiters=limiters)
+                if filesize != size:
+                    raise RuntimeError('file changed size while sending')
+            else:
+                if tree is not None:
+                    # The tree passes the data on to the whole-file hash.
+                    hasher = HashWorker(tree, chunk_size, metrics=metrics)
+                elif not known_digest:
+                    hasher = HashWorker(h, chunk_size, metrics=metrics)
+                job = _SendJob(conn, f, timeout, offset, hasher=hasher,
+                               progress_bar=progress_bar, journal=journal,
+                               chunk_size=chunk_size, metrics=metrics,
+                               limiters=limiters)
+                loop = TransferLoop()
+                loop.add(job)
+                with metrics.phase('send'):
+                    loop.run()
+                if job.error is not None:
+                    raise job.error
+
+                filesize = f.tell()
+                digest = known_digest or hasher.hexdigest()
+                if tree is not None:
+                    hasher.close()
+                    tree.close()
+    except Exception, ex:
+        return False, 'Error transferring file: ' + str(ex)
+    finally:
+        conn.close()
+        if hasher is not None:
+            hasher.close()
+
+    if not filesize:
+        return False, 'no data transferred'
+
+    if progress_bar is not None:
+        progress_bar.finish()
+
+    return True, {'size': filesize, 'hash': digest}
+
+
+def _send_chunks(filename, host, port, chunks, chunk_size, timeout=30,
+                 sock_buf=None, metrics=None, limiters=None,
+                 send_size=CHUNK_SIZE):
+    """Send the given chunks of a file, in order, over one connection.
+
+    Arguments:
+    filename -- Path of file to send chunks of.
+    host, port -- Address the server is listening on.
+    chunks   -- List of chunk indices.  Chunk index starts at byte
+                index * chunk_size of the file.
+    chunk_size -- Size of each chunk.  The last chunk of the file may be
+                shorter.
+    send_size -- Optional.  Size of file reads and socket sends.
+
+    Return:
+    Number of bytes sent.
+
+    """
+    if metrics is None:
+        metrics = TransferMetrics()
+    with metrics.phase('connect'):
+        conn = _make_connection(host, port, timeout, sock_buf)
+    sent = 0
+    try:
+        with _open_sparse(filename) as f:
+            size = os.fstat(f.fileno()).st_size
+            for index in chunks:
+                offset = index * chunk_size
+                job = _SendJob(conn, f, timeout, offset,
+                               min(chunk_size, size - offset),
+                               chunk_size=send_size, metrics=metrics,
+                               limiters=limiters)
+                loop = TransferLoop()
+                loop.add(job)
+                with metrics.phase('send'):
+                    loop.run()
+                if job.error is not None:
+                    raise job.error
+                sent += job.sent
+    finally:
+        conn.close()
+    return sent
+
+
+def _repair_upload(qms, host, fetch_id, filename, verifier, chunk_size,
+                   quiet, timeout=CONFIRM_TIMEOUT, sock_buf=None,
+                   metrics=None, limiters=None, send_size=CHUNK_SIZE):
+    """Resend the chunks of a verified upload that the server got wrong.
+
+    The chunks found by verifier are sent again on a connection opened by
+    repair_upload(), and checked again, up to VERIFY_RETRIES times.  They
+    are sent in reads and sends of send_size bytes.
+
+    Return:
+    (True, bytes resent) if the server has all chunks right, or
+    (False, message) if not.
+
+    """
+    try:
+        bad = verifier.finish(timeout)
+        resent = 0
+        for _ in xrange(VERIFY_RETRIES):
+            if not bad:
+                return True, resent
+            if not quiet:
+                print 'resending %d chunk(s) the server received wrong: %s' \
+                      % (len(bad), ', '.join(str(i) for i in bad))
+            port = qms.repair_upload(fetch_id, bad)
+            resent += _send_chunks(filename, host, port, bad, chunk_size,
+                                   sock_buf=sock_buf, metrics=metrics,
+                                   limiters=limiters, send_size=send_size)
+            bad = verifier.recheck(bad, timeout)
+    except Exception as e:
+        return False, 'Error verifying chunks: %s' % (e,)
+    if bad:
+        return False, '%d chunk(s) still wrong after %d retries' % (
+            len(bad), VERIFY_RETRIES)
+    return True, resent
+
+
+def _background(iterable, depth=PIPELINE_DEPTH):
+    """Run iterable in a separate thread and yield its items.
+
+    Items are passed through a queue holding at most depth items, so the
+    producer runs ahead of the consumer only that far.  An exception raised by
+    the producer is raised again in the consumer.  If the consumer stops early,
+    the producer is stopped the next time it has an item ready.
+
+    """
+    items = Queue.Queue(depth)
+    stop = []
+    failure = []
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop:
                     try:
-                        sent = conn.send(data)
-                        if progress_bar is not None:
-                            progress_bar.update(sent)
-                    except Exception, send_ex:
-                        # If the socket is out of buffers, then give it a
-                        # little time to send the buffered data.
-                        if (str(send_ex).startswith('[Errno 35]') or
-                            str(send_ex).startswith('[Errno 10035]')):
-                            time.sleep(0)
-                            continue
-                        raise send_ex
-                    if sent == len(data):
+                        items.put(item, timeout=1)
                         break
-                    data = data[sent:]
+                    except Queue.Full:
+                        pass
+                if stop:
+                    return
+        except BaseException:
+            failure.append(sys.exc_info())
+        items.put(done)
+
+    th = threading.Thread(target=produce)
+    th.daemon = True
+    th.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            yield item
+        if failure:
+            raise failure[0][0], failure[0][1], failure[0][2]
+    finally:
+        stop.append(True)
 
-            filesize = f.tell()
-            digest = h.hexdigest()
+
+def _send_stream(chunks, host, port, progress_bar=None, timeout=30,
+                 sock_buf=None, metrics=None, limiters=None,
+                 hash_algorithm='sha1', wait_phase='compress'):
+    """Send a stream of data whose size is not known in advance.
+
+    Arguments:
+    chunks       -- Iterable of (data, progress) tuples.  The data is sent
+                    and hashed, and the progress bar is advanced by progress.
+    host         -- Server to connect to.
+    port         -- Server data port.
+    progress_bar -- Optional.  ProgressBar to update.
+    timeout      -- Socket timeout.
+    sock_buf     -- Optional.  Socket buffer size.
+    metrics      -- Optional.  TransferMetrics to record in.  The time spent
+                    waiting for the next chunk is recorded as the wait_phase.
+    limiters     -- Optional.  List of RateLimiter to keep within.
+    hash_algorithm -- Optional.  Algorithm to hash the data with.
+    wait_phase   -- Optional.  Phase that produces the chunks.
+
+    Return:
+    Same as _send_file().
+
+    """
+    if metrics is None:
+        metrics = TransferMetrics()
+    with metrics.phase('connect'):
+        conn = _make_connection(host, port, timeout, sock_buf)
+
+    filesize = 0
+    h = new_hash(hash_algorithm)
+    chunks = iter(chunks)
+    try:
+        while True:
+            with metrics.phase(wait_phase):
+                try:
+                    data, progress = next(chunks)
+                except StopIteration:
+                    break
+            with metrics.phase('hash'):
+                h.update(data)
+            with metrics.phase('send'):
+                conn.sendall(data)
+                if limiters:
+                    time.sleep(_limit_delay(limiters, len(data)))
+            metrics.network(len(data))
+            filesize += len(data)
+            if progress_bar is not None:
+                progress_bar.update(progress)
     except Exception, ex:
         return False, 'Error transferring file: ' + str(ex)
     finally:
@@ -259,50 +2617,643 @@ def _send_file(filename, host, port, print_hash=False, timeout=30):
     if progress_bar is not None:
         progress_bar.finish()
 
-    return True, {'size': filesize, 'hash': digest}
+    return True, {'size': filesize, 'hash': h.hexdigest()}
+
+
+class _TeeSource(object):
+
+    """
+    Data that is read once and sent to several servers.
+
+    A producer thread takes the data from chunks, hashes it once with each of
+    the given algorithms, and makes it available to readers.  If spool is
+    given, the data is appended to it; otherwise path already holds the data,
+    as when sending a file that is not compressed.  Each reader reads from
+    path with its own file handle, at its own pace, up to what the producer
+    has made available.  A reader on a slow link falls behind without
+    holding up the producer or the other readers, and a reader close behind
+    the producer is served from the page cache.
+
+    """
+
+    def __init__(self, path, chunks, algorithms, spool=None):
+        self.path = path
+        self.spooled = spool is not None
+        self.size = 0
+        self.done = False
+        self.error = None
+        self._hashes = dict((a, new_hash(a)) for a in algorithms)
+        self._cond = threading.Condition()
+        th = threading.Thread(target=self._produce, args=(chunks, spool))
+        th.daemon = True
+        th.start()
+
+    def _produce(self, chunks, spool):
+        try:
+            for data in chunks:
+                for h in self._hashes.itervalues():
+                    h.update(data)
+                if spool is not None:
+                    spool.write(data)
+                    spool.flush()
+                with self._cond:
+                    self.size += len(data)
+                    self._cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            if spool is not None:
+                spool.close()
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+
+    def wait(self, offset):
+        """Wait until there is data past offset, or there is no more data.
+
+        Return:
+        Number of bytes available.  Raises RuntimeError if the producer
+        failed.
+
+        """
+        with self._cond:
+            while self.size <= offset and not self.done:
+                self._cond.wait(1.0)
+            if self.error is not None:
+                raise RuntimeError('unable to read %s: %s' % (self.path,
+                                                              self.error))
+            return self.size
+
+    def hexdigest(self, algorithm):
+        """Return the digest of all the data, once done."""
+        return self._hashes[algorithm].hexdigest()
+
+
+def _file_chunks(path, chunk_size):
+    # Generate the data of a file, chunk_size bytes at a time.
+    with _open_sparse(path) as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+
+def _send_tee(tee, host, port, timeout=30, chunk_size=CHUNK_SIZE,
+              sock_buf=None, metrics=None, limiters=None,
+              hash_algorithm='sha1', wait_phase='hash'):
+    """Send the data of a _TeeSource, as it becomes available.
+
+    Arguments:
+    tee          -- _TeeSource to send the data of.
+    host, port   -- Address the server is listening on.
+    metrics      -- Optional.  TransferMetrics to record in.  The time spent
+                    waiting for the producer is recorded as the wait_phase.
+    hash_algorithm -- Optional.  Algorithm the server verifies the data with.
+                    tee must hash with it.
+
+    Return:
+    Same as _send_file().
+
+    """
+    if metrics is None:
+        metrics = TransferMetrics()
+    with metrics.phase('connect'):
+        conn = _make_connection(host, port, timeout, sock_buf)
+
+    filesize = 0
+    try:
+        # A spool is still being written, so its holes are not final.
+        f = open(tee.path, 'rb') if tee.spooled else _open_sparse(tee.path)
+        with f:
+            while True:
+                with metrics.phase(wait_phase):
+                    available = tee.wait(filesize)
+                if filesize >= available:
+                    break
+                data = f.read(min(chunk_size, available - filesize))
+                if not data:
+                    raise RuntimeError('file changed size while sending')
+                with metrics.phase('send'):
+                    conn.sendall(data)
+                    if limiters:
+                        time.sleep(_limit_delay(limiters, len(data)))
+                metrics.network(len(data))
+                filesize += len(data)
+    except Exception, ex:
+        return False, 'Error transferring file: ' + str(ex)
+    finally:
+        conn.close()
+
+    if not filesize:
+        return False, 'no data transferred'
+
+    return True, {'size': filesize, 'hash': tee.hexdigest(hash_algorithm)}
+
+
+def _send_file_striped(filename, host, stripes, timeout=30,
+                       known_digest=None, metrics=None, limiters=None,
+                       hash_algorithm='sha1', chunk_size=CHUNK_SIZE,
+                       sock_buf=None):
+    """Send a file as several byte ranges over parallel connections.
+
+    All connections are driven by a single TransferLoop thread, while the
+    calling thread hashes the file.
+
+    Arguments:
+    filename -- Path of file to send.
+    host     -- Server to connect to.
+    stripes  -- List of (port, offset, length) for each range, as returned by
+                the server's upload_striped() call.
+    timeout  -- Socket timeout for each connection.
+    known_digest -- Optional.  Digest of the file, if already known.
+    metrics  -- Optional.  TransferMetrics to record in.
+    limiters -- Optional.  List of RateLimiter to keep the total rate of all
+                connections within.
+    hash_algorithm -- Optional.  Algorithm to hash the file with.
+    chunk_size -- Optional.  Largest send while rate limited.
+    sock_buf -- Optional.  Socket buffer size of each connection.
+
+    Return:
+    Same as _send_file().
+
+    """
+    if not os.path.isfile(filename):
+        raise Exception('%s is not a file', filename)
+    if metrics is None:
+        metrics = TransferMetrics()
+
+    def run_loop():
+        with metrics.phase('send'):
+            loop.run()
+
+    errors = []
+    jobs = []
+    loop = TransferLoop()
+    try:
+        for port, offset, length in stripes:
+            offset, length = long(offset), long(length)
+            try:
+                with metrics.phase('connect'):
+                    conn = _make_connection(host, port, timeout, sock_buf)
+            except Exception as ex:
+                errors.append('stripe at offset %d: %s' % (offset, ex))
+                continue
+            job = _SendJob(conn, open(filename, "rb"), timeout, offset,
+                           length, chunk_size=chunk_size, zero_copy=True,
+                           metrics=metrics, limiters=limiters)
+            job.offset = offset
+            job.length = length
+            jobs.append(job)
+            loop.add(job)
+
+        th = threading.Thread(target=run_loop)
+        th.daemon = True
+        th.start()
+
+        # Hash the whole file while the stripes are being sent.
+        with open(filename, "rb") as f:
+            filesize = os.fstat(f.fileno()).st_size
+            with metrics.phase('hash'):
+                digest = known_digest or _file_digest(f, filesize,
+                                                      hash_algorithm)
+
+        th.join()
+    finally:
+        for job in jobs:
+            job.conn.close()
+            job._f.close()
+
+    for job in jobs:
+        if job.error is not None:
+            errors.append('stripe at offset %d: %s' % (job.offset, job.error))
+        elif job.sent != job.length:
+            errors.append('stripe at offset %d: sent %d of %d bytes'
+                          % (job.offset, job.sent, job.length))
+
+    if errors:
+        return False, 'Error transferring file: ' + '; '.join(errors)
+    if not filesize:
+        return False, 'no data transferred'
+
+    return True, {'size': filesize, 'hash': digest}
+
+
+def block_signature(path, block_size=DELTA_MIN_BLOCK_SIZE):
+    """Return the delta signature of a file.
+
+    The signature is the Adler-32 checksum and SHA-1 digest of each whole
+    block of the file, packed as a 32-bit big-endian integer and 20 bytes.  A
+    short last block is left out, since it can not match a whole block.
+
+    """
+    pieces = []
+    with _open_sparse(path) as f:
+        while True:
+            data = f.read(block_size)
+            if len(data) < block_size:
+                break
+            pieces.append(_SIGNATURE.pack(zlib.adler32(data) & 0xffffffffL,
+                                          hashlib.sha1(data).digest()))
+    return ''.join(pieces)
+
+
+def _delta_stream(src_path, signature, block_size, source_hash, stats):
+    """Generate the delta instructions that rebuild a file from a base file.
+
+    The window is moved through the file one byte at a time, with its Adler-32
+    checksum rolled along, until the checksum and then the SHA-1 digest of the
+    window match a block of the base file.  The matched block is copied, and
+    the search starts again after it.  Runs of consecutive base blocks are
+    sent as a single copy.
+
+    Arguments:
+    src_path    -- Path of the new file.
+    signature   -- block_signature() of the base file.
+    block_size  -- Block size of the signature.
+    source_hash -- Hash object to update with the data of the new file.
+    stats       -- Dict that gets the 'size' of the new file, and the
+                   'copied' and 'literal' bytes of it.
+
+    Return:
+    Generator of (instructions, file_bytes) tuples, where file_bytes is the
+    amount of the new file the instructions cover.
+
+    """
+    table = {}
+    for index in xrange(len(signature) // _SIGNATURE.size):
+        weak, strong = _SIGNATURE.unpack_from(signature,
+                                              index * _SIGNATURE.size)
+        table.setdefault(weak, {}).setdefault(strong, index)
+
+    stats.update(size=0, copied=0, literal=0)
+    out = []
+    covered = [0]
+    copy_run = []
+
+    def flush_copy():
+        if copy_run:
+            index, count = copy_run
+            out.append(DELTA_COPY + struct.pack('>LL', index, count))
+            stats['copied'] += count * block_size
+            covered[0] += count * block_size
+            del copy_run[:]
+
+    def flush_literal(data):
+        flush_copy()
+        out.append(DELTA_LITERAL + struct.pack('>L', len(data)))
+        out.append(str(data))
+        stats['literal'] += len(data)
+        covered[0] += len(data)
+
+    buf = bytearray()
+    pos = lit = 0
+    weak = None
+    eof = False
+    with _open_sparse(src_path) as f:
+        while True:
+            if len(buf) - pos <= block_size and not eof:
+                # Keep the window and any pending literal data, and read on.
+                del buf[:lit]
+                pos -= lit
+                lit = 0
+                data = f.read(max(GZIP_BLOCK_SIZE, 2 * block_size))
+                if not data:
+                    eof = True
+                source_hash.update(data)
+                stats['size'] += len(data)
+                buf.extend(data)
+                continue
+            if len(buf) - pos < block_size:
+                break
+
+            if weak is None:
+                weak = zlib.adler32(buffer(buf, pos, block_size)) & \
+                       0xffffffffL
+            candidates = table.get(weak)
+            if candidates is not None:
+                index = candidates.get(
+                    hashlib.sha1(buffer(buf, pos, block_size)).digest())
+                if index is not None:
+                    if pos > lit:
+                        flush_literal(buf[lit:pos])
+                    if copy_run and copy_run[0] + copy_run[1] == index:
+                        copy_run[1] += 1
+                    else:
+                        flush_copy()
+                        copy_run[:] = [index, 1]
+                    pos += block_size
+                    lit = pos
+                    weak = None
+                    if len(out) > 64:
+                        yield ''.join(out), covered[0]
+                        del out[:]
+                        covered[0] = 0
+                    continue
+
+            if pos - lit >= DELTA_MAX_LITERAL:
+                flush_literal(buf[lit:pos])
+                lit = pos
+                yield ''.join(out), covered[0]
+                del out[:]
+                covered[0] = 0
+
+            # Roll the window on, one byte at a time, until its checksum is
+            # that of a base block, or the buffer or literal run ends.
+            end = min(len(buf) - block_size, lit + DELTA_MAX_LITERAL)
+            if pos == end:
+                # Last window of the file did not match.
+                break
+            a, b = weak & 0xffff, weak >> 16
+            while pos < end:
+                old, new = buf[pos], buf[pos + block_size]
+                a = (a - old + new) % 65521
+                b = (b - block_size * old + a - 1) % 65521
+                pos += 1
+                if (b << 16 | a) in table:
+                    break
+            weak = (b << 16) | a
+
+    if len(buf) > lit:
+        flush_literal(buf[lit:])
+    flush_copy()
+    yield ''.join(out), covered[0]
+
+
+def _new_file_mode(dst_path):
+    """Return the permissions a file written to dst_path should get.
+
+    Temporary files are created readable by the owner only.  The file that
+    replaces dst_path keeps the mode of the file it replaces, or else gets
+    the mode that open() would have given it under the current umask.
+
+    """
+    try:
+        return stat.S_IMODE(os.stat(dst_path).st_mode)
+    except OSError:
+        return 0666 & ~_UMASK
+
+
+def _preallocate(f, size):
+    """Reserve disk space for a file of the given size, if possible."""
+    if _fallocate is None or not size:
+        return
+    try:
+        _fallocate(f.fileno(), 0, size)
+    except (OSError, IOError):
+        # Not supported by the file system.
+        pass
+
+
+def _data_runs(view, offset):
+    """Yield (start, end) of each run of view that is not all zeros.
+
+    view is split into blocks of SPARSE_BLOCK_SIZE aligned on the file
+    offset, which is that of view[0], and runs are made of whole blocks.
+
+    """
+    n = len(view)
+    start = None
+    pos = 0
+    while pos < n:
+        end = min(n, pos + SPARSE_BLOCK_SIZE -
+                  (offset + pos) % SPARSE_BLOCK_SIZE)
+        if view[pos:end] == _ZERO_BLOCK[:end - pos]:
+            if start is not None:
+                yield start, pos
+                start = None
+        elif start is None:
+            start = pos
+        pos = end
+    if start is not None:
+        yield start, n
+
+
+class _SparseWriter(object):
+
+    """
+    File-like writer that leaves holes for blocks of zeros.
+
+    Data is written to f from its current position, except for blocks of
+    zeros, as found by _data_runs(), which are skipped by seeking past them.
+    f must hold no data past its position, so that the skipped bytes read as
+    zeros.  flush() extends the file to the end of the data written, in case
+    the data ended with zeros.
+
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._pos = self._fpos = f.tell()
+
+    def write(self, data):
+        view = memoryview(data)
+        for start, end in _data_runs(view, self._pos):
+            if self._fpos != self._pos + start:
+                self._f.seek(self._pos + start)
+            self._f.write(view[start:end])
+            self._fpos = self._pos + end
+        self._pos += len(view)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        self._f.flush()
+        if self._fpos < self._pos:
+            self._f.truncate(self._pos)
+
+
+def _new_decompressor(fmt):
+    if fmt == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if fmt == 'bz2':
+        return bz2.BZ2Decompressor()
+    if fmt == 'xz':
+        if lzma is None:
+            raise RuntimeError('xz decompression needs the lzma module '
+                               '(backports.lzma on Python 2)')
+        return lzma.LZMADecompressor()
+    return None
+
+
+class _DecompressWriter(object):
+
+    """
+    File-like writer that decompresses data on its own thread.
+
+    Data given to write() is queued, and a thread decompresses it and writes
+    the result to the file, so decompression runs while the next data is
+    received.  The format is chosen by is_compressed() from the magic bytes
+    at the start of the data: gzip, including the multi-member files made by
+    compress(), bz2 or xz.  Data in any other format is written as it is.
+    close() waits for the thread and raises any error it had.  The time taken
+    is recorded as the decompress phase of metrics.
+
+    """
+
+    def __init__(self, f, metrics=None, depth=PIPELINE_DEPTH):
+        self.format = None
+        self._f = f
+        self._metrics = TransferMetrics() if metrics is None else metrics
+        self._queue = Queue.Queue(depth)
+        self._decompressor = None
+        self._head = ''
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        if isinstance(data, memoryview):
+            # Buffer is reused once it has been hashed.
+            data = data.tobytes()
+        self._queue.put(data)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def _decompress(self, data):
+        # Each gzip member, or bz2 or xz stream, needs a new decompressor.
+        out = []
+        while data:
+            try:
+                out.append(self._decompressor.decompress(data))
+            except EOFError:
+                # Last stream ended exactly at the end of the last data.
+                self._decompressor = _new_decompressor(self.format)
+                continue
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = _new_decompressor(self.format)
+        return ''.join(out)
+
+    def _write(self, data):
+        # Decompress and write data, or None at the end of the data.
+        if self.format is None:
+            # Wait for enough data to recognize the format.
+            if data is not None:
+                self._head += data
+                if len(self._head) < 6:
+                    return
+            data, self._head = self._head, ''
+            self.format = is_compressed(data) or 'none'
+            self._decompressor = _new_decompressor(self.format)
+        elif data is None:
+            return
+        if self._decompressor is not None:
+            data = self._decompress(data)
+        self._f.write(data)
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if self._error is None:
+                try:
+                    with self._metrics.phase('decompress'):
+                        self._write(data)
+                except Exception as e:
+                    self._error = e
+            if data is None:
+                return
+
 
+def decompressed_path(file_path):
+    """Return file_path without its .gz, .bz2 or .xz extension, if any."""
+    root, ext = os.path.splitext(file_path)
+    if ext in CODEC_EXTENSIONS.values():
+        return root
+    return file_path
+
+
+def _recv_file(dst_path, host, port, expected_size=None, timeout=30,
+               tmp_path=None, journal=None, resume=None, preallocate=None,
+               chunk_size=CHUNK_SIZE, sock_buf=None, metrics=None,
+               limiters=None, hash_algorithm='sha1', decompress=False,
+               sparse=False):
+    """Receive a file from the server and move it to dst_path.
+
+    The file is received into a temporary file in the same directory as
+    dst_path, so that it can be renamed to dst_path atomically when done.  If
+    preallocate is given, that much disk space is reserved for the file
+    before receiving.  With sparse, blocks of zeros are written as holes by a
+    _SparseWriter.
+
+    For a resumable download, tmp_path is the partial file to continue,
+    journal is its TransferJournal, and resume is the (offset, hash) returned
+    by TransferJournal.resume() for the data already in tmp_path.  If the
+    download fails, the partial file is kept so that it can be resumed.
+    Otherwise the data is hashed with hash_algorithm.
+
+    The data is hashed on a HashWorker thread while more is received.  With
+    decompress, the data is also decompressed on a _DecompressWriter thread,
+    and the decompressed data is written to dst_path.  The size and hash
+    returned are still those of the data received.
+
+    Connect and receive times, and hashing, are recorded in metrics.  The
+    receive rate is kept within the limits of limiters, a list of RateLimiter.
 
-def _recv_file(dst_path, host, port, expected_size=None, timeout=30):
-    conn = _make_connection(host, port, timeout)
+    """
+    if metrics is None:
+        metrics = TransferMetrics()
+    with metrics.phase('connect'):
+        conn = _make_connection(host, port, timeout, sock_buf)
 
-    # Create temporary file name.
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        tmp_path = os.tempnam()
+    # Create temporary file in destination directory.
+    if tmp_path is None:
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                prefix='.%s.' % (os.path.basename(dst_path),),
+                suffix='.part', dir=os.path.dirname(dst_path) or '.')
+        except Exception:
+            conn.close()
+            raise
+        os.close(fd)
+
+    if resume is not None:
+        offset, h = resume
+    else:
+        offset, h = 0, new_hash(hash_algorithm)
 
     if expected_size:
         progress_bar = ProgressBar(long(expected_size))
+        progress_bar.update(offset)
     else:
         progress_bar = None
 
     error = None
     filesize = digest = None
+    hasher = HashWorker(h, chunk_size, metrics=metrics)
     try:
-        with open(tmp_path, "wb") as f:
-            h = hashlib.sha1()
-            buff = bytearray(CHUNK_SIZE)
-            while True:
-                try:
-                    recv_bytes = conn.recv_into(buff)
-                except Exception as e:
-                    if str(e).startswith('[Errno 35]'):
-                        time.sleep(0)
-                        continue
-                    raise e
-                if not recv_bytes:
-                    break
-                if progress_bar is not None:
-                    progress_bar.update(recv_bytes)
-                if recv_bytes < CHUNK_SIZE:
-                    b = buff[:recv_bytes]
-                    h.update(b)
-                    f.write(b)
-                else:
-                    h.update(buff)
-                    f.write(buff)
-            f.flush()
-            filesize = f.tell()
-            digest = h.hexdigest()
+        with open(tmp_path, "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            f.truncate()
+            _preallocate(f, preallocate)
+            writer = _SparseWriter(f) if sparse else f
+            out = _DecompressWriter(writer, metrics) if decompress else writer
+            job = _RecvJob(conn, out, timeout, hasher, progress_bar, journal,
+                           metrics, limiters)
+            loop = TransferLoop()
+            loop.add(job)
+            try:
+                with metrics.phase('recv'):
+                    loop.run()
+            finally:
+                if decompress:
+                    out.close()
+            if job.error is not None:
+                raise job.error
+            writer.flush()
+            filesize = job.received if decompress else writer.tell()
+            # Drop any preallocated space that was not used.
+            f.truncate(writer.tell())
+            digest = hasher.hexdigest()
         #print 'finished receiving file %s from %s:%s'\
         #      % (tmp_path, self._peer_addr, self._peer_port)
     except socket.timeout:
@@ -313,32 +3264,128 @@ def _recv_file(dst_path, host, port, expected_size=None, timeout=30):
         error = str(e)
     finally:
         conn.close()
+        hasher.close()
 
-    if not filesize:
+    if not error and not filesize:
         error = 'did not receive any data from %s:%s' % (host, port)
 
     if error:
+        if journal is not None:
+            return False, error + ' (partial download kept for resume)'
         try:
             os.unlink(tmp_path)
         except:
             pass
         return False, error
 
-    if os.path.isfile(dst_path):
+    # Rename replaces an existing file atomically, except on Windows.
+    os.chmod(tmp_path, _new_file_mode(dst_path))
+    if os.name == 'nt' and os.path.isfile(dst_path):
         os.unlink(dst_path)
+    os.rename(tmp_path, dst_path)
+
+    if progress_bar is not None:
+        progress_bar.finish()
+
+    return True, {'size': filesize, 'hash': digest}
+
+def _recv_file_striped(dst_path, host, stripes, file_size,
+                       expected_size=None, timeout=30, chunk_size=CHUNK_SIZE,
+                       sock_buf=None, metrics=None, limiters=None,
+                       hash_algorithm='sha1', sparse=False):
+    """Receive a file as several byte ranges over parallel connections.
+
+    The file is received into a temporary file in the same directory as
+    dst_path, which is preallocated to the full size, unless sparse, and each
+    range is written straight to its offset.  All connections are driven by a
+    single TransferLoop.  When every range is complete, the whole file is
+    hashed and renamed to dst_path.
+
+    Arguments:
+    dst_path  -- Path to save the file as.
+    host      -- Server to connect to.
+    stripes   -- List of (port, offset, length) for each range, as returned
+                 by the server's download_striped() call.
+    file_size -- Size of the file.
+    expected_size -- Optional.  Size to show a ProgressBar for.
+
+    The other arguments are the same as for _recv_file().
 
+    Return:
+    Same as _recv_file().
+
+    """
+    if metrics is None:
+        metrics = TransferMetrics()
+    fd, tmp_path = tempfile.mkstemp(
+        prefix='.%s.' % (os.path.basename(dst_path),), suffix='.part',
+        dir=os.path.dirname(dst_path) or '.')
+    progress_bar = None
+    if expected_size:
+        progress_bar = ProgressBar(long(expected_size))
+
+    errors = []
+    jobs = []
+    digest = None
+    loop = TransferLoop()
     try:
-        os.rename(tmp_path, dst_path)
-    except OSError:
-        # Some file systems do not allow rename across different partitions.
-        import shutil
-        shutil.copyfile(tmp_path, dst_path)
-        os.unlink(tmp_path)
+        with os.fdopen(fd, 'r+b') as f:
+            if not sparse:
+                _preallocate(f, file_size)
+            f.truncate(file_size)
+            for port, offset, length in stripes:
+                offset, length = long(offset), long(length)
+                try:
+                    with metrics.phase('connect'):
+                        conn = _make_connection(host, port, timeout,
+                                                sock_buf)
+                except Exception as ex:
+                    errors.append('range at offset %d: %s' % (offset, ex))
+                    continue
+                job = _RangeRecvJob(conn, tmp_path, f.fileno(), offset,
+                                    length, timeout, chunk_size,
+                                    progress_bar, metrics, limiters, sparse)
+                jobs.append(job)
+                loop.add(job)
+            with metrics.phase('recv'):
+                loop.run()
+
+            for job in jobs:
+                # Flush what was written through a file object.
+                job.close()
+                if job.error is not None:
+                    errors.append('range at offset %d: %s' %
+                                  (job.offset, job.error))
+                elif job.received != job.length:
+                    errors.append('range at offset %d: received %d of %d '
+                                  'bytes' % (job.offset, job.received,
+                                             job.length))
+            if not errors:
+                with metrics.phase('hash'):
+                    digest = _file_digest(f, file_size, hash_algorithm)
+    except Exception as ex:
+        errors.append(str(ex))
+    finally:
+        for job in jobs:
+            job.close()
+
+    if errors:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        return False, 'Error transferring file: ' + '; '.join(errors)
+
+    os.chmod(tmp_path, _new_file_mode(dst_path))
+    if os.name == 'nt' and os.path.isfile(dst_path):
+        os.unlink(dst_path)
+    os.rename(tmp_path, dst_path)
 
     if progress_bar is not None:
         progress_bar.finish()
 
-    return True, {'size': filesize, 'hash': digest}
+    return True, {'size': file_size, 'hash': digest}
+
 
 def _check_file(file_path):
     """Validate that the file exists and the given extension will work with
@@ -360,8 +3407,171 @@ def _check_file(file_path):
 
     return None
 
+def _server_call(metrics, qms_url, method, *args):
+    """Call a method of the QManager server for a transfer.  If the call
+    fails, finish the transfer's metrics record with the error and raise
+    RuntimeError."""
+    try:
+        return method(*args)
+    except Exception as e:
+        metrics.finish(e)
+        raise RuntimeError('unable to contact QManager (%s): %s' %
+                           (qms_url, e))
+
+
+def _server_capabilities(qms):
+    """Return the set of optional transfer features the server supports."""
+    try:
+        server_info = qms.get_server_info()
+    except Exception:
+        return frozenset()
+    return frozenset(server_info.get('capabilities', ()))
+
+
+class TransferConfirmation(object):
+
+    """
+    Handle for the server's confirmation of a finished transfer.
+
+    After the data is sent, the server still checks the size and hash of what
+    it received.  A background thread polls the server for the result, first
+    at CONFIRM_FIRST_INTERVAL and then backing off to CONFIRM_MAX_INTERVAL,
+    and gives up after the timeout.  The caller is free to start another
+    transfer in the meantime.
+
+    When the server answers, on_result(status, message) is called on the
+    polling thread.  It raises RuntimeError if the transfer failed.  The time
+    spent waiting is recorded as the confirm phase of the transfer's
+    TransferMetrics, which is then finished.
+
+    """
+
+    def __init__(self, qms_url, method, args, on_result, timeout=None,
+                 metrics=None):
+        self.qms_url = qms_url
+        self.metrics = TransferMetrics() if metrics is None else metrics
+        self.polls = 0
+        self._method = method
+        self._args = args
+        self._on_result = on_result
+        self._timeout = CONFIRM_TIMEOUT if timeout is None else timeout
+        self._error = None
+        self._done = threading.Event()
+        th = threading.Thread(target=self._poll)
+        th.daemon = True
+        th.start()
+
+    def _poll(self):
+        # Use a separate proxy, since proxies are not thread-safe.
+        qms = xmlrpclib.ServerProxy(self.qms_url)
+        start = time.time()
+        deadline = start + self._timeout
+        interval = CONFIRM_FIRST_INTERVAL
+        try:
+            while True:
+                result_data = getattr(qms, self._method)(*self._args)
+                self.polls += 1
+                if result_data:
+                    break
+                if time.time() + interval > deadline:
+                    raise RuntimeError('timed out waiting for qmanager to '
+                                       'confirm transfer')
+                # Sleep, because other end may still be processing file.
+                time.sleep(interval)
+                interval = min(interval * 2, CONFIRM_MAX_INTERVAL)
+            self._on_result(*result_data)
+        except RuntimeError as e:
+            self._error = e
+        except Exception as e:
+            self._error = RuntimeError('unable to confirm transfer with '
+                                       'QManager (%s): %s' % (self.qms_url, e))
+        finally:
+            self.metrics.add('confirm', time.time() - start)
+            try:
+                self.metrics.finish(self._error)
+            finally:
+                self._done.set()
+
+    def done(self):
+        """Return True if the confirmation has finished, without waiting."""
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the server to confirm the transfer.
+
+        Arguments:
+        timeout -- Optional.  Seconds to wait.  Default is to wait until the
+                   confirmation finishes.
+
+        Return:
+        True if confirmed, False if timeout expired first.  Raises
+        RuntimeError if the transfer failed.
+
+        """
+        if timeout is None:
+            # Wait in steps, so that KeyboardInterrupt is not blocked.
+            while not self._done.wait(CONFIRM_MAX_INTERVAL):
+                pass
+        elif not self._done.wait(timeout):
+            return False
+        if self._error is not None:
+            raise self._error
+        return True
+
+
+def _wait_confirmation(confirmation, quiet):
+    # Block until confirmed, showing progress unless quiet.
+    while not confirmation.wait(CONFIRM_MAX_INTERVAL):
+        if not quiet:
+            sys.stdout.write('.')
+            sys.stdout.flush()
+    if not quiet:
+        print
+
+
+def _log_codec_choice(decision, start_time, compressed_size, metrics):
+    """Record the actual outcome of a choose_codec() decision.
+
+    The decision gets an 'actual' dict of ratio, compress_time, transfer_time
+    and total_time, to compare with its 'predicted' one.  The time to compress
+    is that spent waiting for compressed data, and the time to transfer is
+    the send phase.  The total runs from the decision until the data is sent,
+    and excludes the server's confirmation.  The decision is stored as the
+    codec item of the metrics record, and appended as one line of JSON to
+    CODEC_LOG_PATH.
+
+    """
+    record = metrics.record
+    phases = record['phases']
+    file_size = decision['file_size']
+    decision['actual'] = {
+        'ratio': float(compressed_size) / file_size if file_size else 1.0,
+        'compress_time': phases.get('compress', {}).get('wall', 0.0),
+        'transfer_time': phases.get('send', {}).get('wall', 0.0),
+        'total_time': time.time() - start_time}
+    record['codec'] = decision
+
+    entry = dict(decision, time=time.time(), path=record['path'],
+                 server=record['server'])
+    try:
+        log_dir = os.path.dirname(CODEC_LOG_PATH)
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        with open(CODEC_LOG_PATH, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+    except (IOError, OSError):
+        pass
+
+
 def send_file_to_qmanager(user_name, file_path, shared,
-                          qmserver=DEFAULT_QM_SERVER, quiet=True):
+                          qmserver=DEFAULT_QM_SERVER, quiet=True,
+                          zero_copy=False, stripes=1, resume=False,
+                          stream_compress=False, digest_cache=True,
+                          dedupe=True, chunk_size=None, sock_buf=None,
+                          wait=True, confirm_timeout=None, metrics=None,
+                          rate_limit=None, hash_algorithm=None,
+                          codec='gzip', bandwidth=None, delta_base=None,
+                          verify_chunks=True, compress_cache=False):
     """Upload the specified file to the QManager server.
 
     The file is upload to the storage directory for the specified user.  To
@@ -390,81 +3600,780 @@ def send_file_to_qmanager(user_name, file_path, shared,
     qmserver  -- Optional.  QManager server DNS name or IP address.  Default
                  value is Calabasas QManager server.
     quiet     -- Optional.  Do not print output if True.
+    zero_copy -- Optional.  Send the file with the kernel sendfile() call and
+                 hash it from an mmap, instead of reading it in chunks.  Only
+                 used when quiet is True, since no progress is displayed.
+    stripes   -- Optional.  Number of parallel connections to send the file
+                 over.  Each connection carries one byte range of the file,
+                 and the server reassembles them.  Falls back to a single
+                 connection if the server does not support striped upload.
+    resume    -- Optional.  Make the upload resumable.  Progress is recorded
+                 in a journal under JOURNAL_DIR, and if a previous resumable
+                 upload of the same unchanged file was interrupted, it is
+                 continued from where the server left off.
+    stream_compress -- Optional.  If the file is not already compressed, then
+                 upload it compressed with codec, as file_name + '.gz' for
+                 gzip.  If the server supports it, compression runs while the
+                 compressed stream is hashed and sent, and no compressed file
+                 is written.  gzip compresses on COMPRESS_WORKERS threads.
+                 Otherwise the file is compressed to a temporary file that is
+                 removed after the upload.
+    digest_cache -- Optional.  Look up the file's SHA-1 in the DigestCache
+                 before sending, and only hash the file if it is not cached.
+    dedupe    -- Optional.  If the server already holds a file with the same
+                 content, as recorded in the UploadManifest or found by the
+                 server, then copy it into place on the server instead of
+                 uploading the file, or upload it if that fails.  Totals are
+                 kept in dedupe_stats.
+    chunk_size -- Optional.  Size of file reads and socket sends.  Default is
+                 chosen by tune_transfer().
+    sock_buf  -- Optional.  Socket send/receive buffer size.  Default is
+                 chosen by tune_transfer().
+    wait      -- Optional.  Wait for the server to confirm the upload.  If
+                 False, return a TransferConfirmation as soon as the data is
+                 sent, so that the next upload can start while this one is
+                 verified.
+    confirm_timeout -- Optional.  Seconds to wait for the server to confirm
+                 the upload.  Default is CONFIRM_TIMEOUT.
+    metrics   -- Optional.  TransferMetrics to record the upload in.  Its
+                 callback is given the record when the upload is confirmed or
+                 fails.  A returned TransferConfirmation has it as its metrics
+                 attribute.
+    rate_limit -- Optional.  Limit the upload to this many bytes per second,
+                 or to the rate of this RateLimiter, which can be changed
+                 during the upload.  The global_rate_limiter also applies.
+    hash_algorithm -- Optional.  Algorithm the server verifies the upload
+                 with.  Default is the first in HASH_ALGORITHMS that the
+                 server supports.  Resumable uploads always use SHA-1.
+    codec     -- Optional.  Codec stream_compress uses: 'gzip', 'bz2', 'xz',
+                 or 'none' to not compress.  'auto' lets choose_codec() pick
+                 the codec and level that upload the file in the least time;
+                 the choice, its prediction and the actual outcome are kept
+                 as the codec item of the metrics record and logged to
+                 CODEC_LOG_PATH.
+    bandwidth -- Optional.  Link bandwidth in Mbit/s, used to choose the
+                 codec and to tune the transfer.  Default is as for
+                 tune_transfer().
+    delta_base -- Optional.  Name of a file already on the server that the
+                 file is a changed copy of.  Only the blocks that differ from
+                 it are sent, with instructions for the server to copy the
+                 rest from delta_base, and the server verifies the hash of
+                 the file it rebuilds.  The file is not compressed, and one
+                 connection is used without resume.  The whole file is sent
+                 if the server does not support delta upload.
+    verify_chunks -- Optional.  If the server supports it, build a ChunkTree
+                 of the file on both sides as it is sent, and compare them
+                 while sending, so that only the chunks the server received
+                 wrong are sent again, instead of failing the whole upload.
+                 Used for uploads over one connection that are not resumed
+                 or streamed, and not with zero_copy.
+    compress_cache -- Optional.  When stream_compress compresses the file to
+                 a temporary file, reuse the compressed file kept by an
+                 earlier compress() of the unchanged file, if any, and keep
+                 it for the next upload.  Default is False.
 
     Return:
-    Nothing (None) if success.  Raises RuntimeError if error.
+    Nothing (None) if success, or a TransferConfirmation if wait is False and
+    data was sent.  Raises RuntimeError if error.
 
     """
     qms_url = 'http://%s:8080' % (qmserver,)
 
+    if metrics is None:
+        metrics = TransferMetrics()
+    record = metrics.record
+    record.update(direction='upload', server=qmserver, user=user_name)
+    source = not record['path']
+    if source:
+        # Keep the source file, if this is a compressed copy of it.
+        record['path'] = file_path
+    if not os.path.isfile(file_path):
+        metrics.finish('cannot find file: ' + file_path)
+        raise RuntimeError('cannot find file: ' + file_path)
+    if source:
+        record['bytes_in'] = os.path.getsize(file_path)
+
+    if codec not in CODEC_EXTENSIONS and codec not in ('auto', 'none'):
+        metrics.finish('unknown compression codec: %s' % (codec,))
+        raise RuntimeError('unknown compression codec: %s' % (codec,))
+    if delta_base or (stream_compress and not _needs_compress(file_path)):
+        stream_compress = False
+    decision = codec_level = None
+    if stream_compress:
+        # Server needs to know the size before the upload starts, unless it
+        # can take a stream.
+        streaming = (not resume and stripes == 1 and
+                     'stream_upload' in _server_capabilities(
+                         xmlrpclib.ServerProxy(qms_url)))
+        if codec == 'auto':
+            decision = choose_codec(file_path,
+                                    _link_bandwidth(qmserver, bandwidth),
+                                    COMPRESS_WORKERS, streaming)
+            codec, codec_level = decision['codec'], decision['level']
+            codec_start = time.time()
+            if not quiet:
+                print 'compressing with %s level %d, predicted upload time '\
+                      '%.1fs' % (codec, codec_level,
+                                 decision['predicted']['total_time'])
+        if codec == 'none':
+            stream_compress = False
+    if stream_compress and dedupe:
+        # The compressed stream is not known until the file is compressed, so
+        # look for an earlier upload of the same uncompressed file.
+        file_name = os.path.basename(file_path) + CODEC_EXTENSIONS[codec]
+        if shared:
+            file_name = SHARED_PREFIX + file_name
+        record['file'] = file_name
+        qms = xmlrpclib.ServerProxy(qms_url)
+        try:
+            with metrics.phase('dedupe'):
+                saved, _ = _place_duplicate(qms, frozenset(), qmserver,
+                                            user_name, file_path, file_name,
+                                            by_source=True)
+        except Exception as e:
+            metrics.finish(e)
+            raise RuntimeError('unable to contact QManager (%s): %s' %
+                               (qms_url, e))
+        if saved is not None:
+            if not quiet:
+                print 'file %s is already on qmanager, copied on server to '\
+                      '%s (%d bytes not sent)' % (file_path, file_name, saved)
+            record['deduplicated'] = saved
+            metrics.finish()
+            return
+    if stream_compress and not streaming:
+        # Compress to a temporary file first.  The data is sent before the
+        # server confirms it, so the file can be removed without waiting.
+        with metrics.phase('compress'):
+            comp_path = compress(file_path, COMPRESS_WORKERS,
+                                 compresslevel=codec_level, codec=codec,
+                                 use_cache=compress_cache)
+        try:
+            confirmation = send_file_to_qmanager(
+                user_name, comp_path, shared, qmserver, quiet, zero_copy,
+                stripes, resume, digest_cache=False, dedupe=dedupe,
+                chunk_size=chunk_size, sock_buf=sock_buf, wait=wait,
+                confirm_timeout=confirm_timeout, metrics=metrics,
+                rate_limit=rate_limit, hash_algorithm=hash_algorithm,
+                bandwidth=bandwidth)
+            if decision is not None:
+                _log_codec_choice(decision, codec_start,
+                                  os.path.getsize(comp_path), metrics)
+            return confirmation
+        finally:
+            os.unlink(comp_path)
+
     file_name = os.path.basename(file_path)
+    if stream_compress:
+        file_name += CODEC_EXTENSIONS[codec]
     if shared:
         file_name = SHARED_PREFIX + file_name
         storage_type = 'shared'
     else:
         storage_type = 'private'
+    record['file'] = file_name
 
     if not quiet:
         print 'User "%s" uploading %s file "%s" to QM server %s'\
               % (user_name, storage_type, file_path, qms_url)
 
     qms = xmlrpclib.ServerProxy(qms_url)
-    try:
-        qms.get_server_time()
-    except Exception as e:
-        raise RuntimeError('unable to contact QManager (%s): %s' %
-                           (qms_url, e))
+    _server_call(metrics, qms_url, qms.get_server_time)
 
     print_hash = False if quiet else True
 
+    capabilities = frozenset()
+    if (stripes > 1 or resume or dedupe or delta_base or verify_chunks or
+        hash_algorithm != 'sha1'):
+        capabilities = _server_capabilities(qms)
+    if delta_base:
+        if 'delta_upload' in capabilities:
+            resume = False
+            stripes = 1
+        else:
+            if not quiet:
+                print 'qmanager does not support delta upload, sending '\
+                      'whole file'
+            delta_base = None
+    if resume and 'resume' not in capabilities:
+        if not quiet:
+            print 'qmanager does not support resumable upload'
+        resume = False
+    if stripes > 1 and (resume or 'striped_upload' not in capabilities):
+        if not quiet:
+            print 'striped upload not available, using one connection'
+        stripes = 1
+    verify_chunks = (verify_chunks and not resume and not zero_copy and
+                     'chunk_verify' in capabilities)
+    try:
+        algorithm = 'sha1' if resume else _choose_hash(capabilities,
+                                                       hash_algorithm)
+    except (RuntimeError, ValueError) as e:
+        metrics.finish(e)
+        raise RuntimeError(str(e))
+    record['hash_algorithm'] = algorithm
+    # The server is only told the algorithm if it is not the default.
+    hash_args = () if algorithm == 'sha1' else (algorithm,)
+
+    # Look up the digest of an unchanged file before sending anything.
+    cache = file_stat = known_digest = None
+    if digest_cache and not stream_compress:
+        cache = _get_digest_cache()
+        if cache is not None:
+            file_stat = os.stat(file_path)
+            known_digest = cache.lookup(file_path, file_stat)
+
+    if dedupe and not stream_compress:
+        try:
+            with metrics.phase('dedupe'):
+                saved, known_digest = _place_duplicate(
+                    qms, capabilities, qmserver, user_name, file_path,
+                    file_name, known_digest=known_digest)
+        except Exception as e:
+            # Send the file instead.
+            if not quiet:
+                print 'unable to copy file on qmanager, sending it:', e
+            saved = None
+        if saved is not None:
+            if not quiet:
+                print 'file %s is already on qmanager, copied on server to '\
+                      '%s (%d bytes not sent)' % (file_path, file_name, saved)
+            record['deduplicated'] = saved
+            metrics.finish()
+            return
+
+    chunk_size, sock_buf = tune_transfer(qmserver, chunk_size, sock_buf,
+                                         bandwidth)
+    limiters = _rate_limiters(rate_limit)
+    start_time = time.time()
+
+    # Cached and dedupe digests are SHA-1.
+    send_digest = known_digest if algorithm == 'sha1' else None
+
     # Tell QManager to get ready to receive the file.
     #my_ip = socket.gethostbyaddr(socket.gethostname())[-1][0]
-    fetch_id, server_port = qms.upload(
-        user_name, file_name, str(os.path.getsize(file_path)))
+    if delta_base:
+        block_size = _power_of_two(
+            os.path.getsize(file_path) / DELTA_MAX_BLOCKS,
+            DELTA_MIN_BLOCK_SIZE, DELTA_MAX_BLOCK_SIZE)
+        try:
+            with metrics.phase('delta'):
+                signature = qms.delta_signature(user_name, delta_base,
+                                                block_size).data
+        except Exception as e:
+            metrics.finish(e)
+            raise RuntimeError('unable to get signature of %s: %s' %
+                               (delta_base, e))
+        fetch_id, server_port = _server_call(
+            metrics, qms_url, qms.upload_delta, user_name, file_name,
+            delta_base, block_size, *hash_args)
 
-    if not quiet:
-        print 'sending %s file (%s) to qmanager on port %s'\
-              % (storage_type, file_path, server_port)
+        if not quiet:
+            print 'sending differences of %s file (%s) from %s to qmanager '\
+                  'on port %s' % (storage_type, file_path, delta_base,
+                                  server_port)
+
+        progress_bar = None
+        if print_hash:
+            progress_bar = ProgressBar(os.path.getsize(file_path))
+        file_hash = new_hash(algorithm)
+        delta = {'base': delta_base}
+        chunks = _delta_stream(file_path, signature, block_size, file_hash,
+                               delta)
+        status, results = _send_stream(_background(chunks), qmserver,
+                                       server_port, progress_bar,
+                                       sock_buf=sock_buf, metrics=metrics,
+                                       limiters=limiters,
+                                       hash_algorithm=algorithm,
+                                       wait_phase='delta')
+        if status:
+            # Server checks the file it rebuilds, not the delta.
+            results = {'size': delta['size'], 'hash': file_hash.hexdigest()}
+            record['delta'] = delta
+            if not quiet:
+                print 'sent %d literal bytes, copied %d bytes on server' % (
+                    delta['literal'], delta['copied'])
+    elif stream_compress:
+        fetch_id, server_port = _server_call(
+            metrics, qms_url, qms.upload_stream, user_name, file_name,
+            *hash_args)
+
+        if not quiet:
+            print 'compressing and sending %s file (%s) to qmanager on port '\
+                  '%s' % (storage_type, file_path, server_port)
+
+        progress_bar = None
+        if print_hash:
+            progress_bar = ProgressBar(os.path.getsize(file_path))
+        source_stat = os.stat(file_path)
+        source_hash = hashlib.sha1()
+        chunks = _compress_stream(file_path, codec, codec_level,
+                                  COMPRESS_WORKERS, source_hash=source_hash)
+        status, results = _send_stream(_background(chunks), qmserver,
+                                       server_port, progress_bar,
+                                       sock_buf=sock_buf, metrics=metrics,
+                                       limiters=limiters,
+                                       hash_algorithm=algorithm)
+    elif stripes > 1:
+        fetch_id, stripe_info = _server_call(
+            metrics, qms_url, qms.upload_striped, user_name, file_name,
+            str(os.path.getsize(file_path)), stripes, *hash_args)
 
-    # Send the image file to the server.
-    status, results = _send_file(file_path, qmserver, server_port, print_hash)
+        if not quiet:
+            print 'sending %s file (%s) to qmanager over %d connections'\
+                  % (storage_type, file_path, len(stripe_info))
+
+        status, results = _send_file_striped(file_path, qmserver,
+                                             stripe_info,
+                                             known_digest=send_digest,
+                                             metrics=metrics,
+                                             limiters=limiters,
+                                             hash_algorithm=algorithm,
+                                             chunk_size=chunk_size,
+                                             sock_buf=sock_buf)
+    else:
+        journal = tree = verifier = None
+        offset = 0
+        server_port = None
+        if resume:
+            identity = _file_identity(file_path)
+            journal = TransferJournal.load('upload', qmserver, user_name,
+                                           file_name, file_path)
+            if journal is not None and journal.record['identity'] == identity:
+                resume_info = _server_call(metrics, qms_url,
+                                           qms.resume_upload,
+                                           journal.record['fetch_id'])
+                if resume_info:
+                    fetch_id = journal.record['fetch_id']
+                    server_port, offset = resume_info[0], long(resume_info[1])
+            if server_port is None:
+                fetch_id, server_port = _server_call(
+                    metrics, qms_url, qms.upload_resumable, user_name,
+                    file_name, str(identity['size']))
+                journal = TransferJournal.create(
+                    'upload', qmserver, user_name, file_name, file_path,
+                    fetch_id, identity)
+        elif verify_chunks:
+            fetch_id, server_port = _server_call(
+                metrics, qms_url, qms.upload_verified, user_name, file_name,
+                str(os.path.getsize(file_path)), VERIFY_CHUNK_SIZE,
+                *hash_args)
+            tree = ChunkTree(VERIFY_CHUNK_SIZE, algorithm,
+                             new_hash(algorithm))
+            verifier = _ChunkVerifier(qms_url, fetch_id, tree)
+        else:
+            fetch_id, server_port = _server_call(
+                metrics, qms_url, qms.upload, user_name, file_name,
+                str(os.path.getsize(file_path)), *hash_args)
+
+        if not quiet:
+            if offset:
+                print 'resuming upload of %s file (%s) at byte %d on port %s'\
+                      % (storage_type, file_path, offset, server_port)
+            else:
+                print 'sending %s file (%s) to qmanager on port %s'\
+                      % (storage_type, file_path, server_port)
+
+        # Send the image file to the server.
+        status, results = _send_file(file_path, qmserver, server_port,
+                                     print_hash, zero_copy=zero_copy,
+                                     journal=journal, offset=offset,
+                                     known_digest=send_digest,
+                                     chunk_size=chunk_size, sock_buf=sock_buf,
+                                     metrics=metrics, limiters=limiters,
+                                     hash_algorithm=algorithm, tree=tree)
+        if verifier is not None:
+            if status:
+                with metrics.phase('verify'):
+                    status, resent = _repair_upload(
+                        qms, qmserver, fetch_id, file_path, verifier,
+                        VERIFY_CHUNK_SIZE, quiet,
+                        confirm_timeout or CONFIRM_TIMEOUT, sock_buf,
+                        metrics, limiters, chunk_size)
+                if status:
+                    record['resent'] = resent
+                else:
+                    results = resent
+            else:
+                verifier.stop()
+        if journal is not None:
+            if status:
+                journal.remove()
+            elif offset and results.startswith('file changed'):
+                journal.remove()
+            else:
+                results += ' (upload can be resumed)'
 
     # Check the results from sending the file.
     if not status:
+        metrics.finish(results)
         raise RuntimeError('failed to upload %s file: %s' %
                            (storage_type, results,))
 
+    if cache is not None and known_digest is None and algorithm == 'sha1':
+        cache.store(file_path, results['hash'], file_stat)
+    if decision is not None:
+        _log_codec_choice(decision, codec_start, results['size'], metrics)
+
+    elapsed = time.time() - start_time
+    if elapsed > 1 and not delta_base:
+        _link_throughput[qmserver] = results['size'] / elapsed
+
     my_fsize = results['size']
     my_fhash = results['hash']
+    if record['bytes_in'] != my_fsize:
+        record['compression_ratio'] = float(record['bytes_in']) / my_fsize
+    # The manifest records SHA-1 digests, when known.
+    manifest_hash = my_fhash if algorithm == 'sha1' else known_digest
+
+    if stream_compress or delta_base:
+        # Server did not know the size in advance.
+        args = (fetch_id, my_fhash, str(my_fsize))
+    else:
+        args = (fetch_id, my_fhash)
+
+    def on_result(status, qms_results):
+        if not status:
+            raise RuntimeError('qmanager failed to get %s file: %s' %
+                               (storage_type, qms_results))
+
+        # Record what the server now holds, so the same content is not sent
+        # again.
+        if stream_compress:
+            source_digest = source_hash.hexdigest()
+            _record_transfer(qmserver, user_name, file_name, my_fsize,
+                             manifest_hash, source_stat.st_size,
+                             source_digest)
+            cache = _get_digest_cache()
+            if cache is not None:
+                cache.store(file_path, source_digest, source_stat)
+        else:
+            _record_transfer(qmserver, user_name, file_name, my_fsize,
+                             manifest_hash)
+
+    confirmation = TransferConfirmation(qms_url, 'get_transfer_results', args,
+                                        on_result, confirm_timeout, metrics)
+    if not wait:
+        return confirmation
 
-    result_data = None
     if not quiet:
         print 'waiting to confirm upload',
-    while True:
-        result_data = qms.get_transfer_results(fetch_id, my_fhash)
-        if result_data:
-            break
-        if not quiet:
-            sys.stdout.write('.')
-            sys.stdout.flush()
-        # Sleep, because other end may still be processing file.
-        time.sleep(3)
+    _wait_confirmation(confirmation, quiet)
 
     if not quiet:
-        print
+        print 'successfully sent %s file (%s) to qmanager' % (
+            storage_type, file_path)
 
-    status, qms_results = result_data
-    if not status:
-        raise RuntimeError('qmanager failed to get %s file: %s' %
-                           (storage_type, qms_results))
+
+def send_file_to_qmanagers(user_name, file_path, shared, qmservers,
+                           quiet=True, stream_compress=False, codec='gzip',
+                           digest_cache=True, dedupe=True, chunk_size=None,
+                           sock_buf=None, confirm_timeout=None,
+                           metrics_callback=None, rate_limit=None,
+                           hash_algorithm=None, bandwidth=None,
+                           compress_cache=False):
+    """Upload a file to several QManager servers at once, reading it once.
+
+    The file is read, and compressed if stream_compress, only once, and the
+    data is sent to all of the servers at the same time, over one connection
+    to each.  Each server is sent the data at the pace of its own link, so a
+    slow server does not hold up the others.  Data that a server has not
+    been sent yet is read again from the page cache or, when the file is
+    compressed as it is sent, from a temporary spool file next to it.
+
+    Each server checks and confirms its upload separately, as with
+    send_file_to_qmanager(), and an upload that fails does not stop the
+    others.  Uploads are sent over one connection, and are not resumable,
+    delta encoded or verified by chunks.
+
+    Arguments:
+    qmservers -- List of QManager server DNS names or IP addresses.
+    stream_compress -- Optional.  If the file is not already compressed, then
+                 upload it compressed with codec.  If all of the servers
+                 support it, the data is sent as it is compressed.  Otherwise
+                 the file is compressed with compress() first.
+    codec     -- Optional.  'gzip', 'bz2', 'xz', or 'none' to not compress.
+                 'auto' lets choose_codec() pick for the slowest link.
+    metrics_callback -- Optional.  Callback of the TransferMetrics that the
+                 upload to each server is recorded in.
+
+    The other arguments are the same as for send_file_to_qmanager().
+
+    Return:
+    Dict of server to None if the upload to it succeeded, or to the error
+    message if it failed.  Raises RuntimeError if codec is unknown.
+
+    """
+    if codec not in CODEC_EXTENSIONS and codec not in ('auto', 'none'):
+        raise RuntimeError('unknown compression codec: %s' % (codec,))
+    if stream_compress and not _needs_compress(file_path):
+        stream_compress = False
+
+    file_size = os.path.getsize(file_path)
+    results = {}
+    uploads = []
+
+    def fail(upload, error):
+        upload['metrics'].finish(error)
+        results[upload['server']] = str(error)
+        uploads.remove(upload)
+
+    for qmserver in qmservers:
+        if qmserver in results:
+            continue
+        results[qmserver] = None
+        metrics = TransferMetrics(metrics_callback)
+        metrics.record.update(direction='upload', server=qmserver,
+                              user=user_name, path=file_path,
+                              bytes_in=file_size)
+        upload = {'server': qmserver, 'url': 'http://%s:8080' % (qmserver,),
+                  'metrics': metrics, 'error': None}
+        uploads.append(upload)
+        upload['qms'] = xmlrpclib.ServerProxy(upload['url'])
+        try:
+            upload['qms'].get_server_time()
+            upload['capabilities'] = _server_capabilities(upload['qms'])
+        except Exception as e:
+            fail(upload, 'unable to contact QManager (%s): %s' %
+                 (upload['url'], e))
+            continue
+        try:
+            upload['algorithm'] = _choose_hash(upload['capabilities'],
+                                               hash_algorithm)
+        except (RuntimeError, ValueError) as e:
+            fail(upload, e)
+            continue
+        metrics.record['hash_algorithm'] = upload['algorithm']
+
+    if not uploads:
+        return results
+
+    codec_level = None
+    if stream_compress:
+        streaming = all('stream_upload' in upload['capabilities']
+                        for upload in uploads)
+        if codec == 'auto':
+            decision = choose_codec(
+                file_path, min(_link_bandwidth(upload['server'], bandwidth)
+                               for upload in uploads),
+                COMPRESS_WORKERS, streaming)
+            codec, codec_level = decision['codec'], decision['level']
+            for upload in uploads:
+                upload['metrics'].record['codec'] = decision
+            if not quiet:
+                print 'compressing with %s level %d' % (codec, codec_level)
+        if codec == 'none':
+            stream_compress = False
+
+    file_name = os.path.basename(file_path)
+    if stream_compress:
+        file_name += CODEC_EXTENSIONS[codec]
+    if shared:
+        file_name = SHARED_PREFIX + file_name
+        storage_type = 'shared'
+    else:
+        storage_type = 'private'
+    for upload in uploads:
+        upload['metrics'].record['file'] = file_name
 
     if not quiet:
-        print 'successfully sent %s file (%s) to qmanager' % (
-            storage_type, file_path)
+        print 'User "%s" uploading %s file "%s" to QM servers %s'\
+              % (user_name, storage_type, file_path,
+                 ', '.join(upload['server'] for upload in uploads))
+
+    cache = file_stat = known_digest = None
+    if digest_cache and not stream_compress:
+        cache = _get_digest_cache()
+        if cache is not None:
+            file_stat = os.stat(file_path)
+            known_digest = cache.lookup(file_path, file_stat)
+
+    if dedupe:
+        # A compressed upload is matched by its uncompressed source.
+        for upload in list(uploads):
+            metrics = upload['metrics']
+            capabilities = frozenset()
+            if not stream_compress:
+                capabilities = upload['capabilities']
+            try:
+                with metrics.phase('dedupe'):
+                    saved, digest = _place_duplicate(
+                        upload['qms'], capabilities, upload['server'],
+                        user_name, file_path, file_name,
+                        by_source=stream_compress, known_digest=known_digest)
+            except Exception as e:
+                fail(upload, 'unable to contact QManager (%s): %s' %
+                     (upload['url'], e))
+                continue
+            if not stream_compress:
+                known_digest = digest
+            if saved is not None:
+                if not quiet:
+                    print 'file %s is already on qmanager %s, copied on '\
+                          'server to %s (%d bytes not sent)' % (
+                              file_path, upload['server'], file_name, saved)
+                metrics.record['deduplicated'] = saved
+                metrics.finish()
+                uploads.remove(upload)
+        if not uploads:
+            return results
+
+    limiters = _rate_limiters(rate_limit)
+    comp_path = spool_path = None
+    try:
+        send_path = file_path
+        if stream_compress and not streaming:
+            wall, cpu = time.time(), _cpu_time()
+            comp_path = compress(file_path, COMPRESS_WORKERS,
+                                 compresslevel=codec_level, codec=codec,
+                                 use_cache=compress_cache)
+            wall, cpu = time.time() - wall, _cpu_time() - cpu
+            for upload in uploads:
+                upload['metrics'].add('compress', wall, cpu)
+            send_path = comp_path
+            streaming = stream_compress = False
+
+        # Tell each QManager to get ready to receive the file.
+        send_size = str(os.path.getsize(send_path))
+        for upload in list(uploads):
+            algorithm = upload['algorithm']
+            hash_args = () if algorithm == 'sha1' else (algorithm,)
+            upload['chunk_size'], upload['sock_buf'] = tune_transfer(
+                upload['server'], chunk_size, sock_buf, bandwidth)
+            try:
+                if stream_compress:
+                    upload['fetch_id'], upload['port'] = \
+                        upload['qms'].upload_stream(user_name, file_name,
+                                                    *hash_args)
+                else:
+                    upload['fetch_id'], upload['port'] = \
+                        upload['qms'].upload(user_name, file_name,
+                                             send_size, *hash_args)
+            except Exception as e:
+                fail(upload, 'unable to contact QManager (%s): %s' %
+                     (upload['url'], e))
+        if not uploads:
+            return results
+
+        algorithms = set(upload['algorithm'] for upload in uploads)
+        read_size = max(upload['chunk_size'] for upload in uploads)
+        if stream_compress:
+            fd, spool_path = tempfile.mkstemp(
+                prefix='.%s.' % (os.path.basename(file_path),),
+                suffix='.tee', dir=os.path.dirname(os.path.abspath(file_path)))
+            source_stat = os.stat(file_path)
+            source_hash = hashlib.sha1()
+            chunks = (data for data, _ in _compress_stream(
+                file_path, codec, codec_level, COMPRESS_WORKERS,
+                source_hash=source_hash))
+            tee = _TeeSource(spool_path, chunks, algorithms,
+                             os.fdopen(fd, 'wb'))
+            wait_phase = 'compress'
+        else:
+            tee = _TeeSource(send_path, _file_chunks(send_path, read_size),
+                             algorithms)
+            wait_phase = 'hash'
+
+        if not quiet:
+            print 'sending %s file (%s) to %d qmanager(s)' % (
+                storage_type, file_path, len(uploads))
+
+        def send_one(upload):
+            qmserver = upload['server']
+            metrics = upload['metrics']
+            record = metrics.record
+            start_time = time.time()
+            status, send_results = _send_tee(
+                tee, qmserver, upload['port'],
+                chunk_size=upload['chunk_size'], sock_buf=upload['sock_buf'],
+                metrics=metrics, limiters=limiters,
+                hash_algorithm=upload['algorithm'], wait_phase=wait_phase)
+            if not status:
+                upload['error'] = 'failed to upload %s file: %s' % (
+                    storage_type, send_results)
+                metrics.finish(upload['error'])
+                return
+
+            elapsed = time.time() - start_time
+            if elapsed > 1:
+                _link_throughput[qmserver] = send_results['size'] / elapsed
+            my_fsize = send_results['size']
+            my_fhash = send_results['hash']
+            if record['bytes_in'] != my_fsize:
+                record['compression_ratio'] = \
+                    float(record['bytes_in']) / my_fsize
+            manifest_hash = my_fhash if upload['algorithm'] == 'sha1' \
+                            else None
+            if stream_compress:
+                args = (upload['fetch_id'], my_fhash, str(my_fsize))
+            else:
+                args = (upload['fetch_id'], my_fhash)
+
+            def on_result(status, qms_results):
+                if not status:
+                    raise RuntimeError('qmanager failed to get %s file: %s' %
+                                       (storage_type, qms_results))
+                if stream_compress:
+                    _record_transfer(qmserver, user_name, file_name,
+                                     my_fsize, manifest_hash,
+                                     source_stat.st_size,
+                                     source_hash.hexdigest())
+                else:
+                    _record_transfer(qmserver, user_name, file_name,
+                                     my_fsize, manifest_hash or known_digest)
+
+            confirmation = TransferConfirmation(
+                upload['url'], 'get_transfer_results', args, on_result,
+                confirm_timeout, metrics)
+            try:
+                confirmation.wait()
+            except RuntimeError as e:
+                upload['error'] = str(e)
+
+        threads = []
+        for upload in uploads:
+            th = threading.Thread(target=send_one, args=(upload,))
+            th.daemon = True
+            th.start()
+            threads.append(th)
+        for th in threads:
+            # Wait in steps, so that KeyboardInterrupt is not blocked.
+            while th.is_alive():
+                th.join(CONFIRM_MAX_INTERVAL)
+    finally:
+        for path in (spool_path, comp_path):
+            if path is not None:
+                os.unlink(path)
+
+    for upload in uploads:
+        results[upload['server']] = upload['error']
+        if not quiet:
+            if upload['error']:
+                print 'upload to qmanager %s failed: %s' % (
+                    upload['server'], upload['error'])
+            else:
+                print 'successfully sent %s file (%s) to qmanager %s' % (
+                    storage_type, file_path, upload['server'])
+
+    if any(not upload['error'] for upload in uploads):
+        # Remember the digest of the source, for the next upload of it.
+        if stream_compress:
+            cache = _get_digest_cache()
+            if cache is not None:
+                cache.store(file_path, source_hash.hexdigest(), source_stat)
+        elif (cache is not None and known_digest is None and
+              'sha1' in algorithms and send_path == file_path):
+            cache.store(file_path, tee.hexdigest('sha1'), file_stat)
+    return results
 
 
 def recv_file_from_qmanager(user_name, file_path, shared,
-                            qmserver=DEFAULT_QM_SERVER, quiet=True):
+                            qmserver=DEFAULT_QM_SERVER, quiet=True,
+                            resume=False, chunk_size=None, sock_buf=None,
+                            wait=True, confirm_timeout=None, metrics=None,
+                            rate_limit=None, hash_algorithm=None, stripes=1,
+                            decompress=False, sparse=None,
+                            download_cache=True):
     """Download the specified file from the QManager server.
 
     Arguments:
@@ -475,9 +4384,59 @@ def recv_file_from_qmanager(user_name, file_path, shared,
     qmserver  -- Optional.  QManager server DNS name or IP address.  Default
                  value is Calabasas QManager server.
     quiet     -- Optional.  Do not print output if True.
+    resume    -- Optional.  Make the download resumable.  Data is received
+                 into file_path + '.part' and progress is recorded in a
+                 journal under JOURNAL_DIR.  If a previous resumable download
+                 of the same file was interrupted, the partial file is checked
+                 against the journal and appended to.
+    chunk_size -- Optional.  Size of socket receives and file writes.
+                 Default is chosen by tune_transfer().
+    sock_buf  -- Optional.  Socket receive buffer size.  Default is chosen by
+                 tune_transfer().
+    wait      -- Optional.  Wait for the server to confirm the download.  If
+                 False, return a TransferConfirmation as soon as the data is
+                 received.  The file is removed if the server reports an
+                 error.
+    confirm_timeout -- Optional.  Seconds to wait for the server to confirm
+                 the download.  Default is CONFIRM_TIMEOUT.
+    metrics   -- Optional.  TransferMetrics to record the download in.  Its
+                 callback is given the record when the download is confirmed
+                 or fails.
+    rate_limit -- Optional.  Limit the download to this many bytes per
+                 second, or to the rate of this RateLimiter, which can be
+                 changed during the download.  The global_rate_limiter also
+                 applies.
+    hash_algorithm -- Optional.  Algorithm the download is verified with.
+                 Default is the first in HASH_ALGORITHMS that the server
+                 supports.  Resumable downloads always use SHA-1.
+    stripes   -- Optional.  Number of parallel connections to receive the
+                 file over.  Each connection carries one byte range, which is
+                 written straight to its offset in the file.  Falls back to a
+                 single connection if the server does not support striped
+                 download, or for a resumable download.
+    decompress -- Optional.  Decompress a gzip, bz2 or xz file while it is
+                 received, and save the decompressed file under file_path
+                 without its .gz, .bz2 or .xz extension.  The format is
+                 recognized from the data.  The server still checks the hash
+                 of the compressed data received.  Uses one connection, and
+                 is not resumable.
+    sparse    -- Optional.  Leave holes in the saved file for blocks of
+                 zeros, instead of writing them, so that a mostly empty image
+                 uses only the disk space of its data.  The file is then not
+                 preallocated.  Default is SPARSE_WRITES for a file saved
+                 without a .gz, .bz2 or .xz extension.
+    download_cache -- Optional.  If the server can report the size and hash
+                 of a file, look for the file in the download FileCache under
+                 DOWNLOAD_CACHE_DIR, with one call to the server, and if it is
+                 there, place it at file_path with a reflink or copy
+                 instead of downloading it.  Files downloaded are added to
+                 the cache if they can be reflinked into it, so the cache
+                 only works on file systems with reflinks.  Not used with
+                 decompress.  Totals are kept in download_cache_stats.
 
     Return:
-    Nothing (None) if success.  Raises RuntimeError if error.
+    Nothing (None) if success, or a TransferConfirmation if wait is False.
+    Raises RuntimeError if error.
 
     """
     qms_url = 'http://%s:8080' % (qmserver,)
@@ -489,70 +4448,225 @@ def recv_file_from_qmanager(user_name, file_path, shared,
     else:
         storage_type = 'private'
     file_path = os.path.abspath(file_path)
+    if decompress:
+        file_path = decompressed_path(file_path)
+    if sparse is None:
+        sparse = SPARSE_WRITES and decompressed_path(file_path) == file_path
+    if metrics is None:
+        metrics = TransferMetrics()
+    metrics.record.update(direction='download', file=file_name,
+                          path=file_path, server=qmserver, user=user_name)
     if not quiet:
         print 'User "%s" downloading %s file "%s" from QM server %s to "%s"'\
               % (user_name, storage_type, file_name, qms_url, file_path)
 
     qms = xmlrpclib.ServerProxy(qms_url)
-    try:
-        server_info = qms.get_server_info()
-    except Exception, ex:
-        raise RuntimeError('unable to contact QManager (%s): %s'%(qms_url,ex))
+    server_info = _server_call(metrics, qms_url, qms.get_server_info)
 
     ver = server_info.get('server_version')
     if ver < '1.0.4':
-        raise RuntimeError('This version (%s) of QManager server does not '
-                           'support download.' % (ver,))
+        error = 'This version (%s) of QManager server does not support '\
+                'download.' % (ver,)
+        metrics.finish(error)
+        raise RuntimeError(error)
+
+    capabilities = frozenset(server_info.get('capabilities', ()))
+    if resume and decompress:
+        if not quiet:
+            print 'download is not resumable when decompressing'
+        resume = False
+    if resume and 'resume' not in capabilities:
+        if not quiet:
+            print 'qmanager does not support resumable download'
+        resume = False
+    if stripes > 1 and decompress:
+        if not quiet:
+            print 'decompressing download over one connection'
+        stripes = 1
+    if stripes > 1 and (resume or 'striped_download' not in capabilities):
+        if not quiet:
+            print 'striped download not available, using one connection'
+        stripes = 1
+    try:
+        algorithm = 'sha1' if resume else _choose_hash(capabilities,
+                                                       hash_algorithm)
+    except (RuntimeError, ValueError) as e:
+        metrics.finish(e)
+        raise RuntimeError(str(e))
+    metrics.record['hash_algorithm'] = algorithm
+
+    cache = None
+    if download_cache and not decompress and 'file_info' in capabilities:
+        cache = _get_download_cache()
+    try:
+        cached = cache is not None and len(cache)
+    except sqlite3.Error:
+        cached = False
+    if cached:
+        # One call tells whether the cached copy is still current.
+        info = _server_call(metrics, qms_url, qms.file_info, user_name,
+                            file_name,
+                            *(() if algorithm == 'sha1' else (algorithm,)))
+        if not info:
+            metrics.finish('file not found')
+            raise RuntimeError('%s file not found on qmanager: %s'
+                               % (storage_type, file_name))
+        cache_key = _download_cache_key(qmserver, file_name, algorithm,
+                                        info['hash'],
+                                        long(info['file_size']))
+        try:
+            method = cache.place(cache_key, file_path)
+        except (OSError, IOError, sqlite3.Error) as e:
+            if not quiet:
+                print 'unable to use download cache:', e
+            method = None
+        if method is not None:
+            size = long(info['file_size'])
+            download_cache_stats['hits'] += 1
+            download_cache_stats['bytes_saved'] += size
+            metrics.record['bytes_out'] = size
+            metrics.record['cached'] = size
+            if algorithm == 'sha1':
+                _record_transfer(qmserver, user_name, file_name, size,
+                                 info['hash'])
+            metrics.finish()
+            if not quiet:
+                print 'placed %s file (%s) from download cache with %s, '\
+                      '%d bytes not received' % (storage_type, file_name,
+                                                 method, size)
+            return
+    if cache is not None:
+        download_cache_stats['misses'] += 1
 
     # Tell QManager to get ready to send the file.
-    dl_info = qms.download(user_name, file_name)
+    part_path = journal = resume_at = None
+    if resume:
+        # Find out how much of any partial download is still good, and ask
+        # the server to send the rest.
+        part_path = file_path + '.part'
+        journal = TransferJournal.load('download', qmserver, user_name,
+                                       file_name, file_path)
+        if journal is not None and os.path.isfile(part_path):
+            with open(part_path, 'rb') as f:
+                resume_at = journal.resume(
+                    f, min(journal.offset, os.path.getsize(part_path)))
+        offset = resume_at[0] if resume_at else 0
+        dl_info = _server_call(metrics, qms_url, qms.download, user_name,
+                               file_name, str(offset))
+        if (dl_info and resume_at and
+            long(dl_info['file_size']) != journal.record['identity']['size']):
+            # File on server changed, so start over.  The server abandons the
+            # transfer that is not connected to.
+            resume_at = None
+            dl_info = _server_call(metrics, qms_url, qms.download,
+                                   user_name, file_name, '0')
+        if dl_info and resume_at is None:
+            journal = TransferJournal.create(
+                'download', qmserver, user_name, file_name, file_path,
+                dl_info['fetch_id'], {'size': long(dl_info['file_size'])})
+    elif stripes > 1:
+        dl_info = _server_call(
+            metrics, qms_url, qms.download_striped, user_name, file_name,
+            stripes, *(() if algorithm == 'sha1' else (algorithm,)))
+    elif algorithm != 'sha1':
+        dl_info = _server_call(metrics, qms_url, qms.download, user_name,
+                               file_name, '0', algorithm)
+    else:
+        dl_info = _server_call(metrics, qms_url, qms.download, user_name,
+                               file_name)
     if not dl_info:
+        metrics.finish('file not found')
         raise RuntimeError('%s file not found on qmanager: %s'
                            % (storage_type, file_name))
 
     fetch_id = dl_info['fetch_id']
-    server_port = dl_info['server_port']
+    server_port = dl_info.get('server_port')
     file_size = dl_info['file_size'] if not quiet else None
 
     if not quiet:
-        print 'receiving %s file (%s) from qmanager on port %s'\
-              % (storage_type, file_name, server_port)
+        if stripes > 1:
+            print 'receiving %s file (%s) from qmanager over %d connections'\
+                  % (storage_type, file_name, len(dl_info['stripes']))
+        elif resume_at and resume_at[0]:
+            print 'resuming download of %s file (%s) at byte %d on port %s'\
+                  % (storage_type, file_name, resume_at[0], server_port)
+        else:
+            print 'receiving %s file (%s) from qmanager on port %s'\
+                  % (storage_type, file_name, server_port)
 
     # Receive the file from the server.
-    status, results = _recv_file(file_path, qmserver, server_port, file_size)
+    chunk_size, sock_buf = tune_transfer(qmserver, chunk_size, sock_buf)
+    start_time = time.time()
+    if stripes > 1:
+        status, results = _recv_file_striped(
+            file_path, qmserver, dl_info['stripes'],
+            long(dl_info['file_size']), file_size, chunk_size=chunk_size,
+            sock_buf=sock_buf, metrics=metrics,
+            limiters=_rate_limiters(rate_limit), hash_algorithm=algorithm,
+            sparse=sparse)
+    else:
+        status, results = _recv_file(file_path, qmserver, server_port,
+                                     file_size, tmp_path=part_path,
+                                     journal=journal, resume=resume_at,
+                                     preallocate=None if decompress or
+                                     sparse else long(dl_info['file_size']),
+                                     chunk_size=chunk_size,
+                                     sock_buf=sock_buf, metrics=metrics,
+                                     limiters=_rate_limiters(rate_limit),
+                                     hash_algorithm=algorithm,
+                                     decompress=decompress, sparse=sparse)
+    elapsed = time.time() - start_time
+    if status and elapsed > 1:
+        _link_throughput[qmserver] = results['size'] / elapsed
+    if status and journal is not None:
+        journal.remove()
 
     # Check the results from sending the file.
     if not status:
+        metrics.finish(results)
         raise RuntimeError('failed to download %s file: %s' %
                            (storage_type, results,))
 
     my_fsize = results['size']
     my_fhash = results['hash']
+    metrics.record['bytes_out'] = my_fsize
+    if decompress:
+        metrics.record['bytes_out'] = os.path.getsize(file_path)
+        if my_fsize != metrics.record['bytes_out']:
+            metrics.record['compression_ratio'] = (
+                float(metrics.record['bytes_out']) / my_fsize)
+
+    def on_result(status, qms_results):
+        if not status:
+            try:
+                os.unlink(file_path)
+            except:
+                pass
+            raise RuntimeError('failed to get %s file from qmanager: %s' %
+                               (storage_type, qms_results))
+
+        # The manifest records SHA-1 digests.
+        if algorithm == 'sha1':
+            _record_transfer(qmserver, user_name, file_name, my_fsize,
+                             my_fhash)
+        if cache is not None:
+            try:
+                cache.store(_download_cache_key(qmserver, file_name,
+                                                algorithm, my_fhash,
+                                                my_fsize), file_path)
+            except (OSError, IOError, sqlite3.Error):
+                # The download itself succeeded.
+                pass
+
+    confirmation = TransferConfirmation(qms_url, 'transfer_results',
+                                        (fetch_id, my_fhash, str(my_fsize)),
+                                        on_result, confirm_timeout, metrics)
+    if not wait:
+        return confirmation
 
-    result_data = None
     if not quiet:
         print 'waiting to confirm download',
-    while True:
-        result_data = qms.transfer_results(fetch_id, my_fhash, str(my_fsize))
-        if result_data:
-            break
-        if not quiet:
-            sys.stdout.write('.')
-            sys.stdout.flush()
-        # Sleep, because other end may still be processing file.
-        time.sleep(3)
-
-    if not quiet:
-        print
-
-    status, qms_results = result_data
-    if not status:
-        try:
-            os.unlink(file_path)
-        except:
-            pass
-        raise RuntimeError('failed to get %s file from qmanager: %s' %
-                           (storage_type, qms_results))
+    _wait_confirmation(confirmation, quiet)
 
     if not quiet:
         print 'successfully received %s file from qmanager: %s' % (
@@ -560,54 +4674,401 @@ def recv_file_from_qmanager(user_name, file_path, shared,
 
 
 def is_compressed(buff):
-    # Recognizer for compressed file data.
+    # Recognizer for compressed file data.  Returns the name of the format,
+    # 'zip', 'gzip', 'bz2' or 'xz', or False if not recognized.
     magic = {'zip': '\x50\x4b\x03\x04',
              'gzip': '\x1f\x8b\x08',
              'bz2': '\x42\x5a\x68',
              'xz': '\xfd\x37\x7a\x58\x5a\x00'}
 
-    for num in magic.itervalues():
+    for fmt, num in magic.iteritems():
         if buff.startswith(num):
             # File is recognized as compressed.
-            return True
+            return fmt
 
     return False
 
 
-def compress(src_path):
-    """If file is not already compressed, then compress it.
+def _needs_compress(src_path):
+    """Return True if the file is not already compressed and is not an ISO."""
+    if src_path.endswith('.iso'):
+        return False
+    with open(src_path, 'rb') as f_in:
+        return not is_compressed(f_in.read(1024))
+
+
+def _gzip_header(fname, mtime):
+    # Same gzip member header that gzip.GzipFile writes.
+    header = ['\037\213\010', chr(gzip.FNAME if fname else 0),
+              struct.pack('<L', long(mtime)), '\002\377']
+    if fname:
+        header.append(fname + '\000')
+    return ''.join(header)
+
+
+def _deflate_block(data, compresslevel):
+    """Compress one block as raw deflate data.  Return (data, crc32)."""
+    comp = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS,
+                            zlib.DEF_MEM_LEVEL, 0)
+    return (comp.compress(data) + comp.flush(),
+            zlib.crc32(data) & 0xffffffffL)
 
-    If the file is already compressed, then it is not modified and the
-    src_path is returned.
+
+def _gzip_stream(src_path, compresslevel=9, workers=1,
+                 block_size=GZIP_BLOCK_SIZE, pool=None, source_hash=None):
+    """Generate the gzip-compressed data of a file, in pieces.
+
+    With one worker, the output is a single gzip member, the same as
+    gzip.GzipFile writes.  With more workers, the file is split into blocks
+    of block_size bytes that are compressed in parallel on a thread pool, and
+    each block is output as its own gzip member.  The concatenated members
+    are a standard multi-member gzip stream.  zlib releases the GIL while
+    compressing, so the threads run on separate cores.
+
+    The holes of a sparse file are not read from disk, see SparseFile.
 
     Arguments:
-    src_path -- Path/name of file to compress.
+    src_path      -- Path of file to compress.
+    compresslevel -- Optional.  zlib compression level, 1 to 9.
+    workers       -- Optional.  Number of blocks to compress at once.
+    block_size    -- Optional.  Size of uncompressed blocks.
+    pool          -- Optional.  ThreadPool to use instead of creating one.
+                     This allows several files to share the same workers.
+    source_hash   -- Optional.  Hash object to update with the uncompressed
+                     data.
 
     Return:
-    New path/name of compressed file.  This is the src_path with the
-    compressed file extension (.gz) appended to it.
+    Generator of (compressed_data, uncompressed_size) tuples.
 
     """
-    if src_path.endswith('.iso'):
-        return src_path
-    src_mtime = os.path.getmtime(src_path)
-    with open(src_path, 'rb') as f_in:
-        start_of_file = f_in.read(1024)
-        f_in.seek(0)
-        if is_compressed(start_of_file):
-            return src_path
-
-        # File is not compressed, so compress it.
-        dst_path = src_path + '.gz'
-        with gzip.GzipFile(dst_path, 'wb', mtime=src_mtime) as f_out:
+    fname = os.path.basename(src_path)
+    header = _gzip_header(fname, os.path.getmtime(src_path))
+
+    if workers == 1 and pool is None:
+        yield header, 0
+        crc = zlib.crc32('') & 0xffffffffL
+        size = pending = 0
+        comp = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
+        with _open_sparse(src_path) as f_in:
             while True:
                 data = f_in.read(CHUNK_SIZE)
                 if not data:
                     break
+                if source_hash is not None:
+                    source_hash.update(data)
+                crc = zlib.crc32(data, crc) & 0xffffffffL
+                size += len(data)
+                pending += len(data)
+                out = comp.compress(data)
+                if out:
+                    yield out, pending
+                    pending = 0
+
+        yield (comp.flush() + struct.pack('<LL', crc, size & 0xffffffffL),
+               pending)
+        return
+
+    own_pool = pool is None
+    if own_pool:
+        pool = ThreadPool(workers)
+    # Keep enough blocks in flight to keep every worker busy, but no more, so
+    # memory use is bounded by the block size and not the file size.
+    max_pending = 2 * workers
+    pending = collections.deque()
+    members = 0
+    try:
+        with _open_sparse(src_path) as f_in:
+            while True:
+                data = f_in.read(block_size)
+                if data:
+                    if source_hash is not None:
+                        source_hash.update(data)
+                    pending.append((pool.apply_async(
+                        _deflate_block, (data, compresslevel)), len(data)))
+                    if len(pending) < max_pending:
+                        continue
+                if not pending:
+                    break
+                result, size = pending.popleft()
+                body, crc = result.get()
+                yield (header + body + struct.pack('<LL', crc, size), size)
+                header = _gzip_header('', 0)
+                members += 1
+                if not data and not pending:
+                    break
+    finally:
+        if own_pool:
+            pool.terminate()
+
+    if not members:
+        # Empty file still needs one gzip member.
+        body, crc = _deflate_block('', compresslevel)
+        yield header + body + struct.pack('<LL', crc, 0), 0
+
+
+def _new_compressor(codec, compresslevel):
+    """Return a bz2 or xz compressor object."""
+    if codec == 'bz2':
+        return bz2.BZ2Compressor(compresslevel)
+    if codec == 'xz':
+        if lzma is None:
+            raise RuntimeError('xz compression needs the lzma module '
+                               '(backports.lzma on Python 2)')
+        return lzma.LZMACompressor(preset=compresslevel)
+    raise ValueError('unknown compression codec: %s' % (codec,))
+
+
+def _compress_stream(src_path, codec='gzip', compresslevel=None, workers=1,
+                     block_size=GZIP_BLOCK_SIZE, pool=None, source_hash=None):
+    """Generate the compressed data of a file, in pieces.
+
+    gzip is compressed by _gzip_stream(), on workers threads.  bz2 and xz are
+    compressed as one stream on the calling thread, and ignore workers,
+    block_size and pool.
+
+    Arguments:
+    src_path      -- Path of file to compress.
+    codec         -- Optional.  'gzip', 'bz2' or 'xz'.
+    compresslevel -- Optional.  Compression level.  Default is the codec's
+                     level in CODEC_LEVELS.
+
+    The other arguments are the same as for _gzip_stream().
+
+    Return:
+    Generator of (compressed_data, uncompressed_size) tuples.
+
+    """
+    if compresslevel is None:
+        compresslevel = CODEC_LEVELS.get(codec)
+    if codec == 'gzip':
+        return _gzip_stream(src_path, compresslevel, workers, block_size,
+                            pool, source_hash)
+    comp = _new_compressor(codec, compresslevel)
+    return _sequential_stream(src_path, comp, source_hash)
+
+
+def _sequential_stream(src_path, comp, source_hash):
+    pending = 0
+    with _open_sparse(src_path) as f_in:
+        while True:
+            data = f_in.read(CHUNK_SIZE)
+            if not data:
+                break
+            if source_hash is not None:
+                source_hash.update(data)
+            pending += len(data)
+            out = comp.compress(data)
+            if out:
+                yield out, pending
+                pending = 0
+
+    yield comp.flush(), pending
+
+
+def _compress_sample(data, codec, compresslevel):
+    """Compress a sample block in one piece.  Return the compressed size."""
+    if codec == 'gzip':
+        return len(zlib.compress(data, compresslevel))
+    if codec == 'bz2':
+        return len(bz2.compress(data, compresslevel))
+    if codec == 'xz':
+        return len(lzma.compress(data, preset=compresslevel))
+    return len(data)
+
+
+def choose_codec(src_path, bandwidth, workers=1, streaming=True):
+    """Choose the codec and level that upload a file in the least time.
+
+    AUTO_SAMPLE_BLOCKS blocks of AUTO_SAMPLE_SIZE bytes, spread evenly through
+    the file, are compressed with each candidate in AUTO_CODECS to estimate
+    its compression ratio and speed.  From these, and the link bandwidth,
+    the time to compress the whole file and to send the result is predicted.
+    When streaming, compression and sending overlap and the slower of the two
+    sets the total time.  Otherwise the file is compressed before it is sent
+    and the times add up.  Candidate ('none', 0) sends the file as is.
+
+    Arguments:
+    src_path  -- Path of file to upload.
+    bandwidth -- Link bandwidth in bytes per second.
+    workers   -- Optional.  Number of threads gzip compresses with.
+    streaming -- Optional.  True if the compressed data is sent while it is
+                 produced.
+
+    Return:
+    Dict with the chosen 'codec' and 'level', the 'bandwidth', 'streaming',
+    'file_size' and 'sample_bytes' the choice was based on, the 'predicted'
+    ratio, compress_time, transfer_time and total_time of the choice, and
+    the 'candidates' considered, each with its codec, level, ratio, speed
+    (bytes/s) and total_time.
+
+    """
+    file_size = os.path.getsize(src_path)
+    nblocks = max(1, min(AUTO_SAMPLE_BLOCKS, file_size // AUTO_SAMPLE_SIZE))
+    samples = []
+    with open(src_path, 'rb') as f:
+        for i in xrange(nblocks):
+            f.seek(i * (file_size // nblocks))
+            samples.append(f.read(AUTO_SAMPLE_SIZE))
+    sample_bytes = sum(len(data) for data in samples)
+    gzip_workers = min(workers, max(1, -(-file_size // GZIP_BLOCK_SIZE)))
+
+    best = None
+    candidates = []
+    for codec, level in AUTO_CODECS:
+        if codec == 'xz' and lzma is None:
+            continue
+        if codec == 'none':
+            ratio, speed, compress_time = 1.0, None, 0.0
+        else:
+            start = time.time()
+            out_bytes = sum(_compress_sample(data, codec, level)
+                            for data in samples)
+            elapsed = max(time.time() - start, 1e-6)
+            ratio = float(out_bytes) / sample_bytes if sample_bytes else 1.0
+            speed = sample_bytes / elapsed
+            if codec == 'gzip':
+                speed *= gzip_workers
+            compress_time = file_size / speed
+        transfer_time = file_size * ratio / bandwidth
+        if streaming:
+            total_time = max(compress_time, transfer_time)
+        else:
+            total_time = compress_time + transfer_time
+        candidates.append({'codec': codec, 'level': level, 'ratio': ratio,
+                           'speed': speed, 'total_time': total_time})
+        if best is None or total_time < best[0]:
+            best = (total_time, codec, level, {
+                'ratio': ratio, 'compress_time': compress_time,
+                'transfer_time': transfer_time, 'total_time': total_time})
+
+    _, codec, level, predicted = best
+    return {'codec': codec, 'level': level, 'bandwidth': bandwidth,
+            'streaming': streaming, 'file_size': file_size,
+            'sample_bytes': sample_bytes, 'predicted': predicted,
+            'candidates': candidates}
+
+
+def _compress_file(src_path, compresslevel, workers, block_size, pool,
+                   codec='gzip', cache=None):
+    if not _needs_compress(src_path):
+        return src_path
+
+    dst_path = src_path + CODEC_EXTENSIONS[codec]
+    if cache is not None:
+        # Reuse the output of an earlier compress() of the unchanged file.
+        st = os.stat(src_path)
+        level = compresslevel
+        if level is None:
+            level = CODEC_LEVELS[codec]
+        key = '%d:%d:%d:%d:%s:%d' % (_stat_key(st) + (codec, level))
+        try:
+            if cache.place(key, dst_path):
+                return dst_path
+        except (OSError, IOError, sqlite3.Error):
+            pass
+
+    # File is not compressed, so compress it.  Write a new file and rename
+    # it over dst_path, rather than writing into a file that may be shared.
+    fd, tmp_path = tempfile.mkstemp(
+        prefix='.%s.' % (os.path.basename(dst_path),), suffix='.part',
+        dir=os.path.dirname(dst_path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f_out:
+            for data, _ in _compress_stream(src_path, codec, compresslevel,
+                                            workers, block_size, pool):
                 f_out.write(data)
+        os.chmod(tmp_path, _new_file_mode(dst_path))
+        if os.name == 'nt' and os.path.isfile(dst_path):
+            os.unlink(dst_path)
+        os.rename(tmp_path, dst_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    # A file modified again within the same mtime tick would keep its key.
+    if (cache is not None and time.time() - st.st_mtime >= 2 and
+        _stat_key(os.stat(src_path)) == _stat_key(st)):
+        try:
+            cache.store(key, dst_path)
+        except (OSError, IOError, sqlite3.Error):
+            pass
 
     return dst_path
 
+
+def compress(src_path, workers=1, block_size=GZIP_BLOCK_SIZE,
+             compresslevel=None, codec='gzip', bandwidth=None,
+             use_cache=False):
+    """If file is not already compressed, then compress it.
+
+    If the file is already compressed, then it is not modified and the
+    src_path is returned.
+
+    With use_cache, compressed files are kept in a FileCache under
+    COMPRESS_CACHE_DIR, keyed on the device, inode, size and mtime of the
+    source file and the codec and level.  If the source has not changed since
+    it was last compressed the same way, the cached file is placed at the new
+    path with a reflink or copy, instead of compressing again.  Adding a file
+    to the cache costs a copy of it where the file system has no reflinks.
+
+    Arguments:
+    src_path      -- Path/name of file to compress, or a list of paths to
+                     compress at the same time.
+    workers       -- Optional.  Number of threads to compress with.  With
+                     more than one, the output is a multi-member gzip file
+                     made of independently compressed blocks.  None to use
+                     one thread per CPU.  bz2 and xz use one thread per file.
+    block_size    -- Optional.  Size of uncompressed blocks that are
+                     compressed in parallel.
+    compresslevel -- Optional.  Compression level.  Default is the codec's
+                     level in CODEC_LEVELS.
+    codec         -- Optional.  'gzip', 'bz2' or 'xz', or 'auto' to let
+                     choose_codec() pick the codec and level for each file.
+    bandwidth     -- Optional.  With codec 'auto', the bandwidth in Mbit/s
+                     of the link the file will be sent over.  Default is the
+                     value of QMUPLOAD_BANDWIDTH, or DEFAULT_BANDWIDTH.
+    use_cache     -- Optional.  Look for the compressed file in the cache, and
+                     add it to the cache.  Default is False.
+
+    Return:
+    New path/name of compressed file.  This is the src_path with the
+    compressed file extension (.gz, .bz2 or .xz) appended to it.  If a list
+    of paths was given, then a list of paths in the same order.  With codec
+    'auto', a file may be returned uncompressed.
+
+    """
+    if workers is None:
+        workers = COMPRESS_WORKERS
+    if codec == 'auto':
+        bandwidth = _link_bandwidth(None, bandwidth)
+    cache = _get_compress_cache() if use_cache else None
+
+    def compress_one(path, pool):
+        file_codec, level = codec, compresslevel
+        if codec == 'auto':
+            if not _needs_compress(path):
+                return path
+            decision = choose_codec(path, bandwidth, workers, False)
+            file_codec, level = decision['codec'], decision['level']
+            if file_codec == 'none':
+                return path
+        return _compress_file(path, level, workers, block_size, pool,
+                              file_codec, cache)
+
+    if isinstance(src_path, basestring):
+        return compress_one(src_path, None)
+
+    # Compress all files at once, with their blocks sharing one worker pool.
+    pool = ThreadPool(workers)
+    file_pool = ThreadPool(len(src_path))
+    try:
+        return file_pool.map(lambda path: compress_one(path, pool), src_path)
+    finally:
+        file_pool.terminate()
+        pool.terminate()
+
 #
 # When this module is run as a script, then interact with the user.
 #
@@ -662,28 +5123,73 @@ if __name__ == '__main__':
     quiet = False
     download = False
     shared = False
+    resume = False
+    metrics_path = None
+    codec = 'gzip'
+    delta_base = None
+    decompress = False
+    sparse = None
+    compress_cache = False
 
     while argv and argv[0].startswith('-'):
         arg = argv.pop(0)
+        if arg == '-b' and argv:
+            delta_base = argv.pop(0)
+        if arg == '-c' and argv:
+            codec = argv.pop(0)
+        if arg == '-l' and argv:
+            global_rate_limiter.set_rate(float(argv.pop(0)) * 1000000 / 8)
+        if arg == '-m' and argv:
+            metrics_path = argv.pop(0)
         if arg == '-n':
             ask_confirm = False
         if arg == '-q':
             quiet = True
         if arg == '-d':
             download = True
+        if arg == '-k':
+            compress_cache = True
+        if arg == '-r':
+            resume = True
         if arg == '-s':
             shared = True
+        if arg == '-x':
+            decompress = True
+        if arg == '-z':
+            sparse = True
         elif arg in ('-h', '--help', '-help', '-?'):
             print usage_msg
             print 'Options'
+            print '    -b base_file : upload only the differences from '\
+                  'base_file on qmanager'
+            print '    -c codec : compress upload with gzip (default), bz2, '\
+                  'xz or none,'
+            print '               or auto to pick the fastest to upload'
             print '    -d  : download a file from qmanager'
+            print '    -k  : keep the compressed file in a cache, to upload '\
+                  'it again without'
+            print '          compressing it again if it has not changed'
+            print '    -l mbps : limit transfer rate to mbps Mbit/s'
+            print '    -m metrics_file : append a JSON record of transfer '\
+                  'metrics to file'
+            print '                      (- for stdout)'
             print '    -n  : no interactive confirmation'
             print '    -q  : be quiet - do not print output'
+            print '    -r  : resumable transfer - continue if interrupted'
             print '    -s  : use shared storage area'
+            print '    -x  : with -d, decompress a gzip, bz2 or xz file '\
+                  'while downloading'
+            print '    -z  : with -d, leave holes for blocks of zeros '\
+                  'instead of preallocating'
+            print '          the file'
             print
             print ('If -d specified and no file_path specified, then user '
                    'selects file from list.')
             print
+            print ('To upload to several qmanager servers at once, give '
+                   'them separated by')
+            print 'commas, as in server1,server2.'
+            print
             sys.exit(0)
 
     argc = len(argv)
@@ -768,16 +5274,43 @@ if __name__ == '__main__':
         print _check_file(file_path)
         sys.exit(1)
 
+    def write_metrics(record):
+        line = json.dumps(record, sort_keys=True)
+        if metrics_path == '-':
+            print line
+        else:
+            with open(metrics_path, 'a') as f:
+                f.write(line + '\n')
+
+    metrics = TransferMetrics(write_metrics if metrics_path else None)
+    qmservers = qmserver.split(',')
     try:
-        if download:
+        if len(qmservers) > 1:
+            if download or resume or delta_base:
+                raise RuntimeError('-d, -r and -b need a single qmanager '
+                                   'server')
+            results = send_file_to_qmanagers(
+                user_name, file_path, shared, qmservers, quiet,
+                stream_compress=True, codec=codec,
+                metrics_callback=metrics.callback,
+                compress_cache=compress_cache)
+            failed = [server for server in qmservers if results[server]]
+            if failed:
+                raise RuntimeError('upload failed to %s' %
+                                   (', '.join(failed),))
+        elif download:
             recv_file_from_qmanager(user_name, file_path, shared, qmserver,
-                                    quiet)
+                                    quiet, resume=resume, metrics=metrics,
+                                    decompress=decompress, sparse=sparse)
         else:
-            comp_path = compress(file_path)
-            send_file_to_qmanager(user_name, comp_path, shared, qmserver,
-                                  quiet)
-            if comp_path != file_path:
-                os.unlink(comp_path)
+            send_file_to_qmanager(user_name, file_path, shared, qmserver,
+                                  quiet, resume=resume, stream_compress=True,
+                                  metrics=metrics, codec=codec,
+                                  delta_base=delta_base,
+                                  compress_cache=compress_cache)
+            if dedupe_stats['files'] and not quiet:
+                print 'bytes saved by server-side copy:',\
+                      dedupe_stats['bytes_saved']
     except Exception, ex:
         print 'ERROR:', ex
         sys.exit(1)